@@ -0,0 +1,3 @@
+# synthetic fleet generator and benchmarks for ingestion, reports and /metrics,
+# run with `python -m benchmarks --help`, compare two runs with `python -m benchmarks.compare`
+# `python -m benchmarks.parity` checks report engines against TimeHandler on an existing database
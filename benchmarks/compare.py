@@ -0,0 +1,45 @@
+import argparse
+import json
+
+
+def compare(baseline, candidate, stat="median"):
+    # name -> (baseline, candidate, candidate / baseline) for the benchmarks both runs have
+    before = {result["name"]: result for result in baseline["results"]}
+    rows = []
+    for result in candidate["results"]:
+        old = before.get(result["name"])
+        if old is None:
+            continue
+        ratio = result[stat] / old[stat] if old[stat] else None
+        rows.append((result["name"], old[stat], result[stat], ratio))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.compare",
+                                     description="compare two `python -m benchmarks --out` result files")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--stat", default="median", choices=("min", "median", "p95", "max"))
+    parser.add_argument("--threshold", type=float, default=1.10,
+                        help="exit 1 when any benchmark is this many times slower")
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    print(f"{baseline['meta'].get('commit')} -> {candidate['meta'].get('commit')} ({args.stat}, seconds)")
+
+    regressed = False
+    for name, old, new, ratio in compare(baseline, candidate, args.stat):
+        flag = ""
+        if ratio is not None and ratio > args.threshold:
+            flag = "  slower"
+            regressed = True
+        print(f"{name:45} {old:12.6f} {new:12.6f} {ratio if ratio is not None else float('nan'):8.2f}x{flag}")
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
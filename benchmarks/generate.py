@@ -0,0 +1,103 @@
+import csv
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from zoneinfo import available_timezones
+
+# same layout as the real exports, so DataLoader reads them unchanged
+STATUS_FILE = "store_status.csv"
+HOURS_FILE = "menu_hours.csv"
+TIMEZONES_FILE = "timezones.csv"
+
+DEFAULT_END = datetime(2024, 10, 14, 23, 55, tzinfo=timezone.utc)
+
+
+def _zones(rng, count):
+    # plenty of distinct zones, half hour and southern hemisphere ones included
+    zones = sorted(z for z in available_timezones() if "/" in z and not z.startswith(("Etc/", "SystemV/", "posix/", "right/")))
+    return rng.sample(zones, min(count, len(zones)))
+
+
+def _hours(rng, store_id, kind):
+    # kind 0 has no rows at all (open 24/7), the rest cover the shapes the engines special case
+    rows = []
+    closed = rng.randrange(7)
+    for day in range(7):
+        if kind == 1:
+            rows.append((store_id, day, "09:00:00", "18:00:00"))
+        elif kind == 2:
+            # crosses midnight
+            start = rng.choice(("20:00:00", "22:00:00", "23:30:00"))
+            rows.append((store_id, day, start, rng.choice(("02:00:00", "03:30:00", "05:00:00"))))
+        elif kind == 3:
+            # split shift, closed one day a week
+            if day == closed:
+                continue
+            rows.append((store_id, day, "07:00:00", "11:00:00"))
+            rows.append((store_id, day, "13:15:00", "21:45:00"))
+        elif kind == 4:
+            # overlapping intervals
+            rows.append((store_id, day, "10:00:00", "23:00:00"))
+            rows.append((store_id, day, "20:00:00", "23:59:59"))
+    return rows
+
+
+def generate(out_dir, stores=200, polls_per_hour=1.0, days=8, timezones=40, missing_hours=0.2,
+             missing_timezone=0.15, seed=0, end=DEFAULT_END):
+    # writes the three input csvs for a synthetic fleet and returns {name: (path, rows)}.
+    # every store is polled about polls_per_hour times an hour (jittered, with gaps) for `days`
+    # days up to `end`; statuses flip between active and inactive in outages of a few polls.
+    # missing_hours / missing_timezone are the share of stores left without that metadata
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    store_ids = [f"bench-{i:06d}" for i in range(stores)]
+    zones = _zones(rng, timezones)
+    start = end - timedelta(days=days)
+    step = 3600.0 / polls_per_hour
+
+    status_path = os.path.join(out_dir, STATUS_FILE)
+    status_rows = 0
+    with open(status_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["store_id", "status", "timestamp_utc"])
+        for store_id in store_ids:
+            ts = start + timedelta(seconds=rng.uniform(0, step))
+            down = 0
+            while ts < end:
+                if down == 0 and rng.random() < 0.05:
+                    down = rng.randint(1, 6)
+                status = "inactive" if down else "active"
+                down = max(down - 1, 0)
+                # a missed poll now and then
+                if rng.random() > 0.03:
+                    writer.writerow([store_id, status, ts.strftime("%Y-%m-%d %H:%M:%S.%f UTC")])
+                    status_rows += 1
+                ts += timedelta(seconds=step * rng.uniform(0.8, 1.2))
+
+    hours_path = os.path.join(out_dir, HOURS_FILE)
+    hours_rows = 0
+    with open(hours_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["store_id", "dayOfWeek", "start_time_local", "end_time_local"])
+        for store_id in store_ids:
+            kind = 0 if rng.random() < missing_hours else rng.randint(1, 4)
+            for row in _hours(rng, store_id, kind):
+                writer.writerow(row)
+                hours_rows += 1
+
+    timezones_path = os.path.join(out_dir, TIMEZONES_FILE)
+    timezone_rows = 0
+    with open(timezones_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["store_id", "timezone_str"])
+        for store_id in store_ids:
+            if rng.random() < missing_timezone:
+                continue
+            writer.writerow([store_id, rng.choice(zones)])
+            timezone_rows += 1
+
+    return {
+        "store_status": (status_path, status_rows),
+        "business_hours": (hours_path, hours_rows),
+        "timezones": (timezones_path, timezone_rows),
+    }
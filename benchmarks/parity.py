@@ -0,0 +1,77 @@
+import argparse
+import logging
+import os
+from datetime import timedelta
+
+
+def _row(handler, store_id, reference_time, windows):
+    # what the report would say for the store; any error is a row of zeros there
+    from core.services.report_runner import report_row
+    try:
+        return report_row(store_id, handler.calculate_store_metrics(store_id, reference_time), windows)
+    except Exception:
+        return "error"
+
+
+def compare_engines(db, engines, reference_time, windows, store_ids):
+    # engine -> [(store_id, TimeHandler row, engine row)] for every store that differs
+    from core.services.create_report import TimeHandler
+    from core.services.report_runner import ReportEngine, time_handler_for
+
+    reference = TimeHandler(db, windows)
+    handlers = {engine: time_handler_for(ReportEngine(engine), db, reference_time, windows=windows) for engine in engines}
+    mismatches = {engine: [] for engine in engines}
+    for store_id in store_ids:
+        expected = _row(reference, store_id, reference_time, windows)
+        for engine, handler in handlers.items():
+            got = _row(handler, store_id, reference_time, windows)
+            if got != expected:
+                mismatches[engine].append((store_id, expected, got))
+    return mismatches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.parity",
+        description="compare report engines against TimeHandler, store by store, on an existing database "
+                    "(read only)")
+    parser.add_argument("--database-url", help="default: DATABASE_URL")
+    parser.add_argument("--engines", default="sql", help="comma separated report engines")
+    parser.add_argument("--windows", default="1h,1d,7d")
+    parser.add_argument("--shifts", default="0,13,47,100",
+                        help="reference times, hours before the latest observation")
+    parser.add_argument("--sample", type=int, help="only the first N stores")
+    parser.add_argument("--show", type=int, default=5, help="mismatches printed per engine")
+    args = parser.parse_args(argv)
+
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    from core.db.models.store_status import StoreStatus
+    from core.services.create_report import SessionLocal
+    from core.services.report_runner import current_time
+    from core.services.windows import parse_windows
+
+    windows = parse_windows(args.windows)
+    engines = [engine for engine in args.engines.split(",") if engine]
+    failed = False
+    db = SessionLocal()
+    try:
+        latest = current_time(db)
+        store_ids = sorted(row[0] for row in db.query(StoreStatus.store_id).distinct())[:args.sample]
+        for shift in (float(hours) for hours in args.shifts.split(",")):
+            reference_time = latest - timedelta(hours=shift)
+            for engine, rows in compare_engines(db, engines, reference_time, windows, store_ids).items():
+                print(f"{engine:12} {reference_time.isoformat()}  {len(rows)} of {len(store_ids)} stores differ")
+                for store_id, expected, got in rows[:args.show]:
+                    print(f"  {store_id}\n    time_handler {expected}\n    {engine:12} {got}")
+                failed = failed or bool(rows)
+    finally:
+        db.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
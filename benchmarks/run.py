@@ -0,0 +1,222 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from .generate import generate
+
+ENGINES = ("per_store", "bulk", "vectorized", "incremental", "rollup")
+# only runs on postgres
+SQL_ENGINE = "sql"
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _summary(name, samples, **extra):
+    # every benchmark is one flat record, keyed by name, so two result files diff line by line
+    samples = sorted(samples)
+    return {
+        "name": name,
+        "runs": len(samples),
+        "min": round(samples[0], 6),
+        "median": round(statistics.median(samples), 6),
+        "p95": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 6),
+        "max": round(samples[-1], 6),
+        "unit": "s",
+        **extra,
+    }
+
+
+def bench_ingestion(files, repeat):
+    from core.db.database import SessionLocal
+    from core.services.data_loader import DataLoader
+
+    results = []
+    # timezones and hours first, loading store_status bootstraps the incremental state from them
+    for name, method in (("timezones", "load_timezones"), ("business_hours", "load_business_hours"),
+                         ("store_status", "load_store_status")):
+        path, rows = files[name]
+        samples = []
+        for _ in range(repeat):
+            db = SessionLocal()
+            try:
+                loader = DataLoader(db)
+                started = time.perf_counter()
+                getattr(loader, method)(path)
+                samples.append(time.perf_counter() - started)
+            finally:
+                db.close()
+        result = _summary(f"ingest.{name}", samples, rows=rows)
+        result["rows_per_sec"] = round(rows / result["median"], 1) if result["median"] else None
+        results.append(result)
+    return results
+
+
+def bench_reports(engines, repeat, out_dir, parallel=False, workers=None):
+    from core.services.create_report import SessionLocal
+    from core.services.metadata_cache import store_metadata
+    from core.services.report_runner import ReportEngine, current_time, iter_report, write_csv
+
+    results = []
+    report_path = None
+    for engine in engines:
+        samples = []
+        for run in range(repeat):
+            # first run of each engine starts without the metadata cache
+            if run == 0:
+                store_metadata.invalidate()
+            db = SessionLocal()
+            try:
+                path = os.path.join(out_dir, f"report_{engine}.csv")
+                started = time.perf_counter()
+                stores = write_csv(iter_report(db, ReportEngine(engine), parallel=parallel, workers=workers,
+                                               reference_time=current_time(db)), path)
+                samples.append(time.perf_counter() - started)
+            finally:
+                db.close()
+        results.append(_summary(f"report.{engine}{'.parallel' if parallel else ''}", samples, stores=stores,
+                                cold=round(samples[0], 6)))
+        report_path = path
+    return results, report_path
+
+
+def bench_store_metrics(sample, repeat):
+    from core.db.models.store_status import StoreStatus
+    from core.services.create_report import SessionLocal, TimeHandler
+    from core.services.report_runner import current_time
+
+    db = SessionLocal()
+    try:
+        reference_time = current_time(db)
+        store_ids = sorted(row[0] for row in db.query(StoreStatus.store_id).distinct())[:sample]
+        handler = TimeHandler(db)
+        samples = []
+        for _ in range(repeat):
+            for store_id in store_ids:
+                started = time.perf_counter()
+                handler.calculate_store_metrics(store_id, reference_time)
+                samples.append(time.perf_counter() - started)
+    finally:
+        db.close()
+    return [_summary("calculate_store_metrics.per_store", samples, stores=len(store_ids))]
+
+
+def bench_metrics_render(report_path, repeat):
+    from core.services.report_formats import ReportFormat, read_rows
+    from core.services.report_metrics import MetricsExposition
+
+    rows = list(read_rows(report_path, ReportFormat.CSV))
+    exposition = MetricsExposition()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        exposition.publish(datetime.now(timezone.utc), rows)
+        samples.append(time.perf_counter() - started)
+    scrapes = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        exposition.body(gzipped=True)
+        scrapes.append(time.perf_counter() - started)
+    return [
+        _summary("metrics.render", samples, stores=len(rows), bytes=len(exposition.body()),
+                 gzip_bytes=len(exposition.body(gzipped=True))),
+        _summary("metrics.scrape", scrapes),
+    ]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="load a synthetic fleet and time ingestion, reports and /metrics. "
+                    "the database tables are REPLACED, never point this at real data")
+    parser.add_argument("--database-url", help="sqlite or postgres url (default: a temporary sqlite file)")
+    parser.add_argument("--stores", type=int, default=200)
+    parser.add_argument("--polls-per-hour", type=float, default=1.0)
+    parser.add_argument("--days", type=int, default=8)
+    parser.add_argument("--timezones", type=int, default=40)
+    parser.add_argument("--missing-hours", type=float, default=0.2)
+    parser.add_argument("--missing-timezone", type=float, default=0.15)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--engines", help="comma separated report engines (default: all the database supports)")
+    parser.add_argument("--parallel", action="store_true", help="also time the sharded reports")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--sample-stores", type=int, default=50, help="stores timed one by one")
+    parser.add_argument("--out", help="write the json results here (default: stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="store-bench-")
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    # the core modules build their engines from the environment at import time
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.pop("DATABASE_REPLICA_URL", None)
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    from sqlalchemy.engine import make_url
+    from core.db.database import create_tables
+
+    try:
+        started = time.perf_counter()
+        files = generate(os.path.join(workdir, "data"), stores=args.stores, polls_per_hour=args.polls_per_hour,
+                         days=args.days, timezones=args.timezones, missing_hours=args.missing_hours,
+                         missing_timezone=args.missing_timezone, seed=args.seed)
+        generated = time.perf_counter() - started
+        create_tables()
+
+        if args.engines:
+            engines = [engine for engine in args.engines.split(",") if engine]
+        else:
+            engines = list(ENGINES)
+            if make_url(database_url).get_backend_name() == "postgresql":
+                engines.append(SQL_ENGINE)
+        results = bench_ingestion(files, args.repeat)
+        report_results, report_path = bench_reports(engines, args.repeat, workdir)
+        results += report_results
+        if args.parallel:
+            results += bench_reports([e for e in engines if e != "incremental"], args.repeat, workdir,
+                                     parallel=True, workers=args.workers)[0]
+        results += bench_store_metrics(args.sample_stores, args.repeat)
+        if report_path:
+            results += bench_metrics_render(report_path, args.repeat)
+
+        output = {
+            "meta": {
+                "commit": _commit(),
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "database": make_url(database_url).get_backend_name(),
+                "params": {key: value for key, value in vars(args).items() if key not in ("database_url", "out")},
+                "rows": {name: rows for name, (_, rows) in files.items()},
+                "generate_seconds": round(generated, 3),
+            },
+            "results": results,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(output, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+    return output
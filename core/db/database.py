@@ -1,17 +1,19 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 import os
 import logging
 import os
 
+from .engines import registry, PRIMARY
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# pools come from the shared registry (core/db/engines.py), this is the primary (write) side
+engine = registry.engine(PRIMARY)
+SessionLocal = registry.sessionmaker(PRIMARY)
 
 Base = declarative_base()
 
@@ -28,10 +30,16 @@ def create_tables():
         from .models.store_status import StoreStatus
         from .models.store_business_hours import StoreBusinessHours
         from .models.store_timezone import StoreTimezone
+        from .models.store_status_hourly import StoreStatusHourly
+        
+        from .partitioning import prepare_store_status, ensure_indexes
         
         logger.info(f"tables: {list(Base.metadata.tables.keys())}")
         
+        prepare_store_status(engine)
         Base.metadata.create_all(bind=engine)
+        with engine.begin() as conn:
+            ensure_indexes(conn)
         logger.info("Tables created successfully!")
             
     except Exception as e:
@@ -0,0 +1,77 @@
+import logging
+import os
+import threading
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = "primary"   # writes: uploads / loads
+REPORTS = "reports"   # report queries, DATABASE_REPLICA_URL when set, else the primary
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+
+# per process and per engine, a parallel report opens this much in every worker
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+# seconds before a pooled connection is replaced, -1 keeps them forever
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") != "0"
+# postgres statement_timeout in ms for every connection, 0 = no limit
+STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+
+
+def url_for(role):
+    if role == REPORTS and DATABASE_REPLICA_URL:
+        return DATABASE_REPLICA_URL
+    return DATABASE_URL
+
+
+def engine_options(url):
+    url = make_url(url)
+    options = {"pool_pre_ping": POOL_PRE_PING, "pool_recycle": POOL_RECYCLE}
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        # in memory sqlite doesn't use a QueuePool, nothing to size
+        return options
+    options.update(pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW, pool_timeout=POOL_TIMEOUT)
+    if url.get_backend_name() == "postgresql" and STATEMENT_TIMEOUT_MS:
+        options["connect_args"] = {"options": f"-c statement_timeout={STATEMENT_TIMEOUT_MS}"}
+    return options
+
+
+class EngineRegistry:
+    # one engine per distinct url for the whole process (the primary and reports roles share
+    # it when there is no replica), instead of every module creating its own pool
+    def __init__(self):
+        self._engines = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def engine(self, role=PRIMARY):
+        url = url_for(role)
+        with self._lock:
+            if url not in self._engines:
+                self._engines[url] = create_engine(url, **engine_options(url))
+                logger.info(f"engine for {role}: {make_url(url).render_as_string(hide_password=True)}")
+            return self._engines[url]
+
+    def sessionmaker(self, role=PRIMARY):
+        engine = self.engine(role)
+        with self._lock:
+            if engine not in self._sessions:
+                self._sessions[engine] = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+            return self._sessions[engine]
+
+    def dispose(self, close=True):
+        # close=False in a forked child: drop the inherited pools without touching the
+        # parent's connections
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose(close=close)
+
+
+registry = EngineRegistry()
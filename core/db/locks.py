@@ -0,0 +1,31 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock key every loader takes: one upload or bulk load at a time per database,
+# whichever process or server runs it (they share the staging tables and the rollup)
+LOAD_LOCK_KEY = 0x73746f7265
+# sqlite has one writer per file anyway, loads only need to be kept apart within the process
+_PROCESS_LOAD = threading.RLock()
+
+
+@contextmanager
+def load_lock(engine):
+    # held for the whole load on a connection of its own, outside any transaction so it
+    # doesn't pin a snapshot while the load runs
+    if engine.dialect.name != "postgresql":
+        with _PROCESS_LOAD:
+            yield
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if not conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": LOAD_LOCK_KEY}).scalar():
+            logger.info("another load is running against this database, waiting for it")
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": LOAD_LOCK_KEY})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": LOAD_LOCK_KEY})
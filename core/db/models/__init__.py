@@ -1,9 +1,11 @@
 from .store_status import StoreStatus
 from .store_business_hours import StoreBusinessHours
 from .store_timezone import StoreTimezone
+from .store_status_hourly import StoreStatusHourly
 
 __all__ = [
     "StoreStatus",
     "StoreBusinessHours", 
-    "StoreTimezone"
+    "StoreTimezone",
+    "StoreStatusHourly"
 ]
\ No newline at end of file
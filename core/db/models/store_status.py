@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, TIMESTAMP, PrimaryKeyConstraint
+from sqlalchemy import Column, Integer, String, TIMESTAMP, PrimaryKeyConstraint, Index
 from ..database import Base
 
 class StoreStatus(Base):
@@ -9,4 +9,8 @@ class StoreStatus(Base):
     timestamp_utc = Column(TIMESTAMP(timezone=True), nullable=False)  # always UTC
     status = Column(String(10), nullable=False)  
     #again no single column alone is unique, but their combination is, so.....
-    __table_args__ = (PrimaryKeyConstraint("store_id", "timestamp_utc"),)
+    __table_args__ = (
+        PrimaryKeyConstraint("store_id", "timestamp_utc"),
+        # max(timestamp_utc) for current_time() and the global range filters of the bulk engines
+        Index("ix_store_status_timestamp_utc", "timestamp_utc"),
+    )
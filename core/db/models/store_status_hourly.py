@@ -0,0 +1,25 @@
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, PrimaryKeyConstraint, Index
+from ..database import Base
+
+class StoreStatusHourly(Base):
+
+    # rollup of store_status per store and local hour, only hours with an observation inside
+    # business hours get a row. rebuilt by DataLoader after every load (see services/rollup.py)
+    __tablename__ = "store_status_hourly"
+
+    store_id = Column(String, nullable=False)
+    hour_local = Column(DateTime, nullable=False)  # wall clock start of the hour, store timezone
+    observations = Column(Integer, nullable=False)  # business observations in the hour
+    first_local = Column(DateTime, nullable=False)  # wall clock time of the first one
+    first_status = Column(String(10), nullable=False)
+    # business microseconds from the first observation to the end of the hour, each observation
+    # holding its status until the next one
+    active_us = Column(BigInteger, nullable=False)
+    inactive_us = Column(BigInteger, nullable=False)
+    # status of the last observation, carried into the next hour
+    last_status = Column(String(10), nullable=False)
+    __table_args__ = (
+        PrimaryKeyConstraint("store_id", "hour_local"),
+        # a report reads one range of hours for every store
+        Index("ix_store_status_hourly_hour_local", "hour_local"),
+    )
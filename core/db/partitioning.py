@@ -0,0 +1,166 @@
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from ..services.observations import as_utc
+
+logger = logging.getLogger(__name__)
+
+# STORE_STATUS_PARTITION=day|week range partitions store_status on timestamp_utc (postgres only),
+# unset keeps it a plain table
+PARTITION_INTERVAL = os.getenv("STORE_STATUS_PARTITION", "").lower()
+INTERVALS = {"day": timedelta(days=1), "week": timedelta(weeks=1)}
+
+TABLE = "store_status"
+# indexes store_status used to have, dropped from existing tables. the (store_id, timestamp_utc,
+# status) one repeated the primary key's prefix and doubled the index writes of every load, the
+# primary key covers status instead
+RETIRED_INDEXES = ("ix_store_status_store_time_status",)
+# columns a postgres primary key carries besides its keys (INCLUDE): the per store reads of
+# store_status stay index only scans. sqlite keeps the plain key
+PRIMARY_KEY_INCLUDE = {TABLE: ("status",)}
+
+
+def partitioning_enabled(bind):
+    return bind.dialect.name == "postgresql" and PARTITION_INTERVAL in INTERVALS
+
+
+def _store_status_table():
+    from .models.store_status import StoreStatus
+    return StoreStatus.__table__
+
+
+def partition_ranges(start, end, interval=None, table=TABLE):
+    # (name, from, to) of every partition touching [start, end], weeks start on monday
+    interval = interval or PARTITION_INTERVAL
+    start, end = as_utc(start), as_utc(end)
+    lower = datetime(start.year, start.month, start.day, tzinfo=timezone.utc)
+    if interval == "week":
+        lower -= timedelta(days=lower.weekday())
+    ranges = []
+    while lower <= end:
+        upper = lower + INTERVALS[interval]
+        ranges.append((f"{table}_p{lower:%Y%m%d}", lower, upper))
+        lower = upper
+    return ranges
+
+
+def is_partitioned(conn):
+    relkind = conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"), {"name": TABLE}).scalar()
+    return relkind == "p"
+
+
+def existing_partitions(conn, table=TABLE):
+    rows = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(:name)"), {"name": table})
+    return {row[0] for row in rows}
+
+
+def primary_key(table):
+    # PRIMARY KEY clause of the table's postgres key, included columns and all
+    keys = ", ".join(column.name for column in table.primary_key.columns)
+    include = PRIMARY_KEY_INCLUDE.get(table.name)
+    return f"PRIMARY KEY ({keys})" + (f" INCLUDE ({', '.join(include)})" if include else "")
+
+
+def _cover_primary_key(conn, table):
+    # create_all (and older tables) built the plain key, it is rebuilt with the included columns
+    if table.name not in PRIMARY_KEY_INCLUDE:
+        return
+    row = conn.execute(text(
+        "SELECT c.conname, i.indnatts > i.indnkeyatts FROM pg_constraint c JOIN pg_index i ON i.indexrelid = c.conindid "
+        "WHERE c.conrelid = to_regclass(:name) AND c.contype = 'p'"), {"name": table.name}).first()
+    if row is None or row[1]:
+        return
+    conn.execute(text(f"ALTER TABLE {table.name} DROP CONSTRAINT {row[0]}, ADD CONSTRAINT {row[0]} {primary_key(table)}"))
+    logger.info(f"{table.name} primary key rebuilt to include {', '.join(PRIMARY_KEY_INCLUDE[table.name])}")
+
+
+def _create_partitioned_table(conn):
+    ddl = str(CreateTable(_store_status_table()).compile(dialect=conn.dialect)).rstrip()
+    conn.execute(text(f"{ddl} PARTITION BY RANGE (timestamp_utc)"))
+    # still empty, the key is cheap to rebuild here
+    _cover_primary_key(conn, _store_status_table())
+    # catches rows written by something that didn't call ensure_partitions first
+    conn.execute(text(f"CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT"))
+
+
+def ensure_partitions(conn, start, end, table=TABLE):
+    # writers call this with the time range they are about to insert, before inserting it
+    # (table: a staging copy of store_status gets its own partitions)
+    if not partitioning_enabled(conn) or start is None or end is None:
+        return 0
+    existing = existing_partitions(conn, table)
+    created = 0
+    for name, lower, upper in partition_ranges(start, end, table=table):
+        if name in existing:
+            continue
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{lower.isoformat()}') TO ('{upper.isoformat()}')"))
+        created += 1
+    if created:
+        logger.info(f"created {created} {PARTITION_INTERVAL} partitions of {table}")
+    return created
+
+
+def ensure_indexes(conn):
+    # create_all only builds indexes together with a new table, this adds them to existing ones
+    for index in _store_status_table().indexes:
+        conn.execute(CreateIndex(index, if_not_exists=True))
+    for name in RETIRED_INDEXES:
+        conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    if conn.dialect.name == "postgresql":
+        _cover_primary_key(conn, _store_status_table())
+
+
+def prepare_store_status(engine):
+    # runs before create_all: a new store_status is created partitioned when asked for
+    with engine.begin() as conn:
+        if not partitioning_enabled(conn):
+            return
+        if not inspect(conn).has_table(TABLE):
+            _create_partitioned_table(conn)
+            logger.info(f"{TABLE} created, partitioned by {PARTITION_INTERVAL}")
+        elif not is_partitioned(conn):
+            logger.warning(f"STORE_STATUS_PARTITION={PARTITION_INTERVAL} but {TABLE} is a plain table, "
+                           f"run `python -m core.db.partitioning` to convert it")
+
+
+def migrate_store_status(engine):
+    # converts an existing plain store_status into a partitioned one, in one transaction:
+    # rename the old table, create the partitioned one, copy rows over, drop the old one
+    with engine.begin() as conn:
+        if partitioning_enabled(conn) and not is_partitioned(conn):
+            conn.execute(text(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE"))
+            old = f"{TABLE}_unpartitioned"
+            for index in _store_status_table().indexes:
+                conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+            pkey = conn.execute(text(
+                "SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(:name) AND contype = 'p'"),
+                {"name": TABLE}).scalar()
+            conn.execute(text(f"ALTER TABLE {TABLE} RENAME TO {old}"))
+            if pkey:
+                conn.execute(text(f"ALTER TABLE {old} RENAME CONSTRAINT {pkey} TO {old}_pkey"))
+
+            _create_partitioned_table(conn)
+            start, end = conn.execute(text(f"SELECT min(timestamp_utc), max(timestamp_utc) FROM {old}")).one()
+            ensure_partitions(conn, start, end)
+            moved = conn.execute(text(
+                f"INSERT INTO {TABLE} (store_id, timestamp_utc, status) "
+                f"SELECT store_id, timestamp_utc, status FROM {old}")).rowcount
+            conn.execute(text(f"DROP TABLE {old}"))
+            logger.info(f"{TABLE} partitioned by {PARTITION_INTERVAL}, {moved} rows moved")
+
+        ensure_indexes(conn)
+    with engine.begin() as conn:
+        conn.execute(text(f"ANALYZE {TABLE}"))
+
+
+if __name__ == "__main__":
+    from .database import engine
+    migrate_store_status(engine)
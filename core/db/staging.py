@@ -0,0 +1,141 @@
+import logging
+import os
+import time
+
+from sqlalchemy import Column, Index, MetaData, Table, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from .partitioning import TABLE as PARTITIONED_TABLE, existing_partitions, is_partitioned, partitioning_enabled, primary_key
+
+logger = logging.getLogger(__name__)
+
+# a bulk load fills <table>_staging copies next to the live tables and swaps them in at the end
+SUFFIX = "_staging"
+# the swap needs an exclusive lock on every live table: it waits this long for readers to let
+# go, gives up (so new readers never queue behind it for longer) and tries again
+SWAP_LOCK_TIMEOUT_MS = int(os.getenv("SWAP_LOCK_TIMEOUT_MS", "1000"))
+SWAP_ATTEMPTS = int(os.getenv("SWAP_ATTEMPTS", "20"))
+# after that a long report is still reading the old tables: the swap queues for them and waits
+# until that report is done, at most this long (0 = however long it runs)
+SWAP_WAIT_MS = int(os.getenv("SWAP_WAIT_MS", "0"))
+# postgres lock_not_available
+LOCK_NOT_AVAILABLE = "55P03"
+
+
+def staging_name(table):
+    return f"{table.name}{SUFFIX}"
+
+
+def staging_table(table):
+    # the staging copy's columns, for inserts into it and selects from it
+    return Table(staging_name(table), MetaData(),
+                 *[Column(column.name, column.type, nullable=column.nullable) for column in table.columns])
+
+
+def staging_partitioned(conn, table):
+    # the staging copy of store_status is partitioned the same way the live one is
+    return table.name == PARTITIONED_TABLE and partitioning_enabled(conn) and is_partitioned(conn)
+
+
+def create_staging(conn, table):
+    # empty copy of the table, whatever a failed load left behind is dropped first
+    name = staging_name(table)
+    conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+    if conn.dialect.name != "postgresql":
+        # sqlite can't add a primary key to an existing table, it comes with the table
+        conn.execute(CreateTable(table.to_metadata(MetaData(), name=name)))
+        return
+    # columns and defaults only, the keys and indexes are built after the load
+    ddl = f"CREATE TABLE {name} (LIKE {table.name} INCLUDING DEFAULTS)"
+    if staging_partitioned(conn, table):
+        conn.execute(text(f"{ddl} PARTITION BY RANGE (timestamp_utc)"))
+        conn.execute(text(f"CREATE TABLE {name}_default PARTITION OF {name} DEFAULT"))
+    else:
+        conn.execute(text(ddl))
+
+
+def index_staging(conn, table):
+    # primary key and indexes of the live table, built in one pass each once the rows are in.
+    # on postgres they carry the suffix until the swap; sqlite has no ALTER INDEX ... RENAME,
+    # its secondary indexes are built by the swap under their real names
+    name = staging_name(table)
+    if conn.dialect.name == "postgresql":
+        conn.execute(text(f"ALTER TABLE {name} ADD CONSTRAINT {name}_pkey {primary_key(table)}"))
+        staging = staging_table(table)
+        for index in table.indexes:
+            conn.execute(CreateIndex(Index(f"{index.name}{SUFFIX}", *[staging.c[column.name] for column in index.columns],
+                                           unique=index.unique)))
+    conn.execute(text(f"ANALYZE {name}"))
+
+
+def drop_staging(conn, table):
+    conn.execute(text(f"DROP TABLE IF EXISTS {staging_name(table)}"))
+
+
+def _swap(conn, table):
+    name = staging_name(table)
+    conn.execute(text(f"DROP TABLE IF EXISTS {table.name}"))
+    conn.execute(text(f"ALTER TABLE {name} RENAME TO {table.name}"))
+    if conn.dialect.name != "postgresql":
+        for index in table.indexes:
+            conn.execute(CreateIndex(index))
+        return
+    conn.execute(text(f"ALTER TABLE {table.name} RENAME CONSTRAINT {name}_pkey TO {table.name}_pkey"))
+    for index in table.indexes:
+        conn.execute(text(f"ALTER INDEX {index.name}{SUFFIX} RENAME TO {index.name}"))
+    # the old partitions went with the old table, the staged ones take their names
+    for partition in existing_partitions(conn, table.name):
+        if partition.startswith(name):
+            conn.execute(text(f"ALTER TABLE {partition} RENAME TO {table.name}{partition[len(name):]}"))
+
+
+def _lock_timeout(error):
+    # the readers held on to their locks past the timeout (sqlite: its busy timeout)
+    return getattr(error.orig, "pgcode", None) == LOCK_NOT_AVAILABLE or "database is locked" in str(error.orig)
+
+
+def _begin_swap(conn, final):
+    if conn.dialect.name != "postgresql":
+        # pysqlite only opens a transaction before dml, the ddl below needs one too. there is
+        # no lock queue to wait in, every attempt waits out the busy timeout
+        conn.exec_driver_sql("BEGIN")
+        return
+    if final:
+        # queue for the locks until the readers are done, DB_STATEMENT_TIMEOUT_MS would
+        # otherwise cut the wait short
+        conn.execute(text(f"SET LOCAL lock_timeout = {SWAP_WAIT_MS}"))
+        conn.execute(text(f"SET LOCAL statement_timeout = {SWAP_WAIT_MS}"))
+    else:
+        conn.execute(text(f"SET LOCAL lock_timeout = {SWAP_LOCK_TIMEOUT_MS}"))
+
+
+def swap_in(engine, tables):
+    # every staged table replaces its live one in a single transaction: a reader sees either
+    # all the old tables or all the new ones, never an empty or half loaded one.
+    # SWAP_ATTEMPTS short tries first, then it waits for the readers still on the old tables
+    # (a long report) instead of failing the load; reports started meanwhile queue behind it
+    attempt = 0
+    waiting_since = None
+    while True:
+        attempt += 1
+        final = attempt > SWAP_ATTEMPTS
+        if final and waiting_since is None:
+            waiting_since = time.monotonic()
+            logger.warning(f"swap blocked by readers {SWAP_ATTEMPTS} times, waiting for them to finish"
+                           + (f" (at most {SWAP_WAIT_MS}ms)" if SWAP_WAIT_MS else ""))
+        try:
+            with engine.begin() as conn:
+                _begin_swap(conn, final)
+                for table in tables:
+                    _swap(conn, table)
+            return attempt
+        except OperationalError as e:
+            if not _lock_timeout(e):
+                raise
+            if final and (engine.dialect.name == "postgresql"
+                          or SWAP_WAIT_MS and (time.monotonic() - waiting_since) * 1000 >= SWAP_WAIT_MS):
+                raise
+            if not final:
+                logger.warning(f"swap waited {SWAP_LOCK_TIMEOUT_MS}ms for readers (attempt {attempt}), retrying")
+            time.sleep(min(0.1 * attempt, 1.0))
@@ -1,120 +1,88 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
-from fastapi.responses import StreamingResponse, PlainTextResponse  
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, FileResponse, Response
 from sqlalchemy.orm import Session
-from typing import List, Optional, Dict
-import io
+from typing import Optional
 import tempfile
 import os
 import uuid
-import csv
-from datetime import datetime, timezone
-from enum import Enum
 import logging
 from ..db.database import get_db
-from ..db.models.store_status import StoreStatus
-from ..services.create_report import TimeHandler
-from ..services.data_loader import DataLoader
+from ..services.data_loader import DataLoader, LoadMode
+from ..services.report_runner import ReportEngine, current_time
+from ..services.report_jobs import ReportStatus, reports_storage, report_jobs
+from ..services.report_formats import ReportFormat, MEDIA_TYPES, FormatUnavailable, check_available, negotiate_encoding
+from ..services.report_metrics import metrics_exposition, CONTENT_TYPE
+from ..services.windows import DEFAULT_WINDOWS, parse_windows
+from ..services.incremental import MAX_WINDOW as INCREMENTAL_MAX_WINDOW
+from ..services import sql_engine
+from ..services.create_report import engine as reports_engine, SessionLocal as ReportsSession
 
 router = APIRouter()
 
 logger = logging.getLogger(__name__)
 
-# can use redis here
-class ReportStatus(Enum):
-    RUNNING = "Running"
-    COMPLETE = "Complete"
-    ERROR = "Error"
+# uploads are copied to disk a chunk at a time, never held in memory whole
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
-# Global storage for reports
-reports_storage: Dict[str, Dict] = {}
 
-def current_time(db):    
-    result = db.query(StoreStatus.timestamp_utc).order_by( StoreStatus.timestamp_utc.desc()).first()
-    
-    if result and result[0]:
-        timestamp = result[0]
-        if timestamp.tzinfo is None:
-            timestamp = timestamp.replace(tzinfo=timezone.utc)
-        return timestamp
-    else:
-        return datetime.now(timezone.utc)
+async def _save_upload(file: UploadFile):
+    # the request body is awaited, the disk writes run on a worker thread
+    temp_file = await run_in_threadpool(tempfile.NamedTemporaryFile, delete=False, suffix='.csv')
+    try:
+        with temp_file:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await run_in_threadpool(temp_file.write, chunk)
+    except Exception:
+        os.unlink(temp_file.name)
+        raise
+    return temp_file.name
 
-def generate_csv(report_data):
-    
-    output = io.StringIO()
-    
-    fieldnames = ['store_id','uptime_last_hour','uptime_last_day','uptime_last_week',
-    'downtime_last_hour','downtime_last_day','downtime_last_week']
-    
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    writer.writeheader()
-    
-    for row in report_data:
-        writer.writerow(row)    
-    return output.getvalue()
+
+def _latest_observation():
+    # reports database (the replica when configured), same as the report job reads
+    db = ReportsSession()
+    try:
+        return current_time(db)
+    finally:
+        db.close()
 
 @router.post("/trigger_report")
-async def trigger_report(db: Session = Depends(get_db)):
+async def trigger_report(
+    engine: ReportEngine = ReportEngine.PER_STORE,
+    parallel: bool = False,
+    workers: Optional[int] = None,
+    format: ReportFormat = ReportFormat.CSV,
+    windows: Optional[str] = None
+):
     
+    try:
+        check_available(format)
+    except FormatUnavailable as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # windows=15m,1h,6h,1d,7d,30d: trailing windows instead of hour / day / week
+    try:
+        report_windows = parse_windows(windows) if windows else DEFAULT_WINDOWS
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if engine == ReportEngine.INCREMENTAL and report_windows[-1].length > INCREMENTAL_MAX_WINDOW:
+        raise HTTPException(status_code=400, detail=f"engine=incremental supports windows up to {INCREMENTAL_MAX_WINDOW.days} days")
+    if engine == ReportEngine.SQL and not sql_engine.available(reports_engine):
+        raise HTTPException(status_code=400, detail=f"engine=sql needs a {sql_engine.DIALECT} database")
+
     try:    
         report_id = str(uuid.uuid4())
         logger.info(f"Report ID: {report_id}")
         
-        reports_storage[report_id] = {
-            "status": ReportStatus.RUNNING,
-            "created_at": datetime.utcnow(),
-            "csv_data": None,
-            "error": None
-        }
-
-        reference_time = current_time(db)
-        store_ids = [row[0] for row in db.query(StoreStatus.store_id).distinct().all()]
-        
-        try:
-            time_handler = TimeHandler(db)
-            report_data = []            
-            for store_id in store_ids:
-                try:
-                    metrics = time_handler.calculate_store_metrics(store_id, reference_time)
+        # the report is pinned to the latest observation at trigger time, read on a worker
+        # thread so the event loop isn't blocked
+        reference_time = await run_in_threadpool(_latest_observation)
 
-                    report_row = {
-                        "store_id": store_id,
-                        "uptime_last_hour": round(metrics.get('uptime_last_hour', 0.0), 2),
-                        "uptime_last_day": round(metrics.get('uptime_last_day', 0.0), 2),
-                        "uptime_last_week": round(metrics.get('uptime_last_week', 0.0), 2),
-                        "downtime_last_hour": round(metrics.get('downtime_last_hour', 0.0), 2),
-                        "downtime_last_day": round(metrics.get('downtime_last_day', 0.0), 2),
-                        "downtime_last_week": round(metrics.get('downtime_last_week', 0.0), 2)
-                    }
-                    report_data.append(report_row)
-                    
-                except Exception as e:
-                    report_row = {
-                        "store_id": store_id,
-                        "uptime_last_hour": 0.0,
-                        "uptime_last_day": 0.0,
-                        "uptime_last_week": 0.0,
-                        "downtime_last_hour": 0.0,
-                        "downtime_last_day": 0.0,
-                        "downtime_last_week": 0.0
-                    }
-                    report_data.append(report_row)
-                    print(f"Error calculating metrics for store {store_id}: {str(e)}")
-            
-            # Generate CSV
-            csv_data = generate_csv(report_data)
-            
-            # Update report status to complete
-            reports_storage[report_id]["status"] = ReportStatus.COMPLETE
-            reports_storage[report_id]["csv_data"] = csv_data
-            reports_storage[report_id]["completed_at"] = datetime.utcnow()
-            reports_storage[report_id]["total_stores"] = len(report_data)
-            
-        except Exception as e:
-            # Update report status to error
-            reports_storage[report_id]["status"] = ReportStatus.ERROR
-            reports_storage[report_id]["error"] = str(e)
-            print(f"Error generating report {report_id}: {str(e)}")
+        # runs in the background, poll get_report for progress.
+        # parallel=true shards the stores over a process pool (workers defaults to REPORT_PROCESSES / cpu count)
+        # format=parquet|arrow writes the report columnar straight away
+        report_jobs.submit(report_id, engine, parallel=parallel, workers=workers, format=format, reference_time=reference_time, windows=report_windows)
         
         return {"report_id": report_id}
         
@@ -122,52 +90,105 @@ async def trigger_report(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Failed to trigger report: {str(e)}")
 
 @router.get("/get_report")
-async def get_report(report_id: str):
+async def get_report(report_id: str, request: Request, format: Optional[ReportFormat] = None):
     try:
-        if report_id not in reports_storage:
+        # one locked lookup, eviction can't drop the report between a check and the read
+        report = reports_storage.get(report_id)
+        if report is None:
             raise HTTPException(status_code=404, detail="Report not found")
         
-        report = reports_storage[report_id]
-        
-        print(f"Report {report_id} current status: {report['status'].value}")
+        logger.debug(f"Report {report_id} current status: {report['status'].value}")
         
         if report["status"] == ReportStatus.COMPLETE:
-            csv_data = report["csv_data"]
-            
-            print(f"Report {report_id} response: CSV file download")
-            return StreamingResponse(
-                io.StringIO(csv_data),
-                media_type="text/csv",
-                headers={"Content-Disposition": f"attachment; filename=store_report_{report_id}.csv"}
+            # format defaults to the one the report was written in
+            format = format or ReportFormat(report["format"])
+            served, headers = format, {"Vary": "Accept-Encoding"}
+            if format == ReportFormat.CSV:
+                encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+                if encoding:
+                    served = ReportFormat.CSV_ZSTD if encoding == "zstd" else ReportFormat.CSV_GZIP
+                    headers["Content-Encoding"] = encoding
+            try:
+                # other formats are converted once and cached next to the report
+                path = await run_in_threadpool(report_jobs.export, report_id, report, served)
+            except FormatUnavailable as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+            logger.debug(f"Report {report_id} response: {served.value} file download")
+            # streamed from disk in chunks, the report is never loaded into memory
+            return FileResponse(
+                path,
+                media_type=MEDIA_TYPES[format],
+                filename=f"store_report_{report_id}.{format.value}",
+                headers=headers
             )       
+        elif report["status"] == ReportStatus.ERROR:
+            return {"status": ReportStatus.ERROR.value, "error": report["error"]}
         else:            
-            return {"status": "Running"}
+            return {"status": ReportStatus.RUNNING.value, **report_jobs.progress(report)}
             
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get report: {str(e)}")
 
+@router.post("/load_data")
+async def load_data(
+    store_status: UploadFile = File(...),
+    business_hours: UploadFile = File(...),
+    timezones: UploadFile = File(...),
+    db: Session = Depends(get_db)
+):
+
+    for file in (store_status, business_hours, timezones):
+        if not file.filename.endswith('.csv'):
+            raise HTTPException(status_code=400, detail=f"{file.filename} must be a CSV")
+
+    temp_file_paths = []
+    try:
+        for file in (store_status, business_hours, timezones):
+            temp_file_paths.append(await _save_upload(file))
+
+        loader = DataLoader(db)
+        # staged in parallel and swapped in together, reports never see a partial load
+        records_loaded = await run_in_threadpool(loader.load_all, *temp_file_paths)
+
+        return {
+            "message": "Data loaded successfully",
+            "records_loaded": records_loaded,
+            "seconds": loader.stats.get("seconds"),
+            "swap_seconds": loader.stats.get("swap_seconds")
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to load data: {str(e)}")
+    finally:
+        for path in temp_file_paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
 @router.post("/upload_store_status")
-async def upload_store_status(file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def upload_store_status(file: UploadFile = File(...), mode: LoadMode = LoadMode.REPLACE, db: Session = Depends(get_db)):
     
     if not file.filename.endswith('.csv'):
         raise HTTPException(status_code=400, detail="File must be a valid CSV")
     
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.csv') as temp_file:
-            content = await file.read()
-            temp_file.write(content)
-            temp_file_path = temp_file.name
+        temp_file_path = await _save_upload(file)
 
         loader = DataLoader(db)
-        records_loaded = loader.load_store_status(temp_file_path)
+        # parsing and writing are blocking, keep them off the event loop
+        records_loaded = await run_in_threadpool(loader.load_store_status, temp_file_path, mode=mode)
 
         os.unlink(temp_file_path)        
         return {
             "message": "Store status data uploaded successfully",
             "filename": file.filename,
-            "records_loaded": records_loaded
+            "records_loaded": records_loaded,
+            "mode": mode.value,
+            "rows_per_sec": loader.stats.get("rows_per_sec")
         }
         
     except Exception as e:        
@@ -179,25 +200,25 @@ async def upload_store_status(file: UploadFile = File(...), db: Session = Depend
         raise HTTPException(status_code=500, detail=f"Failed to upload store status: {str(e)}")
 
 @router.post("/upload_business_hours")
-async def upload_business_hours(file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def upload_business_hours(file: UploadFile = File(...), mode: LoadMode = LoadMode.REPLACE, db: Session = Depends(get_db)):
     
     if not file.filename.endswith('.csv'):
         raise HTTPException(status_code=400, detail="File must be a CSV")
     
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.csv') as temp_file:
-            content = await file.read()
-            temp_file.write(content)
-            temp_file_path = temp_file.name
+        temp_file_path = await _save_upload(file)
         
         loader = DataLoader(db)
-        records_loaded = loader.load_business_hours(temp_file_path)
+        # parsing and writing are blocking, keep them off the event loop
+        records_loaded = await run_in_threadpool(loader.load_business_hours, temp_file_path, mode=mode)
         
         os.unlink(temp_file_path)        
         return {
             "message": "Business hours data uploaded successfully",
             "filename": file.filename,
-            "records_loaded": records_loaded
+            "records_loaded": records_loaded,
+            "mode": mode.value,
+            "rows_per_sec": loader.stats.get("rows_per_sec")
         }
         
     except Exception as e:
@@ -209,25 +230,25 @@ async def upload_business_hours(file: UploadFile = File(...), db: Session = Depe
         raise HTTPException(status_code=500, detail=f"Failed to upload business hours: {str(e)}")
 
 @router.post("/upload_timezones")
-async def upload_timezones(file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def upload_timezones(file: UploadFile = File(...), mode: LoadMode = LoadMode.REPLACE, db: Session = Depends(get_db)):
     
     if not file.filename.endswith('.csv'):
         raise HTTPException(status_code=400, detail="File must be a CSV")
     
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.csv') as temp_file:
-            content = await file.read()
-            temp_file.write(content)
-            temp_file_path = temp_file.name
+        temp_file_path = await _save_upload(file)
         
         loader = DataLoader(db)
-        records_loaded = loader.load_timezones(temp_file_path)
+        # parsing and writing are blocking, keep them off the event loop
+        records_loaded = await run_in_threadpool(loader.load_timezones, temp_file_path, mode=mode)
         
         os.unlink(temp_file_path)        
         return {
             "message": "Timezones data uploaded successfully",
             "filename": file.filename,
-            "records_loaded": records_loaded
+            "records_loaded": records_loaded,
+            "mode": mode.value,
+            "rows_per_sec": loader.stats.get("rows_per_sec")
         }
         
     except Exception as e:
@@ -239,25 +260,11 @@ async def upload_timezones(file: UploadFile = File(...), db: Session = Depends(g
         raise HTTPException(status_code=500, detail=f"Failed to upload timezones: {str(e)}")
 
 @router.get("/metrics", response_class=PlainTextResponse)
-async def metrics_endpoint():
-    lines = []
-
-    for report_id, report in reports_storage.items():
-        if report["status"] != ReportStatus.COMPLETE:
-            continue
-
-        import csv
-        from io import StringIO
-        csv_reader = csv.DictReader(StringIO(report["csv_data"]))
-        for row in csv_reader:
-            store_id = row["store_id"]
-            
-            lines.append(f'store_uptime_hours{{store_id="{store_id}",period="last_hour"}} {row["uptime_last_hour"]}')
-            lines.append(f'store_uptime_hours{{store_id="{store_id}",period="last_day"}} {row["uptime_last_day"]}')
-            lines.append(f'store_uptime_hours{{store_id="{store_id}",period="last_week"}} {row["uptime_last_week"]}' )
-            
-            lines.append(f'store_downtime_hours{{store_id="{store_id}",period="last_hour"}} {row["downtime_last_hour"]}')
-            lines.append(f'store_downtime_hours{{store_id="{store_id}",period="last_day"}} {row["downtime_last_day"]}')
-            lines.append(f'store_downtime_hours{{store_id="{store_id}",period="last_week"}} {row["downtime_last_week"]}')
-
-    return "\n".join(lines) + "\n"
\ No newline at end of file
+async def metrics_endpoint(request: Request):
+    # store gauges are rendered once per completed report, a scrape only appends the
+    # (small) stage / loader instrumentation to the cached bytes
+    gzipped = negotiate_encoding(request.headers.get("accept-encoding"), codings=("gzip",)) == "gzip"
+    headers = {"Vary": "Accept-Encoding"}
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+    return Response(metrics_exposition.body(gzipped), media_type=CONTENT_TYPE, headers=headers)
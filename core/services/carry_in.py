@@ -0,0 +1,63 @@
+import logging
+
+from sqlalchemy import select, func, and_, true
+
+from ..db.models.store_status import StoreStatus
+from .observations import StoreRow, as_utc
+
+logger = logging.getLogger(__name__)
+
+
+def _observed_stores(window_start, window_end, store_ids=None):
+    # only stores with an observation in the window can need a carry-in
+    stmt = select(StoreStatus.store_id).where(
+        StoreStatus.timestamp_utc >= window_start,
+        StoreStatus.timestamp_utc <= window_end
+    )
+    if store_ids is not None:
+        stmt = stmt.where(StoreStatus.store_id.in_(list(store_ids)))
+    return stmt.distinct()
+
+
+def _lateral_stmt(window_start, window_end, store_ids):
+    # postgres: one LIMIT 1 backward index probe per store instead of scanning all history
+    stores = _observed_stores(window_start, window_end, store_ids).subquery()
+    previous = select(StoreStatus.timestamp_utc, StoreStatus.status).where(
+        StoreStatus.store_id == stores.c.store_id,
+        StoreStatus.timestamp_utc < window_start
+    ).order_by(StoreStatus.timestamp_utc.desc()).limit(1).lateral()
+    return select(stores.c.store_id, previous.c.timestamp_utc, previous.c.status).select_from(
+        stores.join(previous, true())
+    )
+
+
+def _group_max_stmt(window_start, window_end, store_ids):
+    # portable: latest timestamp per store before the window, joined back for the status
+    latest = select(
+        StoreStatus.store_id,
+        func.max(StoreStatus.timestamp_utc).label("timestamp_utc")
+    ).where(
+        StoreStatus.timestamp_utc < window_start,
+        StoreStatus.store_id.in_(_observed_stores(window_start, window_end, store_ids))
+    ).group_by(StoreStatus.store_id).subquery()
+    return select(StoreStatus.store_id, StoreStatus.timestamp_utc, StoreStatus.status).join(
+        latest,
+        and_(StoreStatus.store_id == latest.c.store_id, StoreStatus.timestamp_utc == latest.c.timestamp_utc)
+    )
+
+
+def last_status_before(db, window_start, window_end, store_ids=None, stream=None):
+    # store_id -> last observation before window_start, in one query, for every store observed
+    # in [window_start, window_end] (optionally only store_ids). it's the status each store
+    # carries into the window, whatever window inside it is being computed
+    if db.bind.dialect.name == "postgresql":
+        stmt = _lateral_stmt(window_start, window_end, store_ids)
+    else:
+        stmt = _group_max_stmt(window_start, window_end, store_ids)
+    rows = stream(db, stmt) if stream else db.execute(stmt)
+
+    carry_in = {}
+    for store_id, timestamp_utc, status in rows:
+        carry_in[store_id] = StoreRow(as_utc(timestamp_utc), status)
+    logger.info(f"carry-in state for {len(carry_in)} stores before {window_start}")
+    return carry_in
@@ -1,118 +1,118 @@
 from __future__ import annotations
-import os
-import csv
-import math
 from dataclasses import dataclass
-from datetime import datetime, timedelta, time, timezone
-from typing import List, Optional, Tuple, Dict, Union
-from functools import lru_cache
+from datetime import datetime, time, timezone
+from bisect import bisect_left
+from array import array
 
+from sqlalchemy import select
 
-import pandas as pd
-from dateutil import parser
-from zoneinfo import ZoneInfo
-
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy.pool import QueuePool
-
-from ..db.models.store_timezone import StoreTimezone
-from ..db.models.store_business_hours import StoreBusinessHours
+from ..db.engines import registry, REPORTS
 from ..db.models.store_status import StoreStatus
+from .schedule import local_us, US_PER_MINUTE
+from .windows import DEFAULT_WINDOWS, empty_metrics, window_metrics
+from .carry_in import last_status_before
+from .observations import ObservationBuffer, STATUSES, from_epoch_us, is_active
+from .instrumentation import ReportTimings
 
-import os       
-
-DB_URL = os.getenv("DATABASE_URL")
+# report queries go to the read replica when DATABASE_REPLICA_URL is set, otherwise this
+# is the same pooled engine as core.db.database
+engine = registry.engine(REPORTS)
 
-engine = create_engine(
-    DB_URL, 
-    future=True,
-    poolclass=QueuePool,
-    pool_size=10,           # No of connections to maintain
-    max_overflow=20,        # when pool is full
-    pool_timeout=30,        
-)
+SessionLocal = registry.sessionmaker(REPORTS)
 
-SessionLocal = sessionmaker(bind=engine, future=True)   
-#connpoo
-
-@dataclass
+@dataclass(slots=True)
 class StatusObservation:
     utc_time: datetime
     local_time: datetime
     status: str
     day: int
 
-@dataclass
+@dataclass(slots=True)
 class BusinessHours:
     day: int
     start_time: time
     end_time: time
     crosses_midnight: bool = False
 
-@dataclass
+@dataclass(slots=True)
 class UptimeStats:
     uptime_minutes: float
     downtime_minutes: float
     total_business_minutes: float
 
 
+def to_business_hours(hours):
+    # hours -> StoreBusinessHours rows (or anything with the same attributes) of one store
+    if hours:
+        business_hours = []
+        for hour in hours:
+            crosses_midnight = hour.end_time_local < hour.start_time_local
+            business_hours.append(BusinessHours(
+                day=hour.day_of_week,
+                start_time=hour.start_time_local,
+                end_time=hour.end_time_local,
+                crosses_midnight=crosses_midnight
+            ))
+
+        # Fill missing days with 24/7 hours
+        existing_days = {i.day for i in business_hours}
+        for i in range(7):
+            if i not in existing_days:
+                business_hours.append(BusinessHours(
+                    day=i,
+                    start_time=time(0, 0),
+                    end_time=time(23, 59, 59),
+                    crosses_midnight=False
+                ))
+        return business_hours
+    else:
+        return [
+            BusinessHours(
+                day=i,
+                start_time=time(0, 0),
+                end_time=time(23, 59, 59),
+                crosses_midnight=False
+            ) for i in range(7)
+        ]
+
+
 class TimeHandler:        
-    def __init__(self, session):
+    def __init__(self, session, windows=DEFAULT_WINDOWS):
         self.db = session
-        # use redis for caching?
-        #use LRU fro local
-        # self.tz_cache = {}
-        # self.hours_cache = {}
+        # trailing windows of the report, shortest first
+        self.windows = windows
+        self._metadata = None
+        # (week_ago, reference) -> store_id -> last observation before week_ago, all stores at once
+        self._carry_in = {}
+        # (store_id, since, reference, ObservationBuffer) of the store being calculated,
+        # previous observations are looked up in it
+        self._week = None
+        # stage times, replaced by the report's own when run through report_runner
+        self.timings = ReportTimings()
     
-    @lru_cache(maxsize=1000)  
+    @property
+    def metadata(self):
+        # timezones / business hours come from the process wide cache (see metadata_cache),
+        # the handler sticks to the snapshot it first saw so a report stays consistent
+        if self._metadata is None:
+            from .metadata_cache import store_metadata
+            self._metadata = store_metadata.get(self.db)
+        return self._metadata
+
     def get_timezone(self, store_id):       
-        tz_row = self.db.query(StoreTimezone).filter(StoreTimezone.store_id == store_id).first()            
-        if tz_row:
-            return tz_row.timezone_str
-        else:
-            return "America/Chicago"
+        return self.metadata.timezone(store_id)
     
-    @lru_cache(maxsize=1000)
     def get_business_hours(self, store_id):
-        hours = self.db.query(StoreBusinessHours).filter(StoreBusinessHours.store_id == store_id).all()
-        
-        if hours:
-            business_hours = []
-            for hour in hours:
-                crosses_midnight = hour.end_time_local < hour.start_time_local
-                business_hours.append(BusinessHours(
-                    day=hour.day_of_week,
-                    start_time=hour.start_time_local,
-                    end_time=hour.end_time_local,
-                    crosses_midnight=crosses_midnight
-                ))
-
-            # Fill missing days with 24/7 hours
-            existing_days = {i.day for i in business_hours}
-            for i in range(7):
-                if i not in existing_days:
-                    business_hours.append(BusinessHours(
-                        day=i,
-                        start_time=time(0, 0),
-                        end_time=time(23, 59, 59),
-                        crosses_midnight=False
-                    ))
-            return business_hours
-        else:
-            return [
-                BusinessHours(
-                    day=i,
-                    start_time=time(0, 0),
-                    end_time=time(23, 59, 59),
-                    crosses_midnight=False
-                ) for i in range(7)
-            ]
+        return self.metadata.business_hours(store_id)
+    
+    def get_zone(self, store_id):
+        # interned, every local time of a timezone shares the same ZoneInfo
+        from .metadata_cache import store_metadata
+        return store_metadata.zone(self.get_timezone(store_id))
     
     def utc_to_local(self, utc_timestamp, store_id):
         
-        timezone_str = self.get_timezone(store_id)
-        local_tz = ZoneInfo(timezone_str)
+        local_tz = self.get_zone(store_id)
         
         if utc_timestamp.tzinfo is None:
             utc_timestamp = utc_timestamp.replace(tzinfo=timezone.utc)
@@ -137,198 +137,38 @@ class TimeHandler:
         hours = self.get_business_hours(store_id)
         return [h for h in hours if h.day == day_of_week]
     
-    def filter_by_business_hours(self, hours,store_id):
-        filtered = []
-        
-        for obs in hours:
-            day_hours = self.get_hours_for_day(store_id, obs.day)
-            
-            # check if this time falls within ANY business interval for the day
-            found_match = False
-            for interval in day_hours:
-                if self.is_within_business_hours(obs.local_time, interval):
-                    found_match = True
-                    break  
-            
-            if found_match:
-                filtered.append(obs)
-        
-        return filtered
+    def get_schedule(self, store_id):
+        # business hours compiled once per store, see schedule.WeeklySchedule
+        return self.metadata.schedule(store_id)
     
     def minutes(self, store_id, start_local,end_local):
-        
-        total_minutes = 0.0
-        current = start_local.replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        while current.date() <= end_local.date():
-            day_of_week = self.day_of_week(current)
-            day_business_hours = self.get_hours_for_day(store_id, day_of_week)
-            
-            for bh in day_business_hours:
-                day_start = current.replace(
-                    hour=bh.start_time.hour,
-                    minute=bh.start_time.minute,
-                    second=bh.start_time.second
-                )
-                
-                if bh.crosses_midnight:
-                    # Handle midnight crossing
-                    day_end = (current + timedelta(days=1)).replace(
-                        hour=bh.end_time.hour,
-                        minute=bh.end_time.minute,
-                        second=bh.end_time.second
-                    )
-                else:
-                    day_end = current.replace(
-                        hour=bh.end_time.hour,
-                        minute=bh.end_time.minute,
-                        second=bh.end_time.second
-                    )
-                
-                #period window
-                period_start = max(day_start, start_local)
-                period_end = min(day_end, end_local)
-                
-                if period_start < period_end:
-                    minutes = (period_end - period_start).total_seconds() / 60
-                    total_minutes += minutes
-            
-            current += timedelta(days=1)
-        
-        return total_minutes
+        # O(log k) lookup on the weekly schedule instead of walking every day in the range
+        return self.get_schedule(store_id).minutes(start_local, end_local)
     
-    def calc_uptime_downtime(self, observations, store_id, start_local, end_local):
-        
-        total_biz_mins = self.minutes(store_id, start_local, end_local)
-        
-        if total_biz_mins == 0:
-            return UptimeStats(
-                uptime_minutes=0.0,
-                downtime_minutes=0.0,
-                total_business_minutes=0.0
-            )
-        
-        if not observations:
-            # no data = assume everything is down
-            return UptimeStats(
-                uptime_minutes=0.0,
-                downtime_minutes=total_biz_mins,
-                total_business_minutes=total_biz_mins
-            )
-        
-        observations.sort(key=lambda x: x.local_time)
-        
-        # single observation case
-        if len(observations) == 1:
-            obs = observations[0]            
-            
-            prev_obs = self._get_previous_observation(store_id, obs.local_time)
-            #note here prev observation need not be in business hours , we purely just consider the prev obs            
-
-            if prev_obs:
-                if prev_obs.status == obs.status:
-                    if obs.status.lower() == 'active':
-                        return UptimeStats(
-                            uptime_minutes=total_biz_mins,
-                            downtime_minutes=0.0,
-                            total_business_minutes=total_biz_mins
-                        )
-                    else:
-                        return UptimeStats(
-                            uptime_minutes=0.0,
-                            downtime_minutes=total_biz_mins,
-                            total_business_minutes=total_biz_mins
-                        )
-                else:
-                    mins_before = self.minutes(store_id, start_local, obs.local_time)
-                    mins_after = total_biz_mins - mins_before
-                    
-                    if obs.status.lower() == 'active':
-                        return UptimeStats(
-                            uptime_minutes=mins_after,
-                            downtime_minutes=mins_before,
-                            total_business_minutes=total_biz_mins
-                        )
-                    else:
-                        return UptimeStats(
-                            uptime_minutes=mins_before,
-                            downtime_minutes=mins_after,
-                            total_business_minutes=total_biz_mins
-                        )
-            else:
-                # no previous context - assume entire period has the observed status
-                if obs.status.lower() == 'active':
-                    return UptimeStats(
-                        uptime_minutes=total_biz_mins,
-                        downtime_minutes=0.0,
-                        total_business_minutes=total_biz_mins
-                    )
-                else:
-                    return UptimeStats(
-                        uptime_minutes=0.0,
-                        downtime_minutes=total_biz_mins,
-                        total_business_minutes=total_biz_mins
-                    )
-        
-        uptime_minutes = 0.0
-        downtime_minutes = 0.0
-        intervals = []
-        
-        # Before first observation: assume state of first observation
-        first_obs = observations[0]
-        if start_local < first_obs.local_time:
-            intervals.append({
-                'start': start_local,
-                'end': first_obs.local_time,
-                'status': first_obs.status
-            })
-        
-        # Between observations - each observation defines status until next observation
-        for i in range(len(observations)):
-            current_obs = observations[i]
-            
-            # Determine when this observation's status starts
-            obs_start = max(start_local, current_obs.local_time)
-            
-            # Determine when this observation's status ends
-            if i < len(observations) - 1:
-                # Status lasts until next observation
-                obs_end = min(observations[i + 1].local_time, end_local)
-            else:
-                # Last observation: status lasts until end of period
-                obs_end = end_local
-            
-            # Only add interval if it has positive duration
-            if obs_start < obs_end:
-                intervals.append({
-                    'start': obs_start,
-                    'end': obs_end,
-                    'status': current_obs.status
-                })
-        
-        # Calculate uptime/downtime interval-wise
-        for interval in intervals:
-            interval_minutes = self.minutes(
-                store_id, interval['start'], interval['end']
-            )
-            
-            if interval['status'].lower() == 'active':
-                uptime_minutes += interval_minutes
-            else:
-                downtime_minutes += interval_minutes
-        
-        return UptimeStats(
-            uptime_minutes=uptime_minutes,
-            downtime_minutes=downtime_minutes,
-            total_business_minutes=total_biz_mins
-        )
+    def get_carry_in(self, week_ago, reference_time_utc):
+        # one batched query for every store instead of one per store and window
+        key = (week_ago, reference_time_utc)
+        if key not in self._carry_in:
+            self._carry_in = {key: last_status_before(self.db, week_ago, reference_time_utc)}
+        return self._carry_in[key]
     
     def _get_previous_observation(self, store_id, before_time):       
        
-        previous_observation = self.db.query(StoreStatus).filter(
-            StoreStatus.store_id == store_id,
-            StoreStatus.timestamp_utc < before_time.astimezone(timezone.utc)
-        ).order_by(StoreStatus.timestamp_utc.desc()).first()
+        before_utc = before_time.astimezone(timezone.utc)
+        week = self._week
+        if week and week[0] == store_id and week[1] <= before_utc <= week[2]:
+            # inside the week already in memory: the one before it, or the carry-in
+            _, week_ago, reference_time_utc, buffer = week
+            idx = buffer.before(before_utc)
+            if idx >= 0:
+                previous_observation = buffer.row(idx)
+            else:
+                previous_observation = self.get_carry_in(week_ago, reference_time_utc).get(store_id)
+        else:
+            previous_observation = self.db.query(StoreStatus).filter(
+                StoreStatus.store_id == store_id,
+                StoreStatus.timestamp_utc < before_utc
+            ).order_by(StoreStatus.timestamp_utc.desc()).first()
         
         if not previous_observation:
             return None
@@ -342,86 +182,125 @@ class TimeHandler:
             day=local_time.weekday()
         )
     
-    def process_store_observations(self, store_id, utc_timestamps, statuses):
-        obs = []
-        
-        for utc_ts, status in zip(utc_timestamps, statuses):
-            local_ts = self.utc_to_local(utc_ts, store_id)
-            day_of_week = self.day_of_week(local_ts)
-            
-            obs.append(StatusObservation(
-                utc_time=utc_ts,
-                local_time=local_ts,
-                status=status,
-                day=day_of_week
-            ))
-        
-        return obs
-    
-    def calculate_store_metrics(self, store_id, reference_time_utc):
-        
-        # Get store observations from database
-        hour_ago = reference_time_utc - timedelta(hours=1)
-        day_ago = reference_time_utc - timedelta(days=1)
-        week_ago = reference_time_utc - timedelta(weeks=1)
-        
-        # Query all observations for the store in the last week
-        week_observations = self.db.query(StoreStatus).filter(
+    def get_week_observations(self, store_id, week_ago, reference_time_utc):
+        # all observations of the store in the last week, straight into an ObservationBuffer
+        rows = self.db.execute(select(StoreStatus.timestamp_utc, StoreStatus.status).where(
             StoreStatus.store_id == store_id,
             StoreStatus.timestamp_utc >= week_ago,
             StoreStatus.timestamp_utc <= reference_time_utc
-        ).order_by(StoreStatus.timestamp_utc).all()
-        
-        if not week_observations:
-            return {
-                'uptime_last_hour': 0.0,
-                'uptime_last_day': 0.0,
-                'uptime_last_week': 0.0,
-                'downtime_last_hour': 0.0,
-                'downtime_last_day': 0.0,
-                'downtime_last_week': 0.0
-            }
-        
-        
-        observations = self.process_store_observations(
-            store_id,
-            [obs.timestamp_utc for obs in week_observations],
-            [obs.status for obs in week_observations]
-        )
-        
-        # Filter by business hours
-        business_observations = self.filter_by_business_hours(observations, store_id)
-        
-        # Convert reference time to local
-        reference_local = self.utc_to_local(reference_time_utc, store_id)
-        hour_ago_local = self.utc_to_local(hour_ago, store_id)
-        day_ago_local = self.utc_to_local(day_ago, store_id)
-        week_ago_local = self.utc_to_local(week_ago, store_id)
-        
-        # Calculate metrics for each period
-        hour_result = self.calc_uptime_downtime(
-            [obs for obs in business_observations if obs.local_time >= hour_ago_local],
-            store_id, hour_ago_local, reference_local
-        )
-        
-        day_result = self.calc_uptime_downtime(
-            [obs for obs in business_observations if obs.local_time >= day_ago_local],
-            store_id, day_ago_local, reference_local
-        )
-        
-        week_result = self.calc_uptime_downtime(
-            business_observations,
-            store_id, week_ago_local, reference_local
-        )
+        ).order_by(StoreStatus.timestamp_utc))
+        buffer = ObservationBuffer()
+        for timestamp_utc, status in rows:
+            buffer.append(timestamp_utc, status)
+        return buffer
+    
+    def sweep_uptime_downtime(self, buffer, business, local, store_id, starts, end):
+        # uptime / downtime for several windows ending at end, in one pass, on the buffer.
+        # local is the wall clock us of every observation, business the indexes of the ones in
+        # business hours in local time order, starts go from the shortest window to the longest
+        # (wall clock us too). the longest window takes every observation (like the week did),
+        # the others the ones at or after their start. the business time each observation holds
+        # until the next is summed from the end, so every window is a suffix lookup plus its
+        # leading stretch
+        before = self.get_schedule(store_id).business_us_before
+        flags = [is_active(code) for code in range(len(STATUSES))]
+        times = array('q', (local[i] for i in business))
+        active = [flags[buffer.codes[i]] for i in business]
+        n = len(business)
+
+        def held(i, start):
+            # business us observation i holds its status, from start at the earliest
+            seg_end = min(times[i + 1], end) if i < n - 1 else end
+            seg_start = max(start, times[i])
+            return before(seg_end) - before(seg_start) if seg_start < seg_end else 0
+
+        up_after = array('q', bytes(8 * (n + 1)))
+        down_after = array('q', bytes(8 * (n + 1)))
+        for i in range(n - 1, -1, -1):
+            seg = held(i, times[i])
+            up_after[i] = up_after[i + 1] + (seg if active[i] else 0)
+            down_after[i] = down_after[i + 1] + (0 if active[i] else seg)
+
+        results = []
+        previous = {}
+        longest = len(starts) - 1
+        for w, start in enumerate(starts):
+            total = before(end) - before(start) if start < end else 0
+            first = 0 if w == longest else bisect_left(times, start)
+
+            if total == 0:
+                up = down = 0
+            elif first == n:
+                # no data = assume everything is down
+                up, down = 0, total
+            elif first == n - 1:
+                # single observation: split at it when the previous one had another status
+                obs = business[first]
+                if first not in previous:
+                    previous[first] = self._get_previous_observation(store_id, from_epoch_us(buffer.utc_us[obs]))
+                prev_obs = previous[first]
+                if prev_obs and prev_obs.status != buffer.status(obs):
+                    mins_before = before(times[first]) - before(start) if start < times[first] else 0
+                    up, down = total - mins_before, mins_before
+                    if not active[first]:
+                        up, down = down, up
+                else:
+                    up, down = (total, 0) if active[first] else (0, total)
+            else:
+                # the stretch before the first observation takes its status
+                lead = before(times[first]) - before(start) if start < times[first] else 0
+                up, down = (lead, 0) if active[first] else (0, lead)
+                # observations before the start only happen in the longest window (around a
+                # dst change), they count from the start
+                i = first
+                while i < n and times[i] < start:
+                    seg = held(i, start)
+                    if active[i]:
+                        up += seg
+                    else:
+                        down += seg
+                    i += 1
+                up += up_after[i]
+                down += down_after[i]
+
+            results.append(UptimeStats(
+                uptime_minutes=up / US_PER_MINUTE,
+                downtime_minutes=down / US_PER_MINUTE,
+                total_business_minutes=total / US_PER_MINUTE
+            ))
+        return results
+
+    def calculate_store_metrics(self, store_id, reference_time_utc):
+        # every window ends at the reference time, the longest one decides how much
+        # history is read (a week for the default hour / day / week)
+        windows = self.windows
+        since = reference_time_utc - windows[-1].length
         
-        return {
-            'uptime_last_hour': hour_result.uptime_minutes,
-            'uptime_last_day': day_result.uptime_minutes / 60.0,  # Convert to hours
-            'uptime_last_week': week_result.uptime_minutes / 60.0,  # Convert to hours
-            'downtime_last_hour': hour_result.downtime_minutes,
-            'downtime_last_day': day_result.downtime_minutes / 60.0,  # Convert to hours
-            'downtime_last_week': week_result.downtime_minutes / 60.0  # Convert to hours
-        }
+        # Get store observations from database
+        with self.timings.stage("fetch"):
+            buffer = self.get_week_observations(store_id, since, reference_time_utc)
+        
+        if not buffer:
+            return empty_metrics(windows)
+        
+        with self.timings.stage("timezone"):
+            self._week = (store_id, since, reference_time_utc, buffer)
+            # wall clock us of every observation, the reference time and window starts
+            local = buffer.local_us(self.get_zone(store_id))
+            end = local_us(self.utc_to_local(reference_time_utc, store_id))
+            starts = [local_us(self.utc_to_local(reference_time_utc - w.length, store_id)) for w in windows]
+        
+        # Filter by business hours, indexes into the buffer in local time order
+        with self.timings.stage("business_hours"):
+            contains = self.get_schedule(store_id).contains_us
+            business = [i for i, t in enumerate(local) if contains(t)]
+            business.sort(key=local.__getitem__)
+        
+        # Calculate metrics for every window at once
+        with self.timings.stage("uptime"):
+            results = self.sweep_uptime_downtime(buffer, business, local, store_id, starts, end)
+        
+        return window_metrics(windows, [(r.uptime_minutes, r.downtime_minutes) for r in results])
 
 
 
@@ -1,28 +1,297 @@
 import pandas as pd
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy import insert, text
 from datetime import datetime, time
 import pytz
 from typing import Optional
+import io
 import logging
+import queue
+import threading
+import time as timer
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from functools import wraps
 
 from ..db.models.store_status import StoreStatus
 from ..db.models.store_business_hours import StoreBusinessHours
 from ..db.models.store_timezone import StoreTimezone
+from ..db.models.store_status_hourly import StoreStatusHourly
+from ..db.locks import load_lock
+from ..db.partitioning import ensure_partitions, partitioning_enabled
+from ..db.staging import create_staging, drop_staging, index_staging, staging_partitioned, staging_table, swap_in
+from .create_report import TimeHandler
+from .incremental import rolling_uptime
+from .instrumentation import instruments
+from .metadata_cache import store_metadata
+from .rollup import rebuild_rollup
 
 logger = logging.getLogger(__name__)
 
+# rows parsed per read_csv chunk, each chunk is written (one COPY call / a few orm batches)
+# before it's dropped, so memory stays flat whatever the file size
+CSV_CHUNK_ROWS = 100_000
+# parsed chunks allowed to wait for the db writer
+PARSE_AHEAD = 2
+
+_DONE = object()
+
+
+class LoadMode(str, Enum):
+    REPLACE = "replace"  # wipe the table and load the file (default)
+    APPEND = "append"    # insert rows whose key isn't there yet, keep existing ones (ON CONFLICT DO NOTHING)
+    MERGE = "merge"      # insert new keys and overwrite the other columns of existing ones (ON CONFLICT DO UPDATE)
+
+
+def _exclusive(load):
+    # every load takes the database's load lock (see core/db/locks.py) for as long as it runs
+    @wraps(load)
+    def locked(self, *args, **kwargs):
+        with load_lock(self.engine):
+            return load(self, *args, **kwargs)
+    return locked
+
+
+def _track_earliest(since, rows):
+    # store_id -> earliest timestamp_utc written, the rollup is rebuilt from there on
+    for row in rows:
+        earliest = since.get(row.store_id)
+        if earliest is None or row.timestamp_utc < earliest:
+            since[row.store_id] = row.timestamp_utc
+
+
+def _changed_stores(previous, current):
+    # stores whose timezone or business hours differ between two StoreMetadata snapshots
+    stores = set(previous.timezones) | set(current.timezones) | set(previous.hours) | set(current.hours)
+    return {store_id for store_id in stores
+            if previous.timezone(store_id) != current.timezone(store_id)
+            or sorted(previous.hours.get(store_id, [])) != sorted(current.hours.get(store_id, []))}
+
+
+def _prepare_store_status(chunk):
+    return pd.DataFrame({
+        'store_id': chunk['store_id'].astype(str),
+        'timestamp_utc': pd.to_datetime(chunk['timestamp_utc']),
+        'status': chunk['status']
+    })
+
+
+def _prepare_business_hours(chunk):
+    return pd.DataFrame({
+        'store_id': chunk['store_id'].astype(str),
+        'day_of_week': chunk['dayOfWeek'].astype(int),
+        # parsing validates the format, same as the old per row strptime
+        'start_time_local': pd.to_datetime(chunk['start_time_local'], format='%H:%M:%S').dt.time,
+        'end_time_local': pd.to_datetime(chunk['end_time_local'], format='%H:%M:%S').dt.time
+    })
+
+
+def _prepare_timezones(chunk):
+    return pd.DataFrame({
+        'store_id': chunk['store_id'].astype(str),
+        'timezone_str': chunk['timezone_str']
+    })
+
+
 class DataLoader:
-    def __init__(self, db, batch_size: int = 5000):
+    def __init__(self, db, batch_size: int = 5000, use_copy: bool = True, chunk_rows: int = CSV_CHUNK_ROWS):
         self.db = db
         self.batch_size = batch_size  
         self.engine = db.bind 
+        # COPY only exists on postgres, everything else (sqlite in tests) takes the orm path
+        self.use_copy = use_copy and self.engine.dialect.name == "postgresql"
+        self.chunk_rows = chunk_rows
+        self.stats = {}
 
     def _log_progress(self, processed, total, batch_num):
 
-        percentage = (processed / total) * 100
-        logger.info(f"processed batch  {percentage}%")
+        if total:
+            percentage = (processed / total) * 100
+            logger.info(f"processed batch  {percentage}%")
+        else:
+            logger.info(f"processed batch {batch_num}: {processed} records so far")
+
+    def _record_rate(self, table, rows, started, method, mode):
+        seconds = timer.perf_counter() - started
+        rows_per_sec = rows / seconds if seconds > 0 else float(rows)
+        self.stats = {"table": table, "rows": rows, "seconds": round(seconds, 3), "rows_per_sec": round(rows_per_sec, 1)}
+        instruments.record_load(method, mode.value, rows, seconds, rows_per_sec)
+        logger.info(f"{table}: {rows} rows in {seconds:.2f}s ({rows_per_sec:.0f} rows/sec)")
+
+    def _read_chunks(self, csv_path, prepare):
+        # read_csv(chunksize=...) runs in a background thread, a small bounded queue lets
+        # parsing the next chunk overlap with writing the current one
+        chunks = queue.Queue(maxsize=PARSE_AHEAD)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for chunk in pd.read_csv(csv_path, chunksize=self.chunk_rows):
+                    if not put(prepare(chunk)):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(_DONE)
+
+        producer = threading.Thread(target=produce, name="csv-parser", daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = chunks.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            producer.join()
+
+    def _copy_chunks(self, table, chunks):
+        # TRUNCATE + COPY FROM STDIN in the session's transaction: readers keep the old rows until commit
+        records_loaded = 0
+        try:
+            raw = self.db.connection().connection.dbapi_connection
+            cursor = raw.cursor()
+            cursor.execute(f"TRUNCATE TABLE {table}")
+            batch_num = 0
+            for chunk in chunks:
+                batch_num += 1
+                buffer = io.StringIO()
+                chunk.to_csv(buffer, index=False, header=False)
+                buffer.seek(0)
+                cursor.copy_expert(f"COPY {table} ({', '.join(chunk.columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+                records_loaded += len(chunk)
+                self._log_progress(records_loaded, None, batch_num)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        return records_loaded
+
+    def _insert_chunks(self, model, chunks):
+        self.db.query(model).delete()
+        self.db.commit()
+        
+        records_loaded = 0
+        batch_num = 0
+        
+        for chunk in chunks:
+            for start_idx in range(0, len(chunk), self.batch_size):
+                batch_num += 1
+                batch_data = chunk.iloc[start_idx:start_idx + self.batch_size].to_dict('records')
+                
+                # Bulk insert current batch
+                self.db.bulk_insert_mappings(model, batch_data)
+                self.db.commit()
+                
+                records_loaded += len(batch_data)
+                self._log_progress(records_loaded, None, batch_num)
+        
+        return records_loaded
+
+    def _upsert_chunks(self, model, chunks, mode, on_written=None):
+        # only the incoming rows are touched, so the cost follows the size of the delta
+        dialect = self.engine.dialect.name
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            raise ValueError(f"{mode.value} loads need INSERT ... ON CONFLICT, not supported on {dialect}")
+
+        table = model.__table__
+        keys = [column.name for column in table.primary_key.columns]
+        others = [column.name for column in table.columns if column.name not in keys]
+
+        stmt = insert(table)
+        if mode == LoadMode.MERGE and others:
+            stmt = stmt.on_conflict_do_update(index_elements=keys, set_={name: stmt.excluded[name] for name in others})
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=keys)
+        # RETURNING only gives back rows that were inserted (or updated), that's what gets counted
+        stmt = stmt.returning(*table.columns)
+
+        records_loaded = 0
+        batch_num = 0
+
+        for chunk in chunks:
+            # a key showing up twice in one statement is an error for DO UPDATE, last one wins
+            chunk = chunk.drop_duplicates(subset=keys, keep='last')
+            for start_idx in range(0, len(chunk), self.batch_size):
+                batch_num += 1
+                batch_data = chunk.iloc[start_idx:start_idx + self.batch_size].to_dict('records')
+
+                try:
+                    written = self.db.execute(stmt, batch_data).all()
+                    self.db.commit()
+                except Exception:
+                    self.db.rollback()
+                    raise
+
+                records_loaded += len(written)
+                if on_written and written:
+                    on_written(written)
+                self._log_progress(records_loaded, None, batch_num)
+
+        return records_loaded
+
+    def _insert_rows(self, table, chunks):
+        # plain INSERTs for a table without a mapped class (the staging copies), one commit at the end
+        records_loaded = 0
+        batch_num = 0
+        try:
+            for chunk in chunks:
+                for start_idx in range(0, len(chunk), self.batch_size):
+                    batch_num += 1
+                    batch_data = chunk.iloc[start_idx:start_idx + self.batch_size].to_dict('records')
+                    self.db.execute(insert(table), batch_data)
+                    records_loaded += len(batch_data)
+                    self._log_progress(records_loaded, None, batch_num)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        return records_loaded
+
+    def _with_partitions(self, chunk, table=StoreStatus.__tablename__):
+        # partitions for the chunk's time range exist before it is written (same transaction)
+        if len(chunk):
+            ensure_partitions(self.db.connection(), chunk['timestamp_utc'].min().to_pydatetime(), chunk['timestamp_utc'].max().to_pydatetime(), table=table)
+        return chunk
+
+    def _load(self, csv_path, model, prepare, method, on_chunk=None, mode=LoadMode.REPLACE, on_written=None):
+        table = model.__tablename__
+        logger.info(f"Starting {table} {mode.value} upload from {csv_path}")
+        started = timer.perf_counter()
+
+        chunks = self._read_chunks(csv_path, prepare)
+        if on_chunk:
+            chunks = (on_chunk(chunk) or chunk for chunk in chunks)
+        if model is StoreStatus and partitioning_enabled(self.engine):
+            chunks = (self._with_partitions(chunk) for chunk in chunks)
+
+        if mode != LoadMode.REPLACE:
+            records_loaded = self._upsert_chunks(model, chunks, mode, on_written)
+        elif self.use_copy:
+            records_loaded = self._copy_chunks(table, chunks)
+        else:
+            records_loaded = self._insert_chunks(model, chunks)
+
+        self._record_rate(table, records_loaded, started, method, mode)
+        return records_loaded
     
+    @_exclusive
     def store_status_data(self, csv_path):
         
         logger.info(f"upload from {csv_path}")        
@@ -43,123 +312,171 @@ class DataLoader:
         logger.info(f"upload completed: {total_records} records")
         return total_records
     
-    def load_store_status(self, csv_path):
-        
-        logger.info(f"Starting store status upload from {csv_path}")
-        
-        df = pd.read_csv(csv_path)
-        total_records = len(df)
-        logger.info(f"Found {total_records} records")
-        
-        self.db.query(StoreStatus).delete()
-        self.db.commit()
- 
-        df['timestamp_utc'] = pd.to_datetime(df['timestamp_utc'])
-        df['store_id'] = df['store_id'].astype(str)
-        
-        records_loaded = 0
-        batch_num = 0
-        
-        for start_idx in range(0, total_records, self.batch_size):
-            batch_num += 1
-            end_idx = min(start_idx + self.batch_size, total_records)
-            #end_ind = total_records if start_idx + self.batch_size > total_records else start_idx + self.batch_size
-            batch_df = df.iloc[start_idx:end_idx]
-            
-            batch_data = []
-            for _, row in batch_df.iterrows():
-                batch_data.append({
-                    'store_id': str(row['store_id']),
-                    'timestamp_utc': row['timestamp_utc'],
-                    'status': row['status']
-                })
-            
-            # Bulk insert current batch
-            self.db.bulk_insert_mappings(StoreStatus, batch_data)
-            self.db.commit()
-            
-            records_loaded += len(batch_data)
-            self._log_progress(records_loaded, total_records, batch_num)
+    @_exclusive
+    def load_store_status(self, csv_path, mode=LoadMode.REPLACE):
         
+        if mode == LoadMode.APPEND:
+            # fold only the rows that were actually new into the rolling state,
+            # a cold state is rebuilt from the db on the next incremental report anyway
+            handler = TimeHandler(self.db)
+            since = {}
+
+            def fold_in(rows):
+                _track_earliest(since, rows)
+                if rolling_uptime.ready:
+                    rolling_uptime.ingest(handler, sorted(rows, key=lambda row: (row.store_id, row.timestamp_utc)))
+
+            records_loaded = self._load(csv_path, StoreStatus, _prepare_store_status, "load_store_status", mode=mode, on_written=fold_in)
+            logger.info(f"Store status appended: {records_loaded} new records")
+            if since:
+                rebuild_rollup(self.db, since=since)
+            return records_loaded
+
+        latest = []
+
+        def track_latest(chunk):
+            if len(chunk):
+                latest.append(chunk['timestamp_utc'].max())
+
+        since = {}
+
+        records_loaded = self._load(csv_path, StoreStatus, _prepare_store_status, "load_store_status", on_chunk=track_latest,
+                                    mode=mode, on_written=lambda rows: _track_earliest(since, rows))
         logger.info(f"Store status uploaded: {records_loaded} records")
+        # hourly rollup of the hours that changed (all of them after a replace)
+        if mode == LoadMode.REPLACE:
+            rebuild_rollup(self.db)
+        elif since:
+            rebuild_rollup(self.db, since=since)
+
+        rolling_uptime.reset()
+        if mode == LoadMode.REPLACE and latest:
+            # table was replaced, rebuild the rolling uptime state from the new rows
+            rolling_uptime.bootstrap(self.db, TimeHandler(self.db), max(latest).to_pydatetime())
+        # a merge can rewrite past statuses, the next incremental report rebuilds from the db
         return records_loaded
     
-    def load_business_hours(self, csv_path):
+    @_exclusive
+    def load_business_hours(self, csv_path, mode=LoadMode.REPLACE):
 
-        logger.info(f"Starting business hours upload from {csv_path}")
-        
-        df = pd.read_csv(csv_path)
-        total_records = len(df)
-        logger.info(f"Found {total_records} records to process")
-        
-        self.db.query(StoreBusinessHours).delete()
-        self.db.commit()
-        
-        records_loaded = 0
-        batch_num = 0
-        
-        for start_idx in range(0, total_records, self.batch_size):
-            batch_num += 1
-            end_idx = min(start_idx + self.batch_size, total_records)
-            batch_df = df.iloc[start_idx:end_idx]
-            
-            # Convert to list of dictionaries for bulk insert
-            batch_data = []
-            for _, row in batch_df.iterrows():
-                # Parse times
-                start_time = datetime.strptime(row['start_time_local'], '%H:%M:%S').time()
-                end_time = datetime.strptime(row['end_time_local'], '%H:%M:%S').time()
-                
-                batch_data.append({
-                    'store_id': str(row['store_id']),
-                    'day_of_week': int(row['dayOfWeek']),
-                    'start_time_local': start_time,
-                    'end_time_local': end_time
-                })
-            
-            # Bulk insert current batch
-            self.db.bulk_insert_mappings(StoreBusinessHours, batch_data)
-            self.db.commit()
-            
-            records_loaded += len(batch_data)
-            self._log_progress(records_loaded, total_records, batch_num)
-        
+        previous = store_metadata.load(self.db)
+        records_loaded = self._load(csv_path, StoreBusinessHours, _prepare_business_hours, "load_business_hours", mode=mode)
         logger.info(f" Business hours uploaded: {records_loaded} records")
+        store_metadata.invalidate()
+        rolling_uptime.reset()
+        # the rollup only holds business time, new hours change all of a store's rows
+        self._rebuild_changed(previous)
         return records_loaded
     
-    def load_timezones(self, csv_path):
-        logger.info(f"Starting timezones upload from {csv_path}")
-        
-        df = pd.read_csv(csv_path)
-        total_records = len(df)
-        logger.info(f"Found {total_records} records to process")
-        
-        self.db.query(StoreTimezone).delete()
-        self.db.commit()
-        
-        records_loaded = 0
-        batch_num = 0
-        
-        for start_idx in range(0, total_records, self.batch_size):
-            batch_num += 1
-            end_idx = min(start_idx + self.batch_size, total_records)
-            batch_df = df.iloc[start_idx:end_idx]
-            
-            # Convert to list of dictionaries for bulk insert
-            batch_data = []
-            for _, row in batch_df.iterrows():
-                batch_data.append({
-                    'store_id': str(row['store_id']),
-                    'timezone_str': row['timezone_str']
-                })
-            
-            # Bulk insert current batch
-            self.db.bulk_insert_mappings(StoreTimezone, batch_data)
-            self.db.commit()
-            
-            records_loaded += len(batch_data)
-            self._log_progress(records_loaded, total_records, batch_num)
-        
+    @_exclusive
+    def load_timezones(self, csv_path, mode=LoadMode.REPLACE):
+
+        previous = store_metadata.load(self.db)
+        records_loaded = self._load(csv_path, StoreTimezone, _prepare_timezones, "load_timezones", mode=mode)
         logger.info(f"Timezones uploaded: {records_loaded} records")
+        store_metadata.invalidate()
+        rolling_uptime.reset()
+        # rollup hours are local hours
+        self._rebuild_changed(previous)
         return records_loaded
- 
\ No newline at end of file
+
+    def _rebuild_changed(self, previous):
+        # rollup of the stores whose timezone or business hours differ from the previous snapshot
+        changed = _changed_stores(previous, store_metadata.get(self.db))
+        logger.info(f"{len(changed)} stores changed timezone or business hours")
+        if changed:
+            rebuild_rollup(self.db, changed)
+
+    def _stage(self, csv_path, model, prepare, method, on_chunk=None):
+        # one file into the staging copy of its table on a session of its own: create the copy,
+        # load it, then build its primary key and indexes. committed, but not under the live name
+        table = model.__table__
+        staging = staging_table(table)
+        db = Session(bind=self.engine)
+        loader = DataLoader(db, self.batch_size, self.use_copy, self.chunk_rows)
+        try:
+            started = timer.perf_counter()
+            create_staging(db.connection(), table)
+            partitioned = staging_partitioned(db.connection(), table)
+            db.commit()
+
+            chunks = loader._read_chunks(csv_path, prepare)
+            if on_chunk:
+                chunks = (on_chunk(chunk) or chunk for chunk in chunks)
+            if partitioned:
+                chunks = (loader._with_partitions(chunk, staging.name) for chunk in chunks)
+            if loader.use_copy:
+                records_loaded = loader._copy_chunks(staging.name, chunks)
+            else:
+                records_loaded = loader._insert_rows(staging, chunks)
+
+            index_staging(db.connection(), table)
+            db.commit()
+            loader._record_rate(staging.name, records_loaded, started, method, LoadMode.REPLACE)
+            return records_loaded
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    @_exclusive
+    def load_all(self, status_csv_path, hours_csv_path, timezones_csv_path):
+        # replaces all three tables at once. each file goes into a staging copy of its table,
+        # the three in parallel (one after the other on sqlite, it has a single writer), the
+        # rollup is built from the staged rows, then one transaction swaps the four staging
+        # tables in. reports keep reading the old tables meanwhile, without waiting on the load,
+        # and never see an empty or half loaded one
+        started = timer.perf_counter()
+        latest = []
+
+        def track_latest(chunk):
+            if len(chunk):
+                latest.append(chunk['timestamp_utc'].max())
+
+        jobs = [
+            (status_csv_path, StoreStatus, _prepare_store_status, "load_store_status", track_latest),
+            (hours_csv_path, StoreBusinessHours, _prepare_business_hours, "load_business_hours", None),
+            (timezones_csv_path, StoreTimezone, _prepare_timezones, "load_timezones", None),
+        ]
+        rollup = StoreStatusHourly.__table__
+        tables = [model.__table__ for _, model, _, _, _ in jobs] + [rollup]
+
+        try:
+            workers = len(jobs) if self.engine.dialect.name == "postgresql" else 1
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="staging") as pool:
+                futures = [pool.submit(self._stage, *job) for job in jobs]
+                counts = [future.result() for future in futures]
+
+            metadata = store_metadata.load(self.db, staging_table(StoreTimezone.__table__),
+                                           staging_table(StoreBusinessHours.__table__))
+            create_staging(self.db.connection(), rollup)
+            self.db.commit()
+            rebuild_rollup(self.db, source=staging_table(StoreStatus.__table__), table=staging_table(rollup),
+                           metadata=metadata)
+            index_staging(self.db.connection(), rollup)
+            self.db.commit()
+
+            swap_started = timer.perf_counter()
+            attempts = swap_in(self.engine, tables)
+            swap_seconds = timer.perf_counter() - swap_started
+        except Exception:
+            self.db.rollback()
+            with self.engine.begin() as conn:
+                for table in tables:
+                    drop_staging(conn, table)
+            raise
+
+        store_metadata.invalidate()
+        rolling_uptime.reset()
+        if latest:
+            rolling_uptime.bootstrap(self.db, TimeHandler(self.db), max(latest).to_pydatetime())
+        # don't sit on the new tables' read locks, the next swap would have to wait for them
+        self.db.commit()
+
+        records = {model.__tablename__: count for (_, model, _, _, _), count in zip(jobs, counts)}
+        seconds = timer.perf_counter() - started
+        self.stats = {"records": records, "seconds": round(seconds, 3), "swap_seconds": round(swap_seconds, 3),
+                      "swap_attempts": attempts}
+        logger.info(f"bulk load: {records} in {seconds:.2f}s, swapped in {swap_seconds:.3f}s ({attempts} attempts)")
+        return records
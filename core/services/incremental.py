@@ -0,0 +1,241 @@
+from __future__ import annotations
+import logging
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import func, select
+
+from ..db.models.store_status import StoreStatus
+from .create_report import TimeHandler
+from .observations import epoch_us, is_active, local_offsets, status_code
+from .prefetch import load_prefetched_data
+from .schedule import local_us, US_PER_MINUTE
+from .windows import DEFAULT_WINDOWS, empty_metrics, window_metrics
+
+logger = logging.getLogger(__name__)
+
+# windows a report on this engine can have, at most
+MAX_WINDOW = timedelta(weeks=1)
+# observations kept per store, behind its newest one: reports up to a week older than the
+# newest observation are answered from the state too
+KEEP = 2 * MAX_WINDOW
+
+
+def _to_us_delta(delta):
+    return delta // timedelta(microseconds=1)
+
+
+KEEP_US = _to_us_delta(KEEP)
+
+
+@dataclass
+class StoreState:
+    # the store's observations from kept_from on, plus the one before it, in utc order
+    utc: array = field(default_factory=lambda: array('q'))
+    codes: array = field(default_factory=lambda: array('B'))
+    kept_from: Optional[int] = None
+    # the ones inside business hours: utc, wall clock us, status code, and the business us
+    # every one before it held active / inactive until the next one, summed from the first
+    business_utc: array = field(default_factory=lambda: array('q'))
+    business_local: array = field(default_factory=lambda: array('q'))
+    business_codes: array = field(default_factory=lambda: array('B'))
+    held_up: array = field(default_factory=lambda: array('q'))
+    held_down: array = field(default_factory=lambda: array('q'))
+    # wall clock order is utc order (no dst fall back between two business observations)
+    ordered: bool = True
+
+
+class RollingUptime:
+    # per store running state kept up to date as store_status rows are ingested: the business
+    # time every observation holds its status until the next one (the interpolation from the
+    # README) is summed as it comes in, so a window is two lookups in the running sums plus its
+    # edges, computed the way TimeHandler.sweep_uptime_downtime computes them
+    def __init__(self):
+        self.states: Dict[str, StoreState] = {}
+        self.since_us: Optional[int] = None  # every store's observations are kept from here on
+        self.ready = False
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.states = {}
+            self.since_us = None
+            self.ready = False
+
+    def _prune(self, state, newest):
+        # drops what no report can read any more, keeping the observation before the cutoff
+        # for the single observation split
+        cutoff = newest - KEEP_US
+        drop = bisect_left(state.utc, cutoff) - 1
+        if drop <= 0:
+            return
+        del state.utc[:drop], state.codes[:drop]
+        drop = bisect_left(state.business_utc, cutoff)
+        for column in (state.business_utc, state.business_local, state.business_codes, state.held_up, state.held_down):
+            del column[:drop]
+        state.kept_from = cutoff
+        if not state.ordered:
+            local = state.business_local
+            state.ordered = all(local[i] <= local[i + 1] for i in range(len(local) - 1))
+
+    def observe(self, handler, store_id, timestamp_utc, status):
+        ts = epoch_us(timestamp_utc)
+        state = self.states.setdefault(store_id, StoreState())
+        if state.utc and ts <= state.utc[-1]:
+            # late rows can't be folded in incrementally, the caller marks the state stale
+            return ts == state.utc[-1]
+        code = status_code(status)
+        state.utc.append(ts)
+        state.codes.append(code)
+        schedule = handler.get_schedule(store_id)
+        local = ts + local_offsets(handler.get_zone(store_id), (ts,))[0]
+        if schedule.contains_us(local):
+            up = down = 0
+            if state.business_local:
+                previous = state.business_local[-1]
+                state.ordered = state.ordered and previous <= local
+                held = schedule.business_us_before(local) - schedule.business_us_before(previous)
+                up, down = state.held_up[-1], state.held_down[-1]
+                if is_active(state.business_codes[-1]):
+                    up += held
+                else:
+                    down += held
+            state.business_utc.append(ts)
+            state.business_local.append(local)
+            state.business_codes.append(code)
+            state.held_up.append(up)
+            state.held_down.append(down)
+        self._prune(state, ts)
+        return True
+
+    def ingest(self, handler, rows):
+        # rows -> (store_id, timestamp_utc, status), oldest first per store
+        count = 0
+        late = 0
+        with self._lock:
+            for store_id, timestamp_utc, status in rows:
+                if not self.observe(handler, store_id, timestamp_utc, status):
+                    late += 1
+                count += 1
+            # an observation older than what's already folded in would change past sums,
+            # drop to cold so the next incremental report rebuilds from the db
+            self.ready = late == 0
+        logger.info(f"rolling uptime: ingested {count} observations ({late} late), {len(self.states)} stores tracked")
+        return count
+
+    def bootstrap(self, db, handler, reference_time_utc):
+        data = load_prefetched_data(db, reference_time_utc, span=KEEP)
+        rows = []
+        for store_id, observations in data.observations.items():
+            if store_id in data.carry_in:
+                rows.append((store_id, data.carry_in[store_id].timestamp_utc, data.carry_in[store_id].status))
+            rows.extend((store_id, obs.timestamp_utc, obs.status) for obs in observations)
+        self.reset()
+        self.ingest(handler, rows)
+        self.since_us = epoch_us(data.week_ago)
+
+    def metrics(self, handler, store_id, reference_time_utc, windows=DEFAULT_WINDOWS):
+        # windows up to a week. None when the state can't tell: the longest window starts
+        # before the kept observations, or a dst fall back put two business observations out
+        # of wall clock order; the caller answers that store from the db instead
+        reference = epoch_us(reference_time_utc)
+        since = reference - _to_us_delta(windows[-1].length)
+        with self._lock:
+            state = self.states.get(store_id)
+            if self.since_us is None:
+                return None
+            kept_from = self.since_us if state is None or state.kept_from is None else max(self.since_us, state.kept_from)
+            if since < kept_from:
+                return None
+            if state is None or bisect_left(state.utc, since) == bisect_right(state.utc, reference):
+                # nothing in the longest window, same as calculate_store_metrics
+                return empty_metrics(windows)
+            if not state.ordered:
+                return None
+
+            # the business observations in the longest window, [lo, hi)
+            lo = bisect_left(state.business_utc, since)
+            hi = bisect_right(state.business_utc, reference)
+            times, codes = state.business_local, state.business_codes
+            before = handler.get_schedule(store_id).business_us_before
+            end = local_us(handler.utc_to_local(reference_time_utc, store_id))
+            if hi > lo and times[hi - 1] > end:
+                return None
+            starts = [local_us(handler.utc_to_local(reference_time_utc - w.length, store_id)) for w in windows]
+
+            results = []
+            longest = len(windows) - 1
+            for w, start in enumerate(starts):
+                total = before(end) - before(start) if start < end else 0
+                first = lo if w == longest else bisect_left(times, start, lo, hi)
+                if total == 0:
+                    up = down = 0
+                elif first == hi:
+                    # no data = assume everything is down
+                    up, down = 0, total
+                elif first == hi - 1:
+                    # single observation: split at it when the previous one had another status
+                    previous = bisect_left(state.utc, state.business_utc[first]) - 1
+                    if previous >= 0 and state.codes[previous] != codes[first]:
+                        down = before(times[first]) - before(start) if start < times[first] else 0
+                        up = total - down
+                        if not is_active(codes[first]):
+                            up, down = down, up
+                    else:
+                        up, down = (total, 0) if is_active(codes[first]) else (0, total)
+                else:
+                    # the stretch before the first observation takes its status
+                    lead = before(times[first]) - before(start) if start < times[first] else 0
+                    up, down = (lead, 0) if is_active(codes[first]) else (0, lead)
+                    # observations before the start only happen in the longest window (around a
+                    # dst change), they count from the start
+                    i = first
+                    while i < hi and times[i] < start:
+                        seg_end = min(times[i + 1], end) if i < hi - 1 else end
+                        seg_start = max(start, times[i])
+                        seg = before(seg_end) - before(seg_start) if seg_start < seg_end else 0
+                        if is_active(codes[i]):
+                            up += seg
+                        else:
+                            down += seg
+                        i += 1
+                    if i < hi:
+                        # held from i up to the last one, then the last one until the end
+                        last = hi - 1
+                        tail = before(end) - before(times[last]) if times[last] < end else 0
+                        up += state.held_up[last] - state.held_up[i]
+                        down += state.held_down[last] - state.held_down[i]
+                        if is_active(codes[last]):
+                            up += tail
+                        else:
+                            down += tail
+                results.append((up / US_PER_MINUTE, down / US_PER_MINUTE))
+
+        return window_metrics(windows, results)
+
+
+# process wide, fed by DataLoader
+rolling_uptime = RollingUptime()
+
+
+class IncrementalTimeHandler(TimeHandler):
+    # O(stores) report: reads the rolling sums, only replays the db when the state is cold.
+    # a store the state can't answer (see RollingUptime.metrics) goes through TimeHandler
+    def calculate_store_metrics(self, store_id, reference_time_utc):
+        if self.windows[-1].length > MAX_WINDOW:
+            raise ValueError(f"the incremental engine answers windows up to {MAX_WINDOW.days} days")
+        if not rolling_uptime.ready:
+            with self.timings.stage("fetch"):
+                # the state follows the live table, so it's rebuilt up to the newest observation,
+                # never up to an earlier reference time (rows after it would never be folded in)
+                latest = self.db.execute(select(func.max(StoreStatus.timestamp_utc))).scalar()
+                rolling_uptime.bootstrap(self.db, self, latest or reference_time_utc)
+        with self.timings.stage("uptime"):
+            metrics = rolling_uptime.metrics(self, store_id, reference_time_utc, self.windows)
+        if metrics is None:
+            return super().calculate_store_metrics(store_id, reference_time_utc)
+        return metrics
@@ -0,0 +1,212 @@
+import heapq
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# seconds, wide enough for one store (sub ms) up to a whole report
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# slowest stores of a report written to the log
+SLOWEST_STORES = int(os.getenv("REPORT_SLOWEST_STORES", "10"))
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_labels(self.labelnames, key)} {value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        self.observe_many((value,), **labels)
+
+    def observe_many(self, values, **labels):
+        # one lock round trip for a whole batch (per store times of a report)
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), [0.0, 0])
+            for value in values:
+                i = bisect_left(self.buckets, value)
+                if i < len(counts):
+                    counts[i] += 1
+                total[0] += value
+                total[1] += 1
+            self._values[key] = (counts, total)
+
+    def _samples(self, key, value):
+        counts, (total, count) = value
+        names = self.labelnames + ("le",)
+        lines = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets, counts):
+            cumulative += bucket
+            lines.append(f"{self.name}_bucket{_labels(names, key + (bound,))} {cumulative}")
+        lines.append(f"{self.name}_bucket{_labels(names, key + ('+Inf',))} {count}")
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Instruments:
+    # process wide performance metrics, appended to the store gauges on /metrics.
+    # a handful of series, so unlike the store gauges they're rendered on every scrape
+    def __init__(self):
+        self.report_stage_seconds = Histogram(
+            "report_stage_seconds", "Time a report spent in each stage, summed over its stores",
+            ("engine", "stage"))
+        self.report_store_seconds = Histogram(
+            "report_store_seconds", "calculate_store_metrics time per store", ("engine",))
+        self.report_store_errors = Counter(
+            "report_store_errors_total", "Stores reported as zeros because calculate_store_metrics raised",
+            ("engine",))
+        self.report_duration_seconds = Histogram(
+            "report_duration_seconds", "Wall time of a report from start to the written file", ("engine", "format"))
+        self.loader_rows = Counter(
+            "dataloader_rows_total", "Rows written by DataLoader", ("method", "mode"))
+        self.loader_seconds = Histogram(
+            "dataloader_load_seconds", "Wall time of a DataLoader load", ("method",))
+        self.loader_rows_per_second = Gauge(
+            "dataloader_rows_per_second", "Rows per second of the latest DataLoader load", ("method",))
+        self.metrics = (
+            self.report_stage_seconds, self.report_store_seconds, self.report_store_errors,
+            self.report_duration_seconds, self.loader_rows, self.loader_seconds, self.loader_rows_per_second,
+        )
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def record_load(self, method, mode, rows, seconds, rows_per_sec):
+        self.loader_rows.inc(rows, method=method, mode=mode)
+        self.loader_seconds.observe(seconds, method=method)
+        self.loader_rows_per_second.set(rows_per_sec, method=method)
+
+
+instruments = Instruments()
+
+
+class _Stage:
+    __slots__ = ("timings", "name", "started")
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timings.stages[self.name] += time.perf_counter() - self.started
+
+
+class ReportTimings:
+    # what one report measured, published to `instruments` once it's done. stage times are
+    # summed per report (one observation per stage), store times are kept whole.
+    # plain data, a parallel shard sends its own back to be merged into the report's
+    def __init__(self):
+        self.stages = defaultdict(float)
+        self.store_seconds = []
+        self.slowest = []
+        self.errors = 0
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def _keep_slowest(self, seconds, store_id):
+        if len(self.slowest) < SLOWEST_STORES:
+            heapq.heappush(self.slowest, (seconds, store_id))
+        elif self.slowest and seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, store_id))
+
+    def store(self, store_id, seconds):
+        self.store_seconds.append(seconds)
+        self._keep_slowest(seconds, store_id)
+
+    def merge(self, other):
+        for name, seconds in other.stages.items():
+            self.stages[name] += seconds
+        self.store_seconds.extend(other.store_seconds)
+        for seconds, store_id in other.slowest:
+            self._keep_slowest(seconds, store_id)
+        self.errors += other.errors
+
+    def publish(self, engine):
+        for name, seconds in self.stages.items():
+            instruments.report_stage_seconds.observe(seconds, engine=engine, stage=name)
+        instruments.report_store_seconds.observe_many(self.store_seconds, engine=engine)
+        if self.errors:
+            instruments.report_store_errors.inc(self.errors, engine=engine)
+        if self.slowest:
+            slowest = ", ".join(f"{store_id} {seconds * 1000:.1f}ms" for seconds, store_id in sorted(self.slowest, reverse=True))
+            logger.info(f"{engine} report: {len(self.store_seconds)} stores, {self.errors} errors, slowest: {slowest}")
+
+
+class TimedRows:
+    # wraps the report rows, the time spent producing them is what the writer didn't spend
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            return next(self._rows)
+        finally:
+            self.seconds += time.perf_counter() - started
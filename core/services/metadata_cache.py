@@ -0,0 +1,126 @@
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional
+
+from sqlalchemy import select
+from zoneinfo import ZoneInfo
+
+from ..db.models.store_timezone import StoreTimezone
+from ..db.models.store_business_hours import StoreBusinessHours
+from .schedule import WeeklySchedule
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEZONE = "America/Chicago"
+
+
+class HoursRow(NamedTuple):
+    # plain copy of a StoreBusinessHours row, to_business_hours only needs the attributes
+    store_id: str
+    day_of_week: int
+    start_time_local: object
+    end_time_local: object
+
+
+class StoreMetadata:
+    # one consistent snapshot of store_timezones + store_business_hours, loaded in two queries.
+    # business hours and compiled schedules are built on first use per store and kept
+    def __init__(self, cache, timezones: Dict[str, str], hours: Dict[str, List[HoursRow]]):
+        self._cache = cache
+        self.timezones = timezones
+        self.hours = hours
+        self._business_hours = {}
+        self._schedules = {}
+
+    def timezone(self, store_id):
+        return self.timezones.get(store_id, DEFAULT_TIMEZONE)
+
+    def zone(self, store_id):
+        return self._cache.zone(self.timezone(store_id))
+
+    def business_hours(self, store_id):
+        business_hours = self._business_hours.get(store_id)
+        if business_hours is None:
+            from .create_report import to_business_hours
+            self._cache.misses += 1
+            business_hours = self._business_hours[store_id] = to_business_hours(self.hours.get(store_id))
+        else:
+            self._cache.hits += 1
+        return business_hours
+
+    def schedule(self, store_id):
+        schedule = self._schedules.get(store_id)
+        if schedule is None:
+            self._cache.misses += 1
+            schedule = self._schedules[store_id] = WeeklySchedule.compile(self.business_hours(store_id))
+        else:
+            self._cache.hits += 1
+        return schedule
+
+
+class StoreMetadataCache:
+    # process wide, replaces the lru_cache on TimeHandler's bound methods (which kept every
+    # handler and its session alive and started cold on every report).
+    # the snapshot is loaded in bulk on first use and dropped by DataLoader when timezones or
+    # business hours are uploaded; a report keeps the snapshot it started with.
+    # hits / misses are per store lookup and only approximate while reports run concurrently
+    def __init__(self):
+        self._snapshot: Optional[StoreMetadata] = None
+        self._zones: Dict[str, ZoneInfo] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.invalidations = 0
+
+    def get(self, db) -> StoreMetadata:
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = self.load(db)
+            return self._snapshot
+
+    def load(self, db, timezone_table=None, hours_table=None):
+        # a snapshot of the given tables (the live ones by default, a bulk load passes its
+        # staging copies), not cached
+        timezone_table = timezone_table if timezone_table is not None else StoreTimezone.__table__
+        hours_table = hours_table if hours_table is not None else StoreBusinessHours.__table__
+        timezones = {store_id: timezone_str for store_id, timezone_str in db.execute(
+            select(timezone_table.c.store_id, timezone_table.c.timezone_str))}
+        hours = defaultdict(list)
+        for row in db.execute(select(
+                hours_table.c.store_id, hours_table.c.day_of_week,
+                hours_table.c.start_time_local, hours_table.c.end_time_local)):
+            hours[row.store_id].append(HoursRow(*row))
+        self.loads += 1
+        logger.info(f"store metadata loaded: {len(timezones)} timezones, {len(hours)} business hour sets")
+        return StoreMetadata(self, timezones, dict(hours))
+
+    def zone(self, name):
+        # one ZoneInfo per name for the whole process, so local datetimes share it
+        zone = self._zones.get(name)
+        if zone is None:
+            zone = self._zones.setdefault(name, ZoneInfo(name))
+        return zone
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+            self.invalidations += 1
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "invalidations": self.invalidations,
+            "stores": len(snapshot.timezones) if snapshot else 0,
+            "zones": len(self._zones),
+        }
+
+
+store_metadata = StoreMetadataCache()
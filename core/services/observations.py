@@ -0,0 +1,141 @@
+from __future__ import annotations
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from operator import add
+
+US_PER_HOUR = 3_600_000_000
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+NAIVE_EPOCH = datetime(1970, 1, 1)
+_US = timedelta(microseconds=1)
+
+# status string <-> uint8 code, process wide. seeded so the usual two always get the same
+# codes, anything else is interned on first sight
+STATUSES = []
+_CODES = {}
+
+
+def status_code(status):
+    code = _CODES.get(status)
+    if code is None:
+        if len(STATUSES) == 256:
+            raise ValueError(f"more than 256 distinct statuses, can't code {status!r}")
+        code = _CODES[status] = len(STATUSES)
+        STATUSES.append(status)
+    return code
+
+
+def is_active(code):
+    return str(STATUSES[code]).lower() == 'active'
+
+
+for _status in ("active", "inactive"):
+    status_code(_status)
+
+
+@dataclass(slots=True)
+class StoreRow:
+    # same attribute names as a StoreStatus row, so TimeHandler can't tell the difference
+    timestamp_utc: object
+    status: str
+
+
+def as_utc(ts):
+    # sqlite hands back naive datetimes
+    if ts.tzinfo is None:
+        return ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc)
+
+
+def epoch_us(ts):
+    # naive timestamps are utc (sqlite)
+    return (ts - (EPOCH if ts.tzinfo is not None else NAIVE_EPOCH)) // _US
+
+
+def from_epoch_us(us):
+    return EPOCH + timedelta(microseconds=us)
+
+
+@lru_cache(maxsize=65536)
+def _hour_offset(zone, hour):
+    # utc offset of the zone during one utc hour, None when it changes inside it
+    start = from_epoch_us(hour * US_PER_HOUR)
+    offset = start.astimezone(zone).utcoffset()
+    if (start + timedelta(hours=1)).astimezone(zone).utcoffset() != offset:
+        return None
+    return offset // _US
+
+
+def local_offsets(zone, utc_us):
+    # utc microseconds -> offset to add for the zone's wall clock, one zone lookup per utc hour
+    offsets = array('q', bytes(8 * len(utc_us)))
+    for i, t in enumerate(utc_us):
+        offset = _hour_offset(zone, t // US_PER_HOUR)
+        if offset is None:
+            offset = from_epoch_us(t).astimezone(zone).utcoffset() // _US
+        offsets[i] = offset
+    return offsets
+
+
+class ObservationBuffer:
+    # one store's observations in utc order: epoch microseconds as int64, status as uint8
+    # codes (see status_code), and once localized the utc offset of each one. a window of it
+    # is a view on the same memory
+    __slots__ = ("utc_us", "codes", "offset_us", "zone")
+
+    def __init__(self, utc_us=None, codes=None):
+        self.utc_us = utc_us if utc_us is not None else array('q')
+        self.codes = codes if codes is not None else array('B')
+        self.offset_us = None
+        self.zone = None
+
+    @classmethod
+    def from_rows(cls, rows):
+        # StoreStatus rows (or anything with timestamp_utc / status), oldest first
+        buffer = cls()
+        for row in rows:
+            buffer.append(row.timestamp_utc, row.status)
+        return buffer
+
+    def append(self, timestamp_utc, status):
+        self.append_us(epoch_us(timestamp_utc), status)
+
+    def append_us(self, utc_us, status):
+        self.utc_us.append(utc_us)
+        self.codes.append(status_code(status))
+        self.offset_us = None
+
+    def __len__(self):
+        return len(self.utc_us)
+
+    def __iter__(self):
+        return (self.row(i) for i in range(len(self.utc_us)))
+
+    def row(self, i):
+        return StoreRow(from_epoch_us(self.utc_us[i]), STATUSES[self.codes[i]])
+
+    def status(self, i):
+        return STATUSES[self.codes[i]]
+
+    def before(self, timestamp_utc):
+        # index of the last observation strictly before the timestamp, -1 if none
+        return bisect_left(self.utc_us, epoch_us(timestamp_utc)) - 1
+
+    def window(self, since_utc, until_utc):
+        # observations in [since, until], no copy
+        lo = bisect_left(self.utc_us, epoch_us(since_utc))
+        hi = bisect_right(self.utc_us, epoch_us(until_utc))
+        view = ObservationBuffer(memoryview(self.utc_us)[lo:hi], memoryview(self.codes)[lo:hi])
+        if self.offset_us is not None:
+            view.offset_us = memoryview(self.offset_us)[lo:hi]
+            view.zone = self.zone
+        return view
+
+    def local_us(self, zone):
+        # wall clock microseconds in the zone (what schedule.local_us gives for the local datetime)
+        if self.zone is not zone or self.offset_us is None:
+            self.offset_us = local_offsets(zone, self.utc_us)
+            self.zone = zone
+        return array('q', map(add, self.utc_us, self.offset_us))
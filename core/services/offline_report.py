@@ -0,0 +1,210 @@
+from __future__ import annotations
+import logging
+import multiprocessing
+import os
+from array import array
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timezone
+
+import numpy as np
+import pandas as pd
+
+from .data_loader import CSV_CHUNK_ROWS, _prepare_business_hours, _prepare_timezones
+from .metadata_cache import HoursRow, StoreMetadata, store_metadata
+from .observations import ObservationBuffer, StoreRow, as_utc, status_code
+from .parallel_report import SHARDS_PER_WORKER, default_workers, shard_of
+from .prefetch import PrefetchTimeHandler, PrefetchedData
+from .report_runner import ReportEngine, compute_rows
+from .vectorized import VectorizedTimeHandler
+from .windows import DEFAULT_WINDOWS
+
+logger = logging.getLogger(__name__)
+
+# the engines that work from PrefetchedData alone
+ENGINES = (ReportEngine.BULK, ReportEngine.VECTORIZED)
+
+# typed on read, timestamps are parsed separately (see _timestamps)
+STATUS_DTYPES = {"store_id": str, "status": "category", "timestamp_utc": str}
+HOURS_DTYPES = {"store_id": str, "dayOfWeek": "int8", "start_time_local": str, "end_time_local": str}
+TIMEZONE_DTYPES = {"store_id": str, "timezone_str": str}
+
+
+def _chunks(path, dtype, usecols=None):
+    return pd.read_csv(path, chunksize=CSV_CHUNK_ROWS, memory_map=True, dtype=dtype, usecols=usecols)
+
+
+def _timestamps(values):
+    # "2024-10-14 23:55:18.727055 UTC" -> naive utc datetime64. without the suffix pandas takes
+    # its C iso8601 path instead of matching %Z element by element (an order of magnitude)
+    parsed = pd.to_datetime(values.str.removesuffix(" UTC"), format="ISO8601", utc=True)
+    return parsed.dt.tz_localize(None)
+
+
+def _prepare_status(chunk):
+    return pd.DataFrame({
+        "store_id": chunk["store_id"],
+        "timestamp_utc": _timestamps(chunk["timestamp_utc"]),
+        "status": chunk["status"],
+    })
+
+
+def latest_timestamp(status_path):
+    # what trigger_report pins a report to (the latest observation), from the timestamp column alone
+    latest = None
+    for chunk in _chunks(status_path, {"timestamp_utc": str}, usecols=["timestamp_utc"]):
+        value = _timestamps(chunk["timestamp_utc"]).max()
+        if pd.notna(value) and (latest is None or value > latest):
+            latest = value
+    return latest.to_pydatetime().replace(tzinfo=timezone.utc) if latest is not None else None
+
+
+def _last_per_store(frame):
+    return frame.sort_values("timestamp_utc", kind="stable").drop_duplicates("store_id", keep="last")
+
+
+def read_status(status_path, reference_time_utc, span):
+    # (every store id in the file, observations in [reference - span, reference], last
+    # observation before that per store). chunk by chunk, only the window is ever kept whole
+    reference = reference_time_utc.astimezone(timezone.utc).replace(tzinfo=None)
+    since = reference - span
+    store_ids = set()
+    window, before = [], []
+    for chunk in _chunks(status_path, STATUS_DTYPES):
+        chunk = _prepare_status(chunk)
+        store_ids.update(chunk["store_id"].unique())
+        chunk = chunk[chunk["timestamp_utc"] <= reference]
+        in_window = chunk["timestamp_utc"] >= since
+        window.append(chunk[in_window])
+        before.append(_last_per_store(chunk[~in_window]))
+
+    window = pd.concat(window, ignore_index=True) if window else pd.DataFrame(columns=["store_id", "timestamp_utc", "status"])
+    before = pd.concat(before, ignore_index=True) if before else window.iloc[:0]
+    # a repeated (store, timestamp) counts once, like the table's primary key
+    window = window.drop_duplicates(["store_id", "timestamp_utc"], keep="last")
+    window = window.sort_values(["store_id", "timestamp_utc"], kind="stable")
+    carry_in = _last_per_store(before)
+    carry_in = carry_in[carry_in["store_id"].isin(window["store_id"].unique())]
+    return sorted(store_ids), window, carry_in
+
+
+def read_business_hours(path):
+    hours = defaultdict(list)
+    if path:
+        for chunk in _chunks(path, HOURS_DTYPES):
+            chunk = _prepare_business_hours(chunk).drop_duplicates()
+            for row in chunk.itertuples(index=False):
+                hours[row.store_id].append(HoursRow(row.store_id, row.day_of_week, row.start_time_local, row.end_time_local))
+    return dict(hours)
+
+
+def read_timezones(path):
+    timezones = {}
+    if path:
+        for chunk in _chunks(path, TIMEZONE_DTYPES):
+            chunk = _prepare_timezones(chunk)
+            timezones.update(zip(chunk["store_id"], chunk["timezone_str"]))
+    return timezones
+
+
+def _rows(frame):
+    return zip(frame["store_id"], pd.DatetimeIndex(frame["timestamp_utc"]).to_pydatetime(), frame["status"])
+
+
+def _buffers(window):
+    # store_id -> ObservationBuffer, copied out of the sorted frame's columns without a row object
+    utc_us = window["timestamp_utc"].to_numpy(dtype="datetime64[us]").view(np.int64)
+    statuses = window["status"].astype("category")
+    table = [status_code(status) for status in statuses.cat.categories]
+    if statuses.isna().any():
+        # category code -1, the last entry
+        table.append(status_code(None))
+    codes = np.array(table, dtype=np.uint8)[statuses.cat.codes.to_numpy()]
+    store_ids = window["store_id"].to_numpy()
+    bounds = np.flatnonzero(store_ids[1:] != store_ids[:-1]) + 1
+    buffers = {}
+    for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(store_ids)]):
+        buffers[store_ids[lo]] = ObservationBuffer(array('q', utc_us[lo:hi].tobytes()), array('B', codes[lo:hi].tobytes()))
+    return buffers
+
+
+def prefetched_data(window, carry_in, timezones, hours, reference_time_utc, span):
+    # the same PrefetchedData load_prefetched_data builds from the database
+    data = PrefetchedData(week_ago=reference_time_utc - span, reference_time_utc=reference_time_utc)
+    if len(window):
+        data.observations.update(_buffers(window))
+    for store_id, timestamp_utc, status in _rows(carry_in):
+        data.carry_in[store_id] = StoreRow(timestamp_utc.replace(tzinfo=timezone.utc), status)
+    data.metadata = StoreMetadata(store_metadata, timezones, hours)
+    data.timezones = timezones
+    data.business_hours = hours
+    return data
+
+
+def _handler(engine, data, windows):
+    # no session: every lookup is answered from the data, there's nothing to fall back to
+    if engine == ReportEngine.VECTORIZED:
+        return VectorizedTimeHandler(None, data, windows)
+    return PrefetchTimeHandler(None, data, windows)
+
+
+def _compute_shard(engine_value, store_ids, window, carry_in, timezones, hours, reference_time_utc, windows):
+    engine = ReportEngine(engine_value)
+    data = prefetched_data(window, carry_in, timezones, hours, reference_time_utc, windows[-1].length)
+    return compute_rows(None, engine, store_ids, reference_time_utc, time_handler=_handler(engine, data, windows), windows=windows)
+
+
+def compute_offline(status_path, hours_path=None, timezones_path=None, engine=ReportEngine.BULK,
+                    windows=DEFAULT_WINDOWS, reference_time=None, workers=None):
+    # the report trigger_report would produce once these csvs were loaded, without a database.
+    # without hours / timezones every store is open 24/7 in the default timezone, like a store
+    # missing from those tables. rows come back in store_id order
+    if engine not in ENGINES:
+        raise ValueError(f"engine={engine.value} needs a database, offline reports run on {', '.join(e.value for e in ENGINES)}")
+    if reference_time is None:
+        reference_time = latest_timestamp(status_path)
+    else:
+        reference_time = as_utc(reference_time)
+    span = windows[-1].length
+
+    store_ids = []
+    if reference_time is not None:
+        store_ids, window, carry_in = read_status(status_path, reference_time, span)
+    if not store_ids:
+        return []
+    hours = read_business_hours(hours_path)
+    timezones = read_timezones(timezones_path)
+    logger.info(f"{len(window)} observations of {len(store_ids)} stores up to {reference_time}, "
+                f"{len(timezones)} timezones, {len(hours)} business hour sets")
+
+    workers = max(1, workers or default_workers())
+    if workers == 1:
+        return _compute_shard(engine.value, store_ids, window, carry_in, timezones, hours, reference_time, windows)
+
+    # same crc32 sharding as parallel_report, each shard ships only its own stores' rows
+    shards = workers * SHARDS_PER_WORKER
+    store_shard = {store_id: shard_of(store_id, shards) for store_id in store_ids}
+    members = defaultdict(list)
+    for store_id, shard in store_shard.items():
+        members[shard].append(store_id)
+    window_parts = dict(tuple(window.groupby(window["store_id"].map(store_shard), sort=False)))
+    carry_parts = dict(tuple(carry_in.groupby(carry_in["store_id"].map(store_shard), sort=False)))
+    logger.info(f"computing {len(store_ids)} stores in {len(members)} shards on {workers} processes")
+
+    context = multiprocessing.get_context(os.getenv("REPORT_MP_CONTEXT", "spawn"))
+    rows = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = [
+            pool.submit(
+                _compute_shard, engine.value, shard_stores,
+                window_parts.get(shard, window.iloc[:0]), carry_parts.get(shard, carry_in.iloc[:0]),
+                {s: timezones[s] for s in shard_stores if s in timezones},
+                {s: hours[s] for s in shard_stores if s in hours},
+                reference_time, windows
+            )
+            for shard, shard_stores in members.items()
+        ]
+        for future in as_completed(futures):
+            for row in future.result():
+                rows[row["store_id"]] = row
+    return [rows[store_id] for store_id in store_ids]
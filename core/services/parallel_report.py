@@ -0,0 +1,73 @@
+import logging
+import multiprocessing
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from ..db.engines import registry
+from . import create_report
+from .instrumentation import ReportTimings
+from .windows import DEFAULT_WINDOWS
+from .report_runner import ReportEngine, compute_rows, time_handler_for
+
+logger = logging.getLogger(__name__)
+
+# more shards than workers keeps the pool busy when shards are uneven
+SHARDS_PER_WORKER = 4
+
+
+def default_workers():
+    return int(os.getenv("REPORT_PROCESSES", str(os.cpu_count() or 1)))
+
+
+def shard_of(store_id, shards):
+    # crc32 instead of hash(): has to be stable across processes
+    return zlib.crc32(str(store_id).encode()) % shards
+
+
+def split_into_shards(store_ids, shards):
+    buckets = [[] for _ in range(shards)]
+    for store_id in store_ids:
+        buckets[shard_of(store_id, shards)].append(store_id)
+    return [bucket for bucket in buckets if bucket]
+
+
+def _init_worker():
+    # a forked worker inherits the parent's pools, drop them (without closing the parent's
+    # connections) so this process opens its own
+    registry.dispose(close=False)
+
+
+def _compute_shard(engine_value, store_ids, reference_time, windows):
+    engine = ReportEngine(engine_value)
+    db = create_report.SessionLocal()
+    timings = ReportTimings()
+    try:
+        with timings.stage("fetch"):
+            time_handler = time_handler_for(engine, db, reference_time, store_ids, windows)
+        return compute_rows(db, engine, store_ids, reference_time, time_handler=time_handler, timings=timings, windows=windows), timings
+    finally:
+        db.close()
+
+
+def compute_rows_parallel(engine, store_ids, reference_time, workers=None, progress=None, timings=None, windows=DEFAULT_WINDOWS):
+    # shard timings are merged into `timings`, stage times then add up across processes
+    workers = max(1, workers or default_workers())
+    shards = split_into_shards(store_ids, workers * SHARDS_PER_WORKER)
+    logger.info(f"computing {len(store_ids)} stores in {len(shards)} shards on {workers} processes")
+
+    context = multiprocessing.get_context(os.getenv("REPORT_MP_CONTEXT", "spawn"))
+    rows = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as pool:
+        futures = [pool.submit(_compute_shard, engine.value, shard, reference_time, windows) for shard in shards]
+        for future in as_completed(futures):
+            shard_rows, shard_timings = future.result()
+            for row in shard_rows:
+                rows[row["store_id"]] = row
+            if timings is not None:
+                timings.merge(shard_timings)
+            if progress:
+                progress(len(rows), len(store_ids))
+
+    # merge back in the order the stores were listed, not the order shards finished
+    return [rows[store_id] for store_id in store_ids]
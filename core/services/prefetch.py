@@ -0,0 +1,127 @@
+from __future__ import annotations
+import logging
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import timedelta, timezone
+from typing import Dict, Optional
+
+from sqlalchemy import select
+
+from ..db.models.store_status import StoreStatus
+from .create_report import TimeHandler, StatusObservation
+from .metadata_cache import StoreMetadata, store_metadata
+from .carry_in import last_status_before
+from .observations import ObservationBuffer, StoreRow
+from .windows import DEFAULT_WINDOWS
+
+logger = logging.getLogger(__name__)
+
+# rows pulled per round trip from the server side cursor
+STREAM_BATCH_SIZE = 10000
+
+
+@dataclass
+class PrefetchedData:
+    week_ago: object   # start of the longest window, a week ago unless the report asked for more
+    reference_time_utc: object
+    observations: Dict[str, ObservationBuffer] = field(default_factory=lambda: defaultdict(ObservationBuffer))
+    # last observation before week_ago for every store observed in the week (that has one)
+    carry_in: Dict[str, StoreRow] = field(default_factory=dict)
+    timezones: Dict[str, str] = field(default_factory=dict)
+    business_hours: Dict[str, list] = field(default_factory=dict)
+    metadata: Optional[StoreMetadata] = None
+
+
+def _stream(db, stmt):
+    # core rows, the orm result layer costs more than the rows here
+    return db.connection().execute(stmt.execution_options(yield_per=STREAM_BATCH_SIZE))
+
+
+def _only(stmt, column, store_ids):
+    if store_ids is None:
+        return stmt
+    return stmt.where(column.in_(list(store_ids)))
+
+
+def load_prefetched_data(db, reference_time_utc, store_ids=None, span=timedelta(weeks=1)):
+    # fixed number of set based queries, whatever the store count.
+    # store_ids limits everything to a subset of stores (one shard of a parallel report),
+    # span is the longest window of the report
+    week_ago = reference_time_utc - span
+    data = PrefetchedData(week_ago=week_ago, reference_time_utc=reference_time_utc)
+
+    week_stmt = select(StoreStatus.store_id, StoreStatus.timestamp_utc, StoreStatus.status).where(
+        StoreStatus.timestamp_utc >= week_ago,
+        StoreStatus.timestamp_utc <= reference_time_utc
+    ).order_by(StoreStatus.store_id, StoreStatus.timestamp_utc)
+    week_stmt = _only(week_stmt, StoreStatus.store_id, store_ids)
+
+    rows = 0
+    current, buffer = None, None
+    for store_id, timestamp_utc, status in _stream(db, week_stmt):
+        # ordered by store, one buffer lookup per store
+        if store_id != current:
+            current, buffer = store_id, data.observations[store_id]
+        buffer.append(timestamp_utc, status)
+        rows += 1
+
+    data.carry_in = last_status_before(db, week_ago, reference_time_utc, store_ids, stream=_stream)
+
+    # timezones and business hours come from the process wide cache, not from this report
+    data.metadata = store_metadata.get(db)
+    data.timezones = data.metadata.timezones
+    data.business_hours = data.metadata.hours
+
+    logger.info(
+        f"prefetched {rows} observations for {len(data.observations)} stores, "
+        f"{len(data.timezones)} timezones, {len(data.business_hours)} business hour sets"
+    )
+    return data
+
+
+class PrefetchTimeHandler(TimeHandler):
+    # same calculation as TimeHandler, but every lookup is served from PrefetchedData
+    def __init__(self, session, data: PrefetchedData, windows=DEFAULT_WINDOWS):
+        super().__init__(session, windows)
+        self.data = data
+        # same metadata snapshot the prefetch saw
+        self._metadata = data.metadata
+
+    @classmethod
+    def from_db(cls, db, reference_time_utc, store_ids=None, windows=DEFAULT_WINDOWS):
+        return cls(db, load_prefetched_data(db, reference_time_utc, store_ids, span=windows[-1].length), windows)
+
+    def get_week_observations(self, store_id, week_ago, reference_time_utc):
+        if week_ago < self.data.week_ago or reference_time_utc > self.data.reference_time_utc:
+            return super().get_week_observations(store_id, week_ago, reference_time_utc)
+        observations = self.data.observations.get(store_id) or ObservationBuffer()
+        if week_ago == self.data.week_ago and reference_time_utc == self.data.reference_time_utc:
+            return observations
+        # a shorter span inside the prefetched one is a view on the same buffer
+        return observations.window(week_ago, reference_time_utc)
+
+    def _get_previous_observation(self, store_id, before_time) -> Optional[StatusObservation]:
+        before_utc = before_time.astimezone(timezone.utc)
+        if before_utc > self.data.reference_time_utc:
+            return super()._get_previous_observation(store_id, before_time)
+
+        observations = self.data.observations.get(store_id) or ObservationBuffer()
+        idx = observations.before(before_utc)
+        if idx >= 0:
+            previous_observation = observations.row(idx)
+        elif before_utc >= self.data.week_ago:
+            previous_observation = self.data.carry_in.get(store_id)
+        else:
+            return super()._get_previous_observation(store_id, before_time)
+
+        if not previous_observation:
+            return None
+
+        local_time = self.utc_to_local(previous_observation.timestamp_utc, store_id)
+
+        return StatusObservation(
+            utc_time=previous_observation.timestamp_utc,
+            local_time=local_time,
+            status=previous_observation.status,
+            day=local_time.weekday()
+        )
@@ -0,0 +1,202 @@
+import csv
+import gzip
+import io
+import os
+import shutil
+from enum import Enum
+
+from .report_runner import FIELDNAMES, write_csv
+
+# rows per record batch for parquet / arrow, also how many rows are held while writing them
+BATCH_ROWS = 10_000
+
+
+class ReportFormat(str, Enum):
+    CSV = "csv"
+    CSV_GZIP = "csv.gz"
+    CSV_ZSTD = "csv.zst"
+    PARQUET = "parquet"
+    ARROW = "arrow"   # arrow ipc stream
+
+
+MEDIA_TYPES = {
+    ReportFormat.CSV: "text/csv",
+    ReportFormat.CSV_GZIP: "application/gzip",
+    ReportFormat.CSV_ZSTD: "application/zstd",
+    ReportFormat.PARQUET: "application/vnd.apache.parquet",
+    ReportFormat.ARROW: "application/vnd.apache.arrow.stream",
+}
+
+COMPRESSED_CSV = {ReportFormat.CSV_GZIP, ReportFormat.CSV_ZSTD}
+
+
+class FormatUnavailable(Exception):
+    pass
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise FormatUnavailable("parquet / arrow reports need pyarrow installed")
+    return pyarrow
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise FormatUnavailable("zstd reports need zstandard installed")
+    return zstandard
+
+
+def check_available(fmt):
+    if fmt in (ReportFormat.PARQUET, ReportFormat.ARROW):
+        _pyarrow()
+    elif fmt == ReportFormat.CSV_ZSTD:
+        _zstandard()
+
+
+def zstd_available():
+    try:
+        _zstandard()
+        return True
+    except FormatUnavailable:
+        return False
+
+
+def arrow_schema(pa, fieldnames=FIELDNAMES):
+    # store_id dictionary encoded, every metric a float64
+    return pa.schema([("store_id", pa.dictionary(pa.int32(), pa.string()))]
+                     + [(name, pa.float64()) for name in fieldnames[1:]])
+
+
+def _record_batch(pa, schema, rows):
+    arrays = [pa.array([str(row["store_id"]) for row in rows], pa.string()).dictionary_encode()]
+    arrays += [pa.array([float(row[name]) for row in rows], pa.float64()) for name in schema.names[1:]]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _batches(pa, schema, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_ROWS:
+            yield _record_batch(pa, schema, batch)
+            batch = []
+    if batch:
+        yield _record_batch(pa, schema, batch)
+
+
+def _open_text(path, fmt):
+    if fmt == ReportFormat.CSV_GZIP:
+        return gzip.open(path, "wt", newline="")
+    if fmt == ReportFormat.CSV_ZSTD:
+        return io.TextIOWrapper(_zstandard().ZstdCompressor().stream_writer(open(path, "wb")), newline="")
+    return open(path, "w", newline="")
+
+
+def write_report(rows, path, fmt=ReportFormat.CSV, fieldnames=FIELDNAMES):
+    # same contract as write_csv: rows written as they come, renamed into place when complete
+    if fmt == ReportFormat.CSV:
+        return write_csv(rows, path, fieldnames)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    part = path + ".part"
+    count = 0
+    try:
+        if fmt in COMPRESSED_CSV:
+            with _open_text(part, fmt) as f:
+                writer = csv.DictWriter(f, fieldnames=fieldnames)
+                writer.writeheader()
+                for row in rows:
+                    writer.writerow(row)
+                    count += 1
+        else:
+            pa = _pyarrow()
+            schema = arrow_schema(pa, fieldnames)
+            if fmt == ReportFormat.PARQUET:
+                writer = pa.parquet.ParquetWriter(part, schema)
+            else:
+                # the stream format, unlike the ipc file format, allows a new dictionary per batch
+                writer = pa.ipc.new_stream(part, schema)
+            with writer:
+                for batch in _batches(pa, schema, rows):
+                    writer.write_batch(batch)
+                    count += batch.num_rows
+        os.replace(part, path)
+    except BaseException:
+        if os.path.exists(part):
+            os.unlink(part)
+        raise
+    return count
+
+
+def read_rows(path, fmt=ReportFormat.CSV):
+    # report rows back as dicts, metrics as floats
+    if fmt in (ReportFormat.PARQUET, ReportFormat.ARROW):
+        pa = _pyarrow()
+        if fmt == ReportFormat.PARQUET:
+            batches = pa.parquet.ParquetFile(path).iter_batches(batch_size=BATCH_ROWS)
+        else:
+            batches = pa.ipc.open_stream(path)
+        for batch in batches:
+            yield from batch.to_pylist()
+        return
+
+    if fmt == ReportFormat.CSV_GZIP:
+        f = gzip.open(path, "rt", newline="")
+    elif fmt == ReportFormat.CSV_ZSTD:
+        f = io.TextIOWrapper(_zstandard().ZstdDecompressor().stream_reader(open(path, "rb")), newline="")
+    else:
+        f = open(path, newline="")
+    with f:
+        for row in csv.DictReader(f):
+            yield {name: value if name == "store_id" else float(value) for name, value in row.items()}
+
+
+def compress_file(source, path, fmt):
+    # csv -> csv.gz / csv.zst straight from the bytes on disk, no csv parsing
+    part = path + ".part"
+    try:
+        with open(source, "rb") as src:
+            if fmt == ReportFormat.CSV_GZIP:
+                with gzip.open(part, "wb", compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst)
+            else:
+                with open(part, "wb") as dst:
+                    _zstandard().ZstdCompressor().copy_stream(src, dst)
+        os.replace(part, path)
+    except BaseException:
+        if os.path.exists(part):
+            os.unlink(part)
+        raise
+    return path
+
+
+def negotiate_encoding(accept_encoding, codings=None):
+    # best content coding for a csv response from an Accept-Encoding header, None for identity.
+    # codings limits the choice (/metrics only has gzip), by default gzip and zstd when installed
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+
+    def quality(coding):
+        return accepted.get(coding, accepted.get("*", 0.0))
+
+    if codings is None:
+        codings = ("gzip", "zstd") if zstd_available() else ("gzip",)
+    # highest q wins, the later coding (zstd) on a tie
+    q, _, coding = max((quality(coding), rank, coding) for rank, coding in enumerate(codings))
+    return coding if q > 0 else None
@@ -0,0 +1,139 @@
+import logging
+import os
+import time as timer
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from enum import Enum
+
+from .create_report import SessionLocal
+from .report_runner import FIELDNAMES, ReportEngine, iter_report
+from .report_formats import COMPRESSED_CSV, ReportFormat, compress_file, read_rows, write_report
+from .report_store import ReportStore
+from .report_metrics import metrics_exposition
+from .instrumentation import TimedRows, instruments
+from .windows import DEFAULT_WINDOWS, fieldnames
+
+logger = logging.getLogger(__name__)
+
+# can use redis here
+class ReportStatus(Enum):
+    RUNNING = "Running"
+    COMPLETE = "Complete"
+    ERROR = "Error"
+
+# Global storage for report metadata, the csv files live in REPORTS_DIR
+reports_storage = ReportStore()
+
+
+class ReportJobExecutor:
+    # reports run on a bounded thread pool, each job with its own db session,
+    # so trigger_report returns straight away and the event loop stays free
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or int(os.getenv("REPORT_WORKERS", "2"))
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="report")
+        return self._pool
+
+    def submit(self, report_id, engine=ReportEngine.PER_STORE, parallel=False, workers=None, format=ReportFormat.CSV, reference_time=None, windows=DEFAULT_WINDOWS):
+        reports_storage[report_id] = {
+            "status": ReportStatus.RUNNING,
+            "created_at": datetime.utcnow(),
+            "started_at": None,
+            "path": None,
+            "format": format.value,
+            "files": {},
+            "error": None,
+            "engine": engine.value,
+            "parallel": parallel,
+            "stores_done": 0,
+            "total_stores": None,
+            "reference_time": reference_time,
+            "windows": [w.name for w in windows],
+            "fieldnames": fieldnames(windows)
+        }
+        return self.pool.submit(self._run, report_id, engine, parallel, workers, format, reference_time, windows)
+
+    def _run(self, report_id, engine, parallel=False, workers=None, format=ReportFormat.CSV, reference_time=None, windows=DEFAULT_WINDOWS):
+        report = reports_storage[report_id]
+        report["started_at"] = datetime.utcnow()
+
+        def progress(done, total):
+            report["stores_done"] = done
+            report["total_stores"] = total
+
+        db = SessionLocal()
+        try:
+            # rows are written to the file as they are computed, nothing is kept in memory
+            path = reports_storage.path_for(report_id, format.value)
+            started = timer.perf_counter()
+            report_rows = TimedRows(iter_report(db, engine, progress=progress, parallel=parallel, workers=workers, reference_time=reference_time, windows=windows))
+            rows = write_report(report_rows, path, format, report["fieldnames"])
+            elapsed = timer.perf_counter() - started
+            # whatever wasn't spent computing rows went into writing the file
+            instruments.report_stage_seconds.observe(elapsed - report_rows.seconds, engine=engine.value, stage="write")
+            instruments.report_duration_seconds.observe(elapsed, engine=engine.value, format=format.value)
+
+            # Update report status to complete
+            report["path"] = path
+            report["files"][format.value] = path
+            report["completed_at"] = datetime.utcnow()
+            report["total_stores"] = rows
+            report["status"] = ReportStatus.COMPLETE
+
+        except Exception as e:
+            # Update report status to error
+            report["status"] = ReportStatus.ERROR
+            report["error"] = str(e)
+            logger.exception(f"Error generating report {report_id}: {str(e)}")
+        finally:
+            db.close()
+            reports_storage.finished(report_id)
+
+        # the store gauges are hour / day / week, a report without those columns doesn't update them
+        if report["status"] == ReportStatus.COMPLETE and set(FIELDNAMES) <= set(report["fieldnames"]):
+            try:
+                metrics_exposition.publish(report["created_at"], read_rows(report["path"], format))
+            except Exception:
+                # the report itself is fine, /metrics just keeps the previous values
+                logger.exception(f"failed to publish metrics for report {report_id}")
+
+    def progress(self, report):
+        started_at = report.get("started_at")
+        if started_at is None:
+            return {"stores_done": 0, "total_stores": report["total_stores"], "elapsed_seconds": 0.0, "eta_seconds": None}
+
+        elapsed = (datetime.utcnow() - started_at).total_seconds()
+        done, total = report["stores_done"], report["total_stores"]
+        eta = None
+        if done and total:
+            eta = round(elapsed / done * (total - done), 1)
+        return {"stores_done": done, "total_stores": total, "elapsed_seconds": round(elapsed, 1), "eta_seconds": eta}
+
+    def export(self, report_id, report, format):
+        # path of a finished report in the given format, converted from the file the report
+        # was written in on first request and kept next to it (evicted together)
+        files = report["files"]
+        path = files.get(format.value)
+        if path and os.path.exists(path):
+            return path
+
+        path = reports_storage.path_for(report_id, format.value)
+        if format in COMPRESSED_CSV:
+            # compress the csv bytes, no need to go through rows
+            compress_file(self.export(report_id, report, ReportFormat.CSV), path, format)
+        else:
+            write_report(read_rows(report["path"], ReportFormat(report["format"])), path, format, report["fieldnames"])
+        files[format.value] = path
+        return path
+
+    def shutdown(self, wait=False):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait, cancel_futures=True)
+            self._pool = None
+
+
+report_jobs = ReportJobExecutor()
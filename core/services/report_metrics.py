@@ -0,0 +1,82 @@
+import logging
+import struct
+import threading
+import zlib
+
+from .instrumentation import instruments
+
+logger = logging.getLogger(__name__)
+
+# prometheus text format, starlette adds the charset
+CONTENT_TYPE = "text/plain; version=0.0.4"
+# deflate, no name / mtime, unknown os
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+# metric -> help, (period label, report column). last_hour values are minutes, like the report
+FAMILIES = (
+    ("store_uptime_hours", "Store uptime within business hours from the latest report (last_hour in minutes)",
+     (("last_hour", "uptime_last_hour"), ("last_day", "uptime_last_day"), ("last_week", "uptime_last_week"))),
+    ("store_downtime_hours", "Store downtime within business hours from the latest report (last_hour in minutes)",
+     (("last_hour", "downtime_last_hour"), ("last_day", "downtime_last_day"), ("last_week", "downtime_last_week"))),
+)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class MetricsExposition:
+    # the /metrics body is rendered once when a report completes and kept as bytes (plain and
+    # gzipped), so a scrape costs the same however many reports or stores there are.
+    # the series are those of the newest completed report (by trigger time): stores it doesn't
+    # have are dropped instead of being exported forever
+    def __init__(self):
+        self._series = {}
+        self._created_at = None
+        self._lock = threading.Lock()
+        self._cached = self._encode(self._render())
+
+    def publish(self, created_at, rows):
+        series = {row["store_id"]: row for row in rows}
+        with self._lock:
+            if self._created_at is not None and created_at < self._created_at:
+                # an older report finishing after a newer one
+                logger.info(f"metrics exposition kept, report from {created_at} is older than the published one")
+                return
+            self._series = series
+            self._created_at = created_at
+            self._cached = self._encode(self._render())
+        logger.info(f"metrics exposition rendered for {len(series)} stores")
+
+    def _render(self):
+        lines = []
+        for metric, help_text, periods in FAMILIES:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            for store_id, row in self._series.items():
+                for period, column in periods:
+                    lines.append(f'{metric}{{store_id="{_label(store_id)}",period="{period}"}} {row[column]}')
+        return "\n".join(lines) + "\n"
+
+    def _encode(self, text):
+        # the gzip member is left open after the store series: a scrape appends the live
+        # instrumentation (see instrumentation.py) to a copy of the compressor instead of
+        # compressing the whole body again
+        body = text.encode()
+        deflate = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return body, deflate.compress(body), deflate, zlib.crc32(body)
+
+    def body(self, gzipped=False):
+        plain, head, deflate, crc = self._cached
+        live = instruments.render().encode()
+        if not gzipped:
+            return plain + live
+        deflate = deflate.copy()
+        size = len(plain) + len(live)
+        return b"".join((
+            GZIP_HEADER, head, deflate.compress(live), deflate.flush(),
+            struct.pack("<II", zlib.crc32(live, crc), size & 0xffffffff),
+        ))
+
+
+metrics_exposition = MetricsExposition()
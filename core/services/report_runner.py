@@ -0,0 +1,156 @@
+import csv
+import io
+import logging
+import os
+import time as timer
+from datetime import datetime, timezone
+from enum import Enum
+
+from ..db.models.store_status import StoreStatus
+from .create_report import TimeHandler
+from .prefetch import PrefetchTimeHandler
+from .vectorized import VectorizedTimeHandler
+from .incremental import IncrementalTimeHandler
+from .sql_engine import SqlTimeHandler
+from .rollup import RollupTimeHandler
+from .instrumentation import ReportTimings
+from .windows import DEFAULT_WINDOWS, fieldnames
+
+logger = logging.getLogger(__name__)
+
+# columns of the default hour / day / week report, other windows get their own (see windows.py)
+FIELDNAMES = fieldnames(DEFAULT_WINDOWS)
+
+
+class ReportEngine(str, Enum):
+    PER_STORE = "per_store"   # queries the db store by store
+    BULK = "bulk"             # prefetches the whole week in a few set based queries
+    VECTORIZED = "vectorized" # bulk prefetch + numpy over all stores at once
+    INCREMENTAL = "incremental" # rolling business time sums kept up to date at ingest time
+    SQL = "sql"               # one report query computed in the database (postgres)
+    ROLLUP = "rollup"         # store_status_hourly rows, raw observations only for the edge hours
+
+
+def _reference_time(timestamp):
+    if timestamp:
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return timestamp
+    else:
+        return datetime.now(timezone.utc)
+
+
+def current_time(db):
+    result = db.query(StoreStatus.timestamp_utc).order_by( StoreStatus.timestamp_utc.desc()).first()
+    return _reference_time(result[0] if result else None)
+
+
+def generate_csv(report_data):
+
+    output = io.StringIO()
+
+    writer = csv.DictWriter(output, fieldnames=FIELDNAMES)
+    writer.writeheader()
+
+    for row in report_data:
+        writer.writerow(row)
+    return output.getvalue()
+
+
+def time_handler_for(engine, db, reference_time, store_ids=None, windows=DEFAULT_WINDOWS):
+    if engine == ReportEngine.BULK:
+        return PrefetchTimeHandler.from_db(db, reference_time, store_ids, windows)
+    if engine == ReportEngine.VECTORIZED:
+        return VectorizedTimeHandler.from_db(db, reference_time, store_ids, windows)
+    if engine == ReportEngine.INCREMENTAL:
+        return IncrementalTimeHandler(db, windows)
+    if engine == ReportEngine.SQL:
+        return SqlTimeHandler.from_db(db, reference_time, store_ids, windows)
+    if engine == ReportEngine.ROLLUP:
+        return RollupTimeHandler.from_db(db, reference_time, store_ids, windows)
+    return TimeHandler(db, windows)
+
+
+def report_row(store_id, metrics, windows=DEFAULT_WINDOWS):
+    row = {"store_id": store_id}
+    for name in fieldnames(windows)[1:]:
+        row[name] = round(metrics.get(name, 0.0), 2)
+    return row
+
+
+def iter_rows(db, engine, store_ids, reference_time, progress=None, time_handler=None, timings=None, windows=DEFAULT_WINDOWS):
+    # timings collects stage and per store times for the caller to publish
+    if timings is None:
+        timings = ReportTimings()
+    if time_handler is None:
+        with timings.stage("fetch"):
+            time_handler = time_handler_for(engine, db, reference_time, windows=windows)
+    time_handler.timings = timings
+    for done, store_id in enumerate(store_ids, 1):
+        started = timer.perf_counter()
+        try:
+            metrics = time_handler.calculate_store_metrics(store_id, reference_time)
+            row = report_row(store_id, metrics, windows)
+
+        except Exception as e:
+            row = report_row(store_id, {}, windows)
+            timings.errors += 1
+            logger.exception(f"Error calculating metrics for store {store_id}: {str(e)}")
+        timings.store(store_id, timer.perf_counter() - started)
+
+        yield row
+
+        if progress:
+            progress(done, len(store_ids))
+
+
+def compute_rows(db, engine, store_ids, reference_time, progress=None, time_handler=None, timings=None, windows=DEFAULT_WINDOWS):
+    return list(iter_rows(db, engine, store_ids, reference_time, progress=progress, time_handler=time_handler, timings=timings, windows=windows))
+
+
+def iter_report(db, engine=ReportEngine.PER_STORE, progress=None, parallel=False, workers=None, reference_time=None, windows=DEFAULT_WINDOWS):
+    # yields report rows as stores are computed.
+    # progress(stores_done, total_stores) is called as the report moves along.
+    # reference_time defaults to the latest observation.
+    # stage / per store timings go to the /metrics instruments when the rows run out
+    timings = ReportTimings()
+    with timings.stage("store_ids"):
+        if reference_time is None:
+            reference_time = current_time(db)
+        store_ids = [row[0] for row in db.query(StoreStatus.store_id).distinct().all()]
+    if progress:
+        progress(0, len(store_ids))
+
+    try:
+        # the rolling state lives in this process, sharding it out makes no sense
+        if parallel and engine != ReportEngine.INCREMENTAL:
+            from .parallel_report import compute_rows_parallel
+            yield from compute_rows_parallel(engine, store_ids, reference_time, workers=workers, progress=progress, timings=timings, windows=windows)
+            return
+        yield from iter_rows(db, engine, store_ids, reference_time, progress=progress, timings=timings, windows=windows)
+    finally:
+        timings.publish(engine.value)
+
+
+def build_report(db, engine=ReportEngine.PER_STORE, progress=None, parallel=False, workers=None, reference_time=None, windows=DEFAULT_WINDOWS):
+    return list(iter_report(db, engine, progress=progress, parallel=parallel, workers=workers, reference_time=reference_time, windows=windows))
+
+
+def write_csv(rows, path, fieldnames=FIELDNAMES):
+    # rows go to disk one at a time, under a temporary name until the report is complete
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    part = path + ".part"
+    count = 0
+    try:
+        with open(part, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        os.replace(part, path)
+    except BaseException:
+        if os.path.exists(part):
+            os.unlink(part)
+        raise
+    return count
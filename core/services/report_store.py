@@ -0,0 +1,90 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+REPORTS_DIR = os.getenv("REPORTS_DIR", "reports")
+# finished reports kept around, least recently fetched go first
+REPORT_MAX_KEPT = int(os.getenv("REPORT_MAX_KEPT", "100"))
+# ... and none older than this
+REPORT_TTL_SECONDS = int(os.getenv("REPORT_TTL_SECONDS", str(24 * 3600)))
+
+
+class ReportStore:
+    # report metadata only, the csv itself is written to REPORTS_DIR while the report runs.
+    # behaves like the dict it replaces; finished reports are evicted (file included) by
+    # count (LRU on get_report access) and age, running ones are never touched
+    def __init__(self, directory=REPORTS_DIR, max_reports=REPORT_MAX_KEPT, ttl_seconds=REPORT_TTL_SECONDS):
+        self.directory = directory
+        self.max_reports = max_reports
+        self.ttl_seconds = ttl_seconds
+        self._reports = OrderedDict()
+        self._finished_at = {}
+        self._lock = threading.Lock()
+
+    def path_for(self, report_id, extension="csv"):
+        return os.path.join(self.directory, f"store_report_{report_id}.{extension}")
+
+    def __contains__(self, report_id):
+        with self._lock:
+            self._evict()
+            return report_id in self._reports
+
+    def __getitem__(self, report_id):
+        with self._lock:
+            report = self._reports[report_id]
+            self._reports.move_to_end(report_id)
+            return report
+
+    def get(self, report_id, default=None):
+        # lookup and eviction under one lock: a report evicted in between is simply not found
+        with self._lock:
+            self._evict()
+            report = self._reports.get(report_id)
+            if report is None:
+                return default
+            self._reports.move_to_end(report_id)
+            return report
+
+    def __setitem__(self, report_id, report):
+        with self._lock:
+            self._reports[report_id] = report
+            self._reports.move_to_end(report_id)
+            self._evict()
+
+    def __len__(self):
+        return len(self._reports)
+
+    def items(self):
+        with self._lock:
+            return list(self._reports.items())
+
+    def finished(self, report_id):
+        # starts the ttl clock, called once the report is complete or failed
+        with self._lock:
+            self._finished_at[report_id] = time.monotonic()
+            self._evict()
+
+    def _evict(self):
+        now = time.monotonic()
+        expired = [report_id for report_id, at in self._finished_at.items() if now - at > self.ttl_seconds]
+        # oldest access first, only finished reports count against the limit
+        finished = [report_id for report_id in self._reports if report_id in self._finished_at]
+        overflow = finished[:max(0, len(finished) - self.max_reports)]
+        for report_id in set(expired) | set(overflow):
+            self._remove(report_id)
+
+    def _remove(self, report_id):
+        report = self._reports.pop(report_id, None)
+        self._finished_at.pop(report_id, None)
+        # the report file plus any other formats it was converted to
+        paths = {report.get("path"), *report.get("files", {}).values()} if report else set()
+        for path in paths - {None}:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        logger.info(f"evicted report {report_id}")
@@ -0,0 +1,429 @@
+from __future__ import annotations
+import csv
+import io
+import logging
+import time as timer
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import timedelta, timezone
+from typing import Dict, List, Optional
+
+from sqlalchemy import BigInteger, bindparam, cast, delete, extract, insert, select, text
+
+from ..db.models.store_status import StoreStatus
+from ..db.models.store_status_hourly import StoreStatusHourly
+from .carry_in import last_status_before
+from .create_report import TimeHandler
+from .metadata_cache import StoreMetadata, store_metadata
+from .observations import US_PER_HOUR, ObservationBuffer, STATUSES, epoch_us, from_epoch_us, is_active, status_code
+from .prefetch import PrefetchTimeHandler, _only, _stream, load_prefetched_data
+from .schedule import LOCAL_EPOCH, US_PER_DAY, US_PER_MINUTE, local_us
+from .windows import DEFAULT_WINDOWS, window_metrics
+
+logger = logging.getLogger(__name__)
+
+# rollup rows per insert statement / COPY call
+WRITE_BATCH_SIZE = 50000
+_HOUR = timedelta(hours=1)
+
+
+def _local_datetime(us):
+    return LOCAL_EPOCH + timedelta(microseconds=us)
+
+
+def _local(zone, t):
+    # utc us -> wall clock us in the zone
+    return local_us(from_epoch_us(t).astimezone(zone))
+
+
+def hour_rows(store_id, buffer, zone, schedule):
+    # store_status_hourly rows of one store, out of its observations (ObservationBuffer).
+    # same walk as TimeHandler.sweep_uptime_downtime, cut at every local hour: an observation
+    # holds its status until the next one or the end of its hour, whatever follows is added
+    # at report time
+    local = buffer.local_us(zone)
+    contains = schedule.contains_us
+    business = [i for i, t in enumerate(local) if contains(t)]
+    business.sort(key=local.__getitem__)
+    times = [local[i] for i in business]
+    codes = [buffer.codes[i] for i in business]
+    flags = [is_active(code) for code in range(len(STATUSES))]
+    before = schedule.business_us_before
+
+    rows = []
+    n = len(business)
+    i = 0
+    while i < n:
+        hour = times[i] // US_PER_HOUR
+        hour_end = (hour + 1) * US_PER_HOUR
+        held = [0, 0]  # inactive, active
+        j = i
+        # business time before the current observation, reused as the previous one's end
+        since = before(times[i])
+        while j < n and times[j] < hour_end:
+            until = before(times[j + 1] if j + 1 < n and times[j + 1] < hour_end else hour_end)
+            held[flags[codes[j]]] += until - since
+            since = until
+            j += 1
+        rows.append((store_id, _local_datetime(hour * US_PER_HOUR), j - i, _local_datetime(times[i]),
+                     STATUSES[codes[i]], held[1], held[0], STATUSES[codes[j - 1]]))
+        i = j
+    return rows
+
+
+def _write(db, rows, table):
+    columns = [column.name for column in table.columns]
+    if db.bind.dialect.name == "postgresql":
+        # COPY, like DataLoader's store_status loads
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        cursor = db.connection().connection.dbapi_connection.cursor()
+        cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    else:
+        db.execute(insert(table), [dict(zip(columns, row)) for row in rows])
+
+
+def _first_hour(zone, changed_us):
+    # local hour (wall clock us) the rebuild of a store starts at: the hour before the one the
+    # earliest changed observation falls in, the carry-in into it
+    return (_local(zone, changed_us) // US_PER_HOUR - 1) * US_PER_HOUR
+
+
+def _by_store(rows, epoch, reads_from):
+    # (store_id, observations) per store out of rows ordered by store_id, the ones before the
+    # store's reads_from left out
+    current, buffer, start = None, None, None
+    for store_id, timestamp_utc, status in rows:
+        if store_id != current:
+            if buffer:
+                yield current, buffer
+            current, buffer, start = store_id, ObservationBuffer(), reads_from.get(store_id)
+        if epoch:
+            if start is None or timestamp_utc >= start:
+                buffer.append_us(timestamp_utc, status)
+        elif start is None or epoch_us(timestamp_utc) >= start:
+            buffer.append(timestamp_utc, status)
+    if buffer:
+        yield current, buffer
+
+
+def rebuild_rollup(db, store_ids=None, source=None, table=None, metadata=None, since=None):
+    # recomputes store_status_hourly for the given stores (every store by default) from
+    # store_status, in one transaction: reports keep the old rows until it commits.
+    # a bulk load passes its staging copies of both tables and the metadata it staged.
+    # since (store_id -> earliest timestamp_utc written, after an append or a merge) limits it
+    # to those stores and to the hours from the one before that timestamp on: a row only holds
+    # the observations of its own local hour, the older ones can't have changed
+    started = timer.perf_counter()
+    metadata = metadata if metadata is not None else store_metadata.get(db)
+    source = source if source is not None else StoreStatus.__table__
+    table = table if table is not None else StoreStatusHourly.__table__
+    first_hours = {}
+    if since is not None:
+        store_ids = list(since)
+        for store_id, timestamp_utc in since.items():
+            try:
+                first_hours[store_id] = _first_hour(metadata.zone(store_id), epoch_us(timestamp_utc))
+            except Exception:
+                # bad timezone, the store's rows are all dropped below
+                first_hours[store_id] = None
+
+    # postgres hands back epoch microseconds, no datetime per row
+    epoch = db.bind.dialect.name == "postgresql"
+    timestamp = cast(extract("epoch", source.c.timestamp_utc) * 1_000_000, BigInteger) if epoch else source.c.timestamp_utc
+    stmt = select(source.c.store_id, timestamp, source.c.status).order_by(source.c.store_id, source.c.timestamp_utc)
+    # observations from two utc hours before the first rebuilt local hour cover it, even across
+    # a dst fall back
+    reads_from = {store_id: epoch_us(since[store_id]) // US_PER_HOUR * US_PER_HOUR - 3 * US_PER_HOUR for store_id in first_hours}
+    if reads_from:
+        stmt = stmt.where(source.c.timestamp_utc >= from_epoch_us(min(reads_from.values())))
+
+    written = 0
+    stores = 0
+    skipped = 0
+    try:
+        if store_ids is None and db.bind.dialect.name == "postgresql":
+            # no dead rows left behind, same as the COPY loads
+            db.execute(text(f"TRUNCATE TABLE {table.name}"))
+        elif first_hours:
+            whole = [store_id for store_id, hour in first_hours.items() if hour is None]
+            tails = [{"s": store_id, "h": _local_datetime(hour)} for store_id, hour in first_hours.items() if hour is not None]
+            if whole:
+                db.execute(delete(table).where(table.c.store_id.in_(whole)))
+            if tails:
+                db.execute(delete(table).where(table.c.store_id == bindparam("s"), table.c.hour_local >= bindparam("h")), tails)
+        else:
+            db.execute(_only(delete(table), table.c.store_id, store_ids))
+        # the source rows come ordered by store_id, each store's hours are written before the
+        # next store is read: one store's history in memory, not the fleet's
+        batch = []
+        observed = _stream(db, _only(stmt, source.c.store_id, store_ids))
+        for store_id, buffer in _by_store(observed, epoch, reads_from):
+            stores += 1
+            try:
+                zone = metadata.zone(store_id)
+            except Exception:
+                # bad timezone, reports fail on the store anyway
+                skipped += 1
+                continue
+            rows = hour_rows(store_id, buffer, zone, metadata.schedule(store_id))
+            if store_id in first_hours:
+                first = _local_datetime(first_hours[store_id])
+                rows = [row for row in rows if row[1] >= first]
+            batch.extend(rows)
+            if len(batch) >= WRITE_BATCH_SIZE:
+                _write(db, batch, table)
+                written += len(batch)
+                batch = []
+        if batch:
+            _write(db, batch, table)
+            written += len(batch)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    logger.info(f"{table.name}: {written} rows for {stores - skipped} stores "
+                f"({skipped} skipped) in {timer.perf_counter() - started:.2f}s")
+    return written
+
+
+def rollup_missing(db, store_ids=None):
+    # observations but no rollup: the tables were filled some other way than DataLoader
+    rolled = db.execute(_only(select(StoreStatusHourly.store_id), StoreStatusHourly.store_id, store_ids).limit(1)).first()
+    return rolled is None and db.execute(_only(select(StoreStatus.store_id), StoreStatus.store_id, store_ids).limit(1)).first() is not None
+
+
+def _edge_ranges(reference_time_utc, windows):
+    # utc ranges whose raw observations a report needs: the hour after every window start
+    # (the start's partial hour is inside it) and the hour before the reference time
+    since = reference_time_utc - windows[-1].length
+    ranges = sorted([(reference_time_utc - w.length, min(reference_time_utc - w.length + _HOUR, reference_time_utc)) for w in windows]
+                    + [(max(reference_time_utc - _HOUR, since), reference_time_utc)])
+    merged = [list(ranges[0])]
+    for lo, hi in ranges[1:]:
+        if lo <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    return [tuple(r) for r in merged]
+
+
+@dataclass
+class RollupData:
+    reference_time_utc: object
+    # store_id -> rollup rows (hour, observations, first us, first code, active us, inactive us,
+    # last code) in hour order, wall clock microseconds
+    rows: Dict[str, list] = field(default_factory=lambda: defaultdict(list))
+    # (lo, hi, store_id -> ObservationBuffer, store_id -> StoreRow before lo) per edge range
+    edges: List[tuple] = field(default_factory=list)
+    metadata: Optional[StoreMetadata] = None
+
+
+def load_rollup_data(db, reference_time_utc, store_ids=None, windows=DEFAULT_WINDOWS):
+    # rollup rows of the longest window and the raw observations of the edge hours only
+    data = RollupData(reference_time_utc=reference_time_utc)
+    since = reference_time_utc - windows[-1].length
+    # local hours sit within a day of the utc ones
+    lo = since.astimezone(timezone.utc).replace(tzinfo=None) - timedelta(days=1)
+    hi = reference_time_utc.astimezone(timezone.utc).replace(tzinfo=None) + timedelta(days=1)
+    hourly = StoreStatusHourly
+    stmt = select(
+        hourly.store_id, hourly.hour_local, hourly.observations, hourly.first_local, hourly.first_status,
+        hourly.active_us, hourly.inactive_us, hourly.last_status
+    ).where(hourly.hour_local >= lo, hourly.hour_local <= hi).order_by(hourly.store_id, hourly.hour_local)
+    count = 0
+    for store_id, hour, observations, first, first_status, active_us, inactive_us, last_status in _stream(db, _only(stmt, hourly.store_id, store_ids)):
+        data.rows[store_id].append((local_us(hour) // US_PER_HOUR, observations, local_us(first), status_code(first_status),
+                                    active_us, inactive_us, status_code(last_status)))
+        count += 1
+
+    raw = 0
+    for lo, hi in _edge_ranges(reference_time_utc, windows):
+        stmt = select(StoreStatus.store_id, StoreStatus.timestamp_utc, StoreStatus.status).where(
+            StoreStatus.timestamp_utc >= lo, StoreStatus.timestamp_utc <= hi
+        ).order_by(StoreStatus.store_id, StoreStatus.timestamp_utc)
+        buffers = defaultdict(ObservationBuffer)
+        for store_id, timestamp_utc, status in _stream(db, _only(stmt, StoreStatus.store_id, store_ids)):
+            buffers[store_id].append(timestamp_utc, status)
+            raw += 1
+        data.edges.append((epoch_us(lo), epoch_us(hi), buffers, last_status_before(db, lo, hi, store_ids, stream=_stream)))
+
+    data.metadata = store_metadata.get(db)
+    logger.info(f"rollup: {count} hourly rows for {len(data.rows)} stores, {raw} raw observations in "
+                f"{len(data.edges)} edge ranges")
+    return data
+
+
+def fall_back_between(zone, lo, hi):
+    # utc offset going down somewhere in [lo, hi] (utc us): wall clock times repeat there and
+    # local order stops following utc order. offsets never change twice within a day
+    previous = None
+    t = lo
+    while True:
+        offset = _local(zone, t) - t
+        if previous is not None and offset < previous:
+            return True
+        previous = offset
+        if t >= hi:
+            return False
+        t = min(t + US_PER_DAY, hi)
+
+
+class RollupTimeHandler(TimeHandler):
+    # windows from store_status_hourly plus the raw observations of their partial edge hours.
+    # stores the rollup can't answer exactly (a dst fall back near the report, a window holding
+    # a single observation that isn't at an edge, nothing observed in business hours) are
+    # computed from one bulk prefetch of just those stores
+    def __init__(self, session, data: RollupData, windows=DEFAULT_WINDOWS):
+        super().__init__(session, windows)
+        self.data = data
+        self._metadata = data.metadata
+        self._metrics = None
+        self._errors = {}
+        self._fallback = None
+
+    @classmethod
+    def from_db(cls, db, reference_time_utc, store_ids=None, windows=DEFAULT_WINDOWS):
+        # a report never writes (its session is the read replica when there is one): without a
+        # rollup it is the bulk engine's report
+        if rollup_missing(db, store_ids):
+            logger.warning("store_status_hourly is empty, the rollup report is computed from raw observations. "
+                           "build it on the primary: DataLoader does after every upload, or rollup.rebuild_rollup")
+            return PrefetchTimeHandler.from_db(db, reference_time_utc, store_ids, windows)
+        return cls(db, load_rollup_data(db, reference_time_utc, store_ids, windows), windows)
+
+    def _edge_observations(self, store_id, zone, schedule):
+        # business observations of the edge ranges in utc order: (utc, local, code, code of the
+        # observation before it in utc order or None)
+        observations = []
+        for _, _, buffers, carry_in in self.data.edges:
+            buffer = buffers.get(store_id)
+            if not buffer:
+                continue
+            previous = carry_in.get(store_id)
+            previous = status_code(previous.status) if previous else None
+            for i, t in enumerate(buffer.local_us(zone)):
+                code = buffer.codes[i]
+                if schedule.contains_us(t):
+                    observations.append((buffer.utc_us[i], t, code, previous))
+                previous = code
+        return observations
+
+    def _store_metrics(self, store_id):
+        # window metrics of one store, None when it has to go through the fallback
+        reference = epoch_us(self.data.reference_time_utc)
+        lengths = [w.length // timedelta(microseconds=1) for w in self.windows]
+        zone = self.get_zone(store_id)
+        if fall_back_between(zone, reference - lengths[-1] - 2 * US_PER_HOUR, reference + 2 * US_PER_HOUR):
+            return None
+        schedule = self.get_schedule(store_id)
+        before = schedule.business_us_before
+        flags = [is_active(code) for code in range(len(STATUSES))]
+        edges = self._edge_observations(store_id, zone, schedule)
+        rows = self.data.rows.get(store_id, [])
+        row_hours = [row[0] for row in rows]
+
+        def held(a, b):
+            return before(b) - before(a) if a < b else 0
+
+        end = _local(zone, reference)
+        end_hour = end // US_PER_HOUR
+        results = []
+        for w, length in enumerate(lengths):
+            since = reference - length
+            start = _local(zone, since)
+            start_hour = start // US_PER_HOUR
+            total = held(start, end)
+            if start_hour == end_hour:
+                leading = [e for e in edges if since <= e[0] <= reference]
+                trailing, interior = [], []
+            else:
+                leading = [e for e in edges if since <= e[0] and e[1] < (start_hour + 1) * US_PER_HOUR]
+                trailing = [e for e in edges if e[1] >= end_hour * US_PER_HOUR and e[0] <= reference]
+                interior = rows[bisect_right(row_hours, start_hour):bisect_left(row_hours, end_hour)]
+            count = len(leading) + len(trailing) + sum(row[1] for row in interior)
+
+            if count == 0 and w == len(lengths) - 1:
+                # no business observation at all, maybe no observation at all
+                return None
+            if total == 0:
+                up = down = 0
+            elif count == 0:
+                # no data = assume everything is down
+                up, down = 0, total
+            elif count == 1:
+                # single observation: split at it when the previous one had another status
+                if interior:
+                    return None
+                _, t, code, previous = (leading or trailing)[0]
+                if previous is not None and previous != code:
+                    mins_before = held(start, t)
+                    up, down = total - mins_before, mins_before
+                    if not flags[code]:
+                        up, down = down, up
+                else:
+                    up, down = (total, 0) if flags[code] else (0, total)
+            else:
+                # every observation holds its status until the next one, the first one also
+                # covers the stretch before it; whole hours come from the rollup rows
+                held_by = [0, 0]  # inactive, active
+                pos, code = (leading[0][1], leading[0][2]) if leading else \
+                    (interior[0][2], interior[0][3]) if interior else (trailing[0][1], trailing[0][2])
+                held_by[flags[code]] += held(start, pos)
+                for _, t, next_code, _ in leading:
+                    held_by[flags[code]] += held(pos, t)
+                    pos, code = t, next_code
+                for hour, _, first, _, active_us, inactive_us, last_code in interior:
+                    held_by[flags[code]] += held(pos, first)
+                    held_by[1] += active_us
+                    held_by[0] += inactive_us
+                    pos, code = (hour + 1) * US_PER_HOUR, last_code
+                for _, t, next_code, _ in trailing:
+                    held_by[flags[code]] += held(pos, t)
+                    pos, code = t, next_code
+                held_by[flags[code]] += held(pos, end)
+                up, down = held_by[1], held_by[0]
+            results.append((up / US_PER_MINUTE, down / US_PER_MINUTE))
+        return window_metrics(self.windows, results)
+
+    def _compute(self):
+        metrics = {}
+        fallback = []
+        stores = set(self.data.rows)
+        for _, _, buffers, _ in self.data.edges:
+            stores.update(buffers)
+        with self.timings.stage("uptime"):
+            for store_id in sorted(stores):
+                try:
+                    result = self._store_metrics(store_id)
+                except Exception as e:
+                    self._errors[store_id] = e
+                    continue
+                if result is None:
+                    fallback.append(store_id)
+                else:
+                    metrics[store_id] = result
+        if fallback:
+            logger.info(f"rollup: {len(fallback)} of {len(stores)} stores computed from raw observations")
+            with self.timings.stage("fetch"):
+                data = load_prefetched_data(self.db, self.data.reference_time_utc, fallback, span=self.windows[-1].length)
+            self._fallback = PrefetchTimeHandler(self.db, data, self.windows)
+            self._fallback.timings = self.timings
+        self._metrics = metrics
+
+    def calculate_store_metrics(self, store_id, reference_time_utc):
+        if reference_time_utc != self.data.reference_time_utc:
+            return super().calculate_store_metrics(store_id, reference_time_utc)
+        if self._metrics is None:
+            self._compute()
+        if store_id in self._errors:
+            raise self._errors[store_id]
+        if store_id in self._metrics:
+            return self._metrics[store_id]
+        if self._fallback is not None and store_id in self._fallback.data.observations:
+            return self._fallback.calculate_store_metrics(store_id, reference_time_utc)
+        # no rollup row and nothing raw near the edges: same as no observation in the
+        # longest window, unless it has some in the middle of it
+        return super().calculate_store_metrics(store_id, reference_time_utc)
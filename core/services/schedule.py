@@ -0,0 +1,86 @@
+from __future__ import annotations
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from typing import List
+
+US_PER_MINUTE = 60_000_000
+US_PER_DAY = 86_400_000_000
+US_PER_WEEK = 7 * US_PER_DAY
+# 1970-01-01 was a thursday, so week boundaries (monday 00:00) sit 4 days into the epoch
+WEEK_ORIGIN = 4 * US_PER_DAY
+LOCAL_EPOCH = datetime(1970, 1, 1)
+
+
+def local_us(local_timestamp):
+    # wall clock of a local datetime as naive microseconds. utc offsets are ignored on
+    # purpose, same as comparing two datetimes that share a ZoneInfo
+    return (local_timestamp.replace(tzinfo=None) - LOCAL_EPOCH) // timedelta(microseconds=1)
+
+
+def time_to_us(t):
+    return ((t.hour * 60 + t.minute) * 60 + t.second) * 1_000_000 + t.microsecond
+
+
+class WeeklySchedule:
+    # a store's business hours compiled into one sorted, merged list of periods over a
+    # monday-based week, plus the business time before each period starts. midnight
+    # crossing periods run into the next day (sunday night wraps into monday).
+    def __init__(self, starts: List[int], ends: List[int]):
+        self.starts = starts
+        self.ends = ends
+        self.cumulative = []
+        total = 0
+        for start, end in zip(starts, ends):
+            self.cumulative.append(total)
+            total += end - start
+        self.week_total = total
+
+    @classmethod
+    def compile(cls, business_hours):
+        periods = []
+        for bh in business_hours:
+            start = bh.day * US_PER_DAY + time_to_us(bh.start_time)
+            end = (bh.day + (1 if bh.crosses_midnight else 0)) * US_PER_DAY + time_to_us(bh.end_time)
+            if end <= start:
+                continue
+            if end > US_PER_WEEK:
+                periods.append((start, US_PER_WEEK))
+                periods.append((0, end - US_PER_WEEK))
+            else:
+                periods.append((start, end))
+
+        periods.sort()
+        starts, ends = [], []
+        for start, end in periods:
+            if ends and start <= ends[-1]:
+                # overlapping periods count once
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        return cls(starts, ends)
+
+    def _locate(self, t):
+        weeks, offset = divmod(t - WEEK_ORIGIN, US_PER_WEEK)
+        return weeks, offset, bisect_right(self.starts, offset) - 1
+
+    def business_us_before(self, t):
+        weeks, offset, i = self._locate(t)
+        within = 0
+        if i >= 0:
+            within = self.cumulative[i] + min(offset, self.ends[i]) - self.starts[i]
+        return weeks * self.week_total + within
+
+    def minutes(self, start_local, end_local):
+        start, end = local_us(start_local), local_us(end_local)
+        if start >= end:
+            return 0.0
+        return (self.business_us_before(end) - self.business_us_before(start)) / US_PER_MINUTE
+
+    def contains(self, local_timestamp):
+        return self.contains_us(local_us(local_timestamp))
+
+    def contains_us(self, t):
+        # inclusive on both ends, like is_within_business_hours
+        _, offset, i = self._locate(t)
+        return i >= 0 and offset <= self.ends[i]
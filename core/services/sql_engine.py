@@ -0,0 +1,285 @@
+from __future__ import annotations
+import logging
+from typing import Dict
+
+from sqlalchemy import text
+
+from .create_report import TimeHandler
+from .metadata_cache import DEFAULT_TIMEZONE
+from .schedule import US_PER_DAY, US_PER_MINUTE, US_PER_WEEK, WEEK_ORIGIN
+from .windows import DEFAULT_WINDOWS, empty_metrics
+
+logger = logging.getLogger(__name__)
+
+# LEAD / LATERAL / AT TIME ZONE / pg_timezone_names
+DIALECT = "postgresql"
+
+
+def available(bind):
+    return bind.dialect.name == DIALECT
+
+
+def _us(expr):
+    # naive timestamp / time -> wall clock microseconds, the same numbers as schedule.local_us
+    return f"(extract(epoch FROM {expr}) * 1000000)::bigint"
+
+
+def _offset(t):
+    # position of a wall clock time in its monday based week
+    return f"(({t}) - {WEEK_ORIGIN}) % {US_PER_WEEK}"
+
+
+def _covers(schedule, t):
+    return f"{_offset(t)} >= {schedule}.lo AND {_offset(t)} < {schedule}.hi"
+
+
+def _business_before(schedule, t):
+    # WeeklySchedule.business_us_before, with the schedule row covering t
+    return (f"(({t}) - {WEEK_ORIGIN}) / {US_PER_WEEK} * {schedule}.week_us + {schedule}.before_us"
+            f" + least({_offset(t)}, {schedule}.end_us) - {schedule}.start_us")
+
+
+def report_sql(windows, store_ids=None):
+    # TimeHandler.sweep_uptime_downtime for every store and window in one statement.
+    # the WeeklySchedule of each store is built as a table (periods over a monday based week,
+    # merged, with the business time before each one), business time up to a local time is
+    # one range join against it, and every business observation holds its status until the
+    # LEAD() one. result: store_id, known (its timezone exists) and the report columns
+    longest = len(windows) - 1
+    window_rows = ",\n            ".join(
+        f"({i}, CAST(:start_{i} AS timestamptz), {'true' if i == longest else 'false'})"
+        for i in range(len(windows))
+    )
+    only = "AND s.store_id = ANY(:store_ids)" if store_ids is not None else ""
+    columns = []
+    for i, w in enumerate(windows):
+        columns.append(f'max(r.up_us) FILTER (WHERE r.w = {i})::float8 / {US_PER_MINUTE} / {w.scale}::float8 AS "{w.uptime}"')
+    for i, w in enumerate(windows):
+        columns.append(f'max(r.down_us) FILTER (WHERE r.w = {i})::float8 / {US_PER_MINUTE} / {w.scale}::float8 AS "{w.downtime}"')
+    columns = ",\n        ".join(columns)
+
+    return f"""
+    WITH windows (w, start_utc, longest) AS (
+        VALUES
+            {window_rows}
+    ),
+    observed AS (
+        -- the longest window, with the status right before each observation in utc order
+        SELECT s.store_id, s.timestamp_utc, s.status,
+               lag(s.status) OVER (PARTITION BY s.store_id ORDER BY s.timestamp_utc) AS prev_status
+        FROM store_status s
+        WHERE s.timestamp_utc >= :since AND s.timestamp_utc <= :ref {only}
+    ),
+    zoned AS (
+        SELECT o.store_id, coalesce(tz.timezone_str, :default_timezone) AS tz,
+               coalesce(tz.timezone_str, :default_timezone) IN (SELECT name FROM pg_timezone_names) AS known
+        FROM (SELECT DISTINCT store_id FROM observed) o
+        LEFT JOIN store_timezones tz ON tz.store_id = o.store_id
+    ),
+    carry_in AS (
+        -- status carried into the longest window, for its first observation
+        SELECT z.store_id, c.status
+        FROM zoned z
+        CROSS JOIN LATERAL (
+            SELECT p.status FROM store_status p
+            WHERE p.store_id = z.store_id AND p.timestamp_utc < :since
+            ORDER BY p.timestamp_utc DESC LIMIT 1
+        ) c
+    ),
+    hours AS (
+        -- days without rows are open 00:00 - 23:59:59, like to_business_hours
+        SELECT h.store_id, h.day_of_week AS day, h.start_time_local AS start_time, h.end_time_local AS end_time
+        FROM store_business_hours h JOIN zoned z ON z.store_id = h.store_id
+        UNION ALL
+        SELECT z.store_id, d.day, TIME '00:00:00', TIME '23:59:59'
+        FROM zoned z CROSS JOIN generate_series(0, 6) AS d (day)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM store_business_hours h WHERE h.store_id = z.store_id AND h.day_of_week = d.day
+        )
+    ),
+    periods AS (
+        -- midnight crossing hours run into the next day
+        SELECT store_id, start_us, end_us FROM (
+            SELECT store_id,
+                   day * {US_PER_DAY}::bigint + {_us('start_time')} AS start_us,
+                   (day + CASE WHEN end_time < start_time THEN 1 ELSE 0 END) * {US_PER_DAY}::bigint + {_us('end_time')} AS end_us
+            FROM hours
+        ) p
+        WHERE end_us > start_us
+    ),
+    week_periods AS (
+        -- sunday night wraps into monday
+        SELECT store_id, start_us, least(end_us, {US_PER_WEEK}::bigint) AS end_us FROM periods
+        UNION ALL
+        SELECT store_id, 0, end_us - {US_PER_WEEK} FROM periods WHERE end_us > {US_PER_WEEK}
+    ),
+    islands AS (
+        -- overlapping periods count once
+        SELECT store_id, start_us, end_us,
+               sum(opens) OVER (PARTITION BY store_id ORDER BY start_us, end_us ROWS UNBOUNDED PRECEDING) AS island
+        FROM (
+            SELECT store_id, start_us, end_us,
+                   CASE WHEN start_us <= max(end_us) OVER (
+                       PARTITION BY store_id ORDER BY start_us, end_us ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                   ) THEN 0 ELSE 1 END AS opens
+            FROM week_periods
+        ) flagged
+    ),
+    merged AS (
+        SELECT store_id, min(start_us) AS start_us, max(end_us) AS end_us
+        FROM islands GROUP BY store_id, island
+    ),
+    schedule AS (
+        -- a period covers the week offsets up to the next one's start, an extra row covers
+        -- the offsets before the first period. every row carries the store's weekly total
+        SELECT store_id, start_us AS lo, coalesce(lead(start_us) OVER p, {US_PER_WEEK}) AS hi, start_us, end_us,
+               coalesce(sum(end_us - start_us) OVER (p ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0)::bigint AS before_us,
+               sum(end_us - start_us) OVER (PARTITION BY store_id)::bigint AS week_us,
+               true AS open
+        FROM merged
+        WINDOW p AS (PARTITION BY store_id ORDER BY start_us)
+        UNION ALL
+        SELECT z.store_id, 0, coalesce(min(m.start_us), {US_PER_WEEK}), 0, 0, 0,
+               coalesce(sum(m.end_us - m.start_us), 0)::bigint, false
+        FROM zoned z LEFT JOIN merged m ON m.store_id = z.store_id
+        GROUP BY z.store_id
+    ),
+    local AS MATERIALIZED (
+        -- converted once, not once per schedule row it's matched against
+        SELECT o.store_id, o.timestamp_utc, o.status, coalesce(o.prev_status, c.status) AS prev_status,
+               {_us('o.timestamp_utc AT TIME ZONE z.tz')} AS t
+        FROM observed o
+        JOIN zoned z ON z.store_id = o.store_id AND z.known
+        LEFT JOIN carry_in c ON c.store_id = o.store_id
+    ),
+    located AS (
+        -- observations in business hours (WeeklySchedule.contains) with the business time before them
+        SELECT l.*, {_business_before('s', 'l.t')} AS b
+        FROM local l
+        JOIN schedule s ON s.store_id = l.store_id AND {_covers('s', 'l.t')}
+        WHERE s.open AND {_offset('l.t')} <= s.end_us
+    ),
+    business AS (
+        -- in local order like the list TimeHandler sorts
+        SELECT store_id, timestamp_utc, t, b, status, prev_status,
+               lower(status) = 'active' AS active,
+               lead(t) OVER o AS next_t,
+               lead(b) OVER o AS next_b
+        FROM located
+        WINDOW o AS (PARTITION BY store_id ORDER BY t, timestamp_utc)
+    ),
+    edges AS (
+        SELECT z.store_id, w.w, w.longest,
+               {_us('w.start_utc AT TIME ZONE z.tz')} AS start_t,
+               {_us('CAST(:ref AS timestamptz) AT TIME ZONE z.tz')} AS end_t
+        FROM zoned z CROSS JOIN windows w
+        WHERE z.known
+    ),
+    bounds AS (
+        SELECT *, CASE WHEN start_t < end_t THEN end_b - start_b ELSE 0 END AS total
+        FROM (
+            SELECT e.*, {_business_before('s', 'e.start_t')} AS start_b, {_business_before('f', 'e.end_t')} AS end_b
+            FROM edges e
+            JOIN schedule s ON s.store_id = e.store_id AND {_covers('s', 'e.start_t')}
+            JOIN schedule f ON f.store_id = e.store_id AND {_covers('f', 'e.end_t')}
+        ) e
+    ),
+    in_window AS (
+        -- the longest window takes every observation, the others the ones from their start
+        SELECT b.store_id, b.w, o.t, o.status, o.prev_status, o.active,
+               count(*) OVER ws AS n,
+               row_number() OVER (ws ORDER BY o.t, o.timestamp_utc) AS rn,
+               -- business time the observation holds until the next one or the end, from the start at the earliest
+               CASE WHEN greatest(o.t, b.start_t) < CASE WHEN o.next_t IS NULL THEN b.end_t ELSE least(o.next_t, b.end_t) END
+                    THEN CASE WHEN o.next_t IS NULL THEN b.end_b ELSE least(o.next_b, b.end_b) END
+                         - CASE WHEN o.t >= b.start_t THEN o.b ELSE b.start_b END
+                    ELSE 0 END AS held,
+               CASE WHEN b.start_t < o.t THEN o.b - b.start_b ELSE 0 END AS lead_in
+        FROM bounds b
+        JOIN business o ON o.store_id = b.store_id AND (b.longest OR o.t >= b.start_t)
+        WINDOW ws AS (PARTITION BY b.store_id, b.w)
+    ),
+    per_window AS (
+        SELECT b.store_id, b.w, b.total,
+               count(i.t) AS n,
+               -- two or more: the first observation also covers the stretch before it
+               coalesce(sum(CASE WHEN i.active THEN i.held + CASE WHEN i.rn = 1 THEN i.lead_in ELSE 0 END ELSE 0 END), 0) AS up_multi,
+               coalesce(sum(CASE WHEN i.active THEN 0 ELSE i.held + CASE WHEN i.rn = 1 THEN i.lead_in ELSE 0 END END), 0) AS down_multi,
+               -- just one: split at it when the previous observation had another status
+               bool_or(i.active) AS single_active,
+               bool_or(i.prev_status IS NOT NULL AND i.prev_status <> i.status) AS single_split,
+               max(i.lead_in) AS single_before
+        FROM bounds b
+        LEFT JOIN in_window i ON i.store_id = b.store_id AND i.w = b.w
+        GROUP BY b.store_id, b.w, b.total
+    ),
+    results AS (
+        SELECT store_id, w,
+               CASE WHEN total = 0 OR n = 0 THEN 0
+                    WHEN n = 1 AND single_split THEN CASE WHEN single_active THEN total - single_before ELSE single_before END
+                    WHEN n = 1 THEN CASE WHEN single_active THEN total ELSE 0 END
+                    ELSE up_multi END AS up_us,
+               CASE WHEN total = 0 THEN 0
+                    WHEN n = 0 THEN total
+                    WHEN n = 1 AND single_split THEN CASE WHEN single_active THEN single_before ELSE total - single_before END
+                    WHEN n = 1 THEN CASE WHEN single_active THEN 0 ELSE total END
+                    ELSE down_multi END AS down_us
+        FROM per_window
+    )
+    SELECT z.store_id, z.tz, z.known,
+        {columns}
+    FROM zoned z
+    LEFT JOIN results r ON r.store_id = z.store_id
+    GROUP BY z.store_id, z.tz, z.known
+    """
+
+
+def run_report_query(db, reference_time_utc, store_ids=None, windows=DEFAULT_WINDOWS):
+    # store_id -> report metrics (or the error for stores in an unknown timezone), for every
+    # store observed in the longest window
+    params = {
+        "ref": reference_time_utc,
+        "since": reference_time_utc - windows[-1].length,
+        "default_timezone": DEFAULT_TIMEZONE,
+    }
+    for i, w in enumerate(windows):
+        params[f"start_{i}"] = reference_time_utc - w.length
+    if store_ids is not None:
+        params["store_ids"] = list(store_ids)
+
+    metrics: Dict[str, dict] = {}
+    errors: Dict[str, str] = {}
+    names = [w.uptime for w in windows] + [w.downtime for w in windows]
+    for row in db.execute(text(report_sql(windows, store_ids)), params).mappings():
+        if not row["known"]:
+            errors[row["store_id"]] = f"unknown timezone {row['tz']!r}"
+            continue
+        metrics[row["store_id"]] = {name: row[name] for name in names}
+    logger.info(f"sql engine: {len(metrics)} stores computed, {len(errors)} in unknown timezones")
+    return metrics, errors
+
+
+class SqlTimeHandler(TimeHandler):
+    # serves calculate_store_metrics from one report query run in the database, no
+    # observations are loaded into python. TimeHandler stays the reference (and the fallback
+    # for any other reference time)
+    def __init__(self, session, reference_time_utc, metrics, errors, windows=DEFAULT_WINDOWS):
+        super().__init__(session, windows)
+        self.reference_time_utc = reference_time_utc
+        self._metrics = metrics
+        self._errors = errors
+
+    @classmethod
+    def from_db(cls, db, reference_time_utc, store_ids=None, windows=DEFAULT_WINDOWS):
+        if not available(db.bind):
+            raise ValueError(f"engine=sql needs a {DIALECT} database, not {db.bind.dialect.name}")
+        metrics, errors = run_report_query(db, reference_time_utc, store_ids, windows)
+        return cls(db, reference_time_utc, metrics, errors, windows)
+
+    def calculate_store_metrics(self, store_id, reference_time_utc):
+        if reference_time_utc != self.reference_time_utc:
+            return super().calculate_store_metrics(store_id, reference_time_utc)
+        if store_id in self._errors:
+            raise ValueError(self._errors[store_id])
+        # no observation in the longest window
+        return self._metrics.get(store_id) or empty_metrics(self.windows)
@@ -0,0 +1,222 @@
+from __future__ import annotations
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from .instrumentation import ReportTimings
+from .observations import STATUSES, epoch_us, is_active as active_code, status_code
+from .prefetch import PrefetchTimeHandler, PrefetchedData
+from .schedule import US_PER_MINUTE, US_PER_WEEK, WEEK_ORIGIN
+from .windows import DEFAULT_WINDOWS, empty_metrics, window_metrics
+
+logger = logging.getLogger(__name__)
+
+# everything below works on int64 microseconds. local times are naive wall clock
+# microseconds, which is what TimeHandler ends up comparing too (see schedule.local_us)
+def to_local_us(utc_us, tz):
+    idx = pd.DatetimeIndex(np.asarray(utc_us, dtype=np.int64).astype("datetime64[us]"))
+    return idx.tz_localize("UTC").tz_convert(tz).tz_localize(None).as_unit("us").asi8
+
+
+class ScheduleArrays:
+    # the WeeklySchedule of every store flattened into one sorted array with a store
+    # group key, so minutes/contains run for many (store, time) pairs at once
+    def __init__(self, schedules):
+        counts = np.array([len(s.starts) for s in schedules], dtype=np.int64)
+        g = np.repeat(np.arange(len(schedules), dtype=np.int64), counts)
+        # one trailing sentinel so lookups never index an empty array
+        self.starts = np.array([x for s in schedules for x in s.starts] + [0], dtype=np.int64)
+        self.ends = np.array([x for s in schedules for x in s.ends] + [0], dtype=np.int64)
+        self.cumulative = np.array([x for s in schedules for x in s.cumulative] + [0], dtype=np.int64)
+        self.totals = np.array([s.week_total for s in schedules], dtype=np.int64)
+        self.keys = np.r_[g * US_PER_WEEK + self.starts[:-1], len(schedules) * US_PER_WEEK]
+        self.group_start = np.r_[0, np.cumsum(counts)[:-1]]
+
+    def _locate(self, g, t):
+        weeks, offset = np.divmod(t - WEEK_ORIGIN, US_PER_WEEK)
+        i = np.searchsorted(self.keys, g * US_PER_WEEK + offset, side="right") - 1
+        found = i >= self.group_start[g]
+        return weeks, offset, np.where(found, i, len(self.starts) - 1), found
+
+    def business_us_before(self, g, t):
+        weeks, offset, i, found = self._locate(g, t)
+        within = np.where(found, self.cumulative[i] + np.minimum(offset, self.ends[i]) - self.starts[i], 0)
+        return weeks * self.totals[g] + within
+
+    def contains(self, g, t):
+        _, offset, i, found = self._locate(g, t)
+        return found & (offset <= self.ends[i])
+
+    def minutes(self, g, a, b):
+        g = np.asarray(g, dtype=np.int64)
+        a = np.asarray(a, dtype=np.int64)
+        b = np.asarray(b, dtype=np.int64)
+        return np.where(a < b, self.business_us_before(g, b) - self.business_us_before(g, a), 0)
+
+
+class VectorizedEngine:
+    def __init__(self, data: PrefetchedData, timings=None, windows=DEFAULT_WINDOWS):
+        self.data = data
+        self.windows = windows
+        self.errors: Dict[str, str] = {}
+        self.timings = timings if timings is not None else ReportTimings()
+
+    def _timezones(self, stores):
+        zones = {}
+        for store_id in stores:
+            try:
+                zones[store_id] = self.data.metadata.zone(store_id)
+            except Exception as e:
+                self.errors[store_id] = str(e)
+        return zones
+
+    def compute(self, store_ids) -> Dict[str, dict]:
+        data = self.data
+        windows = self.windows
+        results = {store_id: empty_metrics(windows) for store_id in store_ids if not data.observations.get(store_id)}
+
+        candidates = [store_id for store_id in store_ids if data.observations.get(store_id)]
+        zones = self._timezones(candidates)
+        stores: List[str] = [store_id for store_id in candidates if store_id in zones]
+        if not stores:
+            return results
+        store_count = len(stores)
+
+        stage = self.timings.stage
+        # raw observations as flat arrays with a group key, ordered by (store, utc), read
+        # straight out of the ObservationBuffers
+        buffers = [data.observations[s] for s in stores]
+        counts = np.array([len(b) for b in buffers], dtype=np.int64)
+        g_raw = np.repeat(np.arange(store_count, dtype=np.int64), counts)
+        utc_us = np.concatenate([np.frombuffer(b.utc_us, dtype=np.int64) for b in buffers])
+        codes = np.concatenate([np.frombuffer(b.codes, dtype=np.uint8) for b in buffers])
+        # -1 -> no previous observation
+        carry_code = np.array([status_code(data.carry_in[s].status) if s in data.carry_in else -1 for s in stores], dtype=np.int16)
+        is_active = np.array([active_code(code) for code in range(len(STATUSES))], dtype=bool)
+
+        # status of the observation right before each one, in utc order (= _get_previous_observation)
+        first_raw = np.r_[True, g_raw[1:] != g_raw[:-1]]
+        prev_code = np.r_[-1, codes[:-1]].astype(np.int16)
+        prev_code[first_raw] = carry_code[g_raw[first_raw]]
+
+        with stage("timezone"):
+            # local wall clock for observations and window edges, one conversion per timezone
+            reference_utc = epoch_us(data.reference_time_utc)
+            window_utc = [epoch_us(data.reference_time_utc - w.length) for w in windows]
+            local_us = np.empty_like(utc_us)
+            end_local = np.empty(store_count, dtype=np.int64)
+            start_local = [np.empty(store_count, dtype=np.int64) for _ in windows]
+
+            store_zone = pd.Series([zones[s].key for s in stores])
+            for key, members in store_zone.groupby(store_zone).groups.items():
+                members = np.asarray(members, dtype=np.int64)
+                zone = zones[stores[members[0]]]
+                rows = np.isin(g_raw, members)
+                local_us[rows] = to_local_us(utc_us[rows], zone)
+                edges = to_local_us([reference_utc] + window_utc, zone)
+                end_local[members] = edges[0]
+                for i in range(len(windows)):
+                    start_local[i][members] = edges[i + 1]
+
+        with stage("business_hours"):
+            schedules = ScheduleArrays([
+                data.metadata.schedule(store_id) for store_id in stores
+            ])
+            minutes = schedules.minutes
+            in_business = schedules.contains(g_raw, local_us)
+
+            # business observations ordered by local time within a store (stable, like list.sort)
+            biz = np.flatnonzero(in_business)
+            biz = biz[np.lexsort((local_us[biz], g_raw[biz]))]
+
+        with stage("uptime"):
+            # the longest window takes every prefetched observation, like TimeHandler
+            output = [
+                self._window(
+                    minutes, store_count, start_local[i], end_local,
+                    g_raw[biz], local_us[biz], codes[biz], prev_code[biz], is_active,
+                    all_in_window=(i == len(windows) - 1)
+                )
+                for i in range(len(windows))
+            ]
+
+            for g, store_id in enumerate(stores):
+                results[store_id] = window_metrics(windows, [
+                    (up[g] / US_PER_MINUTE, down[g] / US_PER_MINUTE) for up, down in output
+                ])
+        return results
+
+    def _window(self, minutes, store_count, start, end, g, local, code, prev, is_active, all_in_window):
+        # uptime / downtime of every store for one window (TimeHandler.sweep_uptime_downtime)
+        everyone = np.arange(store_count, dtype=np.int64)
+        total = minutes(everyone, start, end)
+        up = np.zeros(store_count, dtype=np.int64)
+        down = total.copy()  # no observations -> down the whole time
+
+        if not all_in_window:
+            keep = local >= start[g]
+            g, local, code, prev = g[keep], local[keep], code[keep], prev[keep]
+        count = np.bincount(g, minlength=store_count)
+
+        if len(g):
+            active = is_active[code]
+            first = np.r_[True, g[1:] != g[:-1]]
+            last = np.r_[g[1:] != g[:-1], True]
+
+            # two or more observations: every observation holds its status until the next one,
+            # the first one also covers the stretch before it
+            multi = count[g] >= 2
+            seg_start = np.maximum(start[g], local)
+            seg_end = np.where(last, end[g], np.minimum(np.r_[local[1:], 0], end[g]))
+            seg = minutes(g, seg_start, seg_end)
+            lead = np.where(first, minutes(g, start[g], local), 0)
+            seg = np.where(multi, seg + lead, 0)
+            up_multi = np.bincount(g, weights=np.where(active, seg, 0), minlength=store_count)
+            down_multi = np.bincount(g, weights=np.where(active, 0, seg), minlength=store_count)
+
+            # single observation: split at the observation if the previous one disagrees
+            single = count[g] == 1
+            sg = g[single]
+            o_active = active[single]
+            split = (prev[single] >= 0) & (prev[single] != code[single])
+            before = minutes(sg, start[sg], local[single])
+            after = total[sg] - before
+            whole = total[sg]
+            single_up = np.where(split, np.where(o_active, after, before), np.where(o_active, whole, 0))
+            single_down = np.where(split, np.where(o_active, before, after), np.where(o_active, 0, whole))
+
+            has_multi = count >= 2
+            up[has_multi] = up_multi[has_multi].astype(np.int64)
+            down[has_multi] = down_multi[has_multi].astype(np.int64)
+            up[sg] = single_up
+            down[sg] = single_down
+
+        no_business_time = total == 0
+        up[no_business_time] = 0
+        down[no_business_time] = 0
+        return up, down
+
+
+class VectorizedTimeHandler(PrefetchTimeHandler):
+    # serves calculate_store_metrics from one VectorizedEngine pass over every store
+    def __init__(self, session, data: PrefetchedData, windows=DEFAULT_WINDOWS):
+        super().__init__(session, data, windows)
+        self._metrics = None
+        self._engine = None
+
+    def calculate_store_metrics(self, store_id, reference_time_utc):
+        if reference_time_utc != self.data.reference_time_utc:
+            return super().calculate_store_metrics(store_id, reference_time_utc)
+
+        if self._metrics is None:
+            self._engine = VectorizedEngine(self.data, self.timings, self.windows)
+            self._metrics = self._engine.compute(list(self.data.observations))
+
+        if store_id in self._engine.errors:
+            raise ValueError(self._engine.errors[store_id])
+        if store_id not in self._metrics:
+            return super().calculate_store_metrics(store_id, reference_time_utc)
+        return self._metrics[store_id]
@@ -0,0 +1,78 @@
+import os
+import re
+from dataclasses import dataclass
+from datetime import timedelta
+
+UNITS = {"m": timedelta(minutes=1), "h": timedelta(hours=1), "d": timedelta(days=1), "w": timedelta(weeks=1)}
+# the original report columns keep their names (uptime_last_hour, ...)
+NAMED = {timedelta(hours=1): "hour", timedelta(days=1): "day", timedelta(weeks=1): "week"}
+# longest trailing window a report may ask for, it's also how much history gets read
+MAX_WINDOW = timedelta(days=int(os.getenv("REPORT_MAX_WINDOW_DAYS", "31")))
+
+_SPEC = re.compile(r"^(\d+)([mhdw])$")
+
+
+@dataclass(frozen=True)
+class Window:
+    name: str
+    length: timedelta
+
+    @property
+    def scale(self):
+        # like the original report: an hour or less in minutes, longer windows in hours
+        return 1.0 if self.length <= timedelta(hours=1) else 60.0
+
+    @property
+    def uptime(self):
+        return f"uptime_last_{self.name}"
+
+    @property
+    def downtime(self):
+        return f"downtime_last_{self.name}"
+
+
+DEFAULT_WINDOWS = (
+    Window("hour", timedelta(hours=1)),
+    Window("day", timedelta(days=1)),
+    Window("week", timedelta(weeks=1)),
+)
+
+
+def parse_windows(spec):
+    # "15m,1h,6h,1d,7d,30d" -> Windows sorted by length, duplicates (1d / 24h) dropped.
+    # raises ValueError on anything else
+    windows = {}
+    for part in spec.split(","):
+        part = part.strip().lower()
+        if not part:
+            continue
+        match = _SPEC.match(part)
+        if not match or int(match.group(1)) == 0:
+            raise ValueError(f"bad window {part!r}, expected e.g. 15m, 6h, 1d or 2w")
+        length = int(match.group(1)) * UNITS[match.group(2)]
+        if length > MAX_WINDOW:
+            raise ValueError(f"window {part!r} is longer than {MAX_WINDOW.days} days")
+        windows.setdefault(length, Window(NAMED.get(length, part), length))
+    if not windows:
+        raise ValueError("no windows given")
+    return tuple(windows[length] for length in sorted(windows))
+
+
+def fieldnames(windows=DEFAULT_WINDOWS):
+    return ["store_id"] + [w.uptime for w in windows] + [w.downtime for w in windows]
+
+
+def empty_metrics(windows=DEFAULT_WINDOWS):
+    metrics = {w.uptime: 0.0 for w in windows}
+    metrics.update({w.downtime: 0.0 for w in windows})
+    return metrics
+
+
+def window_metrics(windows, results):
+    # (uptime minutes, downtime minutes) per window -> report values in the window's unit
+    metrics = {}
+    for w, (up, _) in zip(windows, results):
+        metrics[w.uptime] = up / w.scale
+    for w, (_, down) in zip(windows, results):
+        metrics[w.downtime] = down / w.scale
+    return metrics
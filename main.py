@@ -3,6 +3,7 @@ import uvicorn
 
 from core.db.database import create_tables
 from core.routes.endpoints import router
+from core.services.report_jobs import report_jobs
 
 app = FastAPI(title="Store Monitoring API")
 
@@ -12,6 +13,10 @@ app.include_router(router, prefix="/api/v1")
 async def startup():
     create_tables()
 
+@app.on_event("shutdown")
+async def shutdown():
+    report_jobs.shutdown()
+
 @app.get("/")
 async def root():
     return {
@@ -0,0 +1,71 @@
+import os
+import tempfile
+
+import pytest
+
+# engines are created from DATABASE_URL on import, so the test database is picked before
+# anything from core is imported. TEST_DATABASE_URL runs the suite on another database
+# (its tables are replaced)
+_WORKDIR = tempfile.mkdtemp(prefix="store-monitoring-tests-")
+os.environ["DATABASE_URL"] = os.getenv("TEST_DATABASE_URL", f"sqlite:///{os.path.join(_WORKDIR, 'test.db')}")
+
+from benchmarks.generate import generate  # noqa: E402
+
+# a small fleet with every business hours shape, missing metadata and many timezones
+FLEET = dict(stores=40, polls_per_hour=1.0, days=9, timezones=20, missing_hours=0.2, missing_timezone=0.15, seed=11)
+
+
+@pytest.fixture(scope="session")
+def fleet_files():
+    files = generate(os.path.join(_WORKDIR, "fleet"), **FLEET)
+    return {name: path for name, (path, _) in files.items()}
+
+
+@pytest.fixture(scope="session")
+def loaded_db(fleet_files):
+    from core.db.database import SessionLocal, create_tables
+    from core.services.data_loader import DataLoader
+
+    create_tables()
+    db = SessionLocal()
+    loader = DataLoader(db)
+    loader.load_store_status(fleet_files["store_status"])
+    loader.load_business_hours(fleet_files["business_hours"])
+    loader.load_timezones(fleet_files["timezones"])
+    yield db
+    db.close()
+
+
+@pytest.fixture(scope="session")
+def store_ids(loaded_db):
+    from core.db.models.store_status import StoreStatus
+    return sorted(row[0] for row in loaded_db.query(StoreStatus.store_id).distinct())
+
+
+@pytest.fixture(scope="session")
+def latest(loaded_db):
+    from core.services.report_runner import current_time
+    return current_time(loaded_db)
+
+
+@pytest.fixture
+def empty_db(tmp_path):
+    # a sqlite database of its own for tests that load into it. the metadata cache and the
+    # rolling state are process wide, they're dropped on the way in and out
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+    from core.db.database import Base
+    from core.services.incremental import rolling_uptime
+    from core.services.metadata_cache import store_metadata
+
+    # a short busy timeout, a locked database shows up in a test run's time otherwise
+    engine = create_engine(f"sqlite:///{tmp_path / 'empty.db'}", connect_args={"timeout": 0.2})
+    Base.metadata.create_all(bind=engine)
+    store_metadata.invalidate()
+    rolling_uptime.reset()
+    session = Session(bind=engine)
+    yield session
+    session.close()
+    engine.dispose()
+    store_metadata.invalidate()
+    rolling_uptime.reset()
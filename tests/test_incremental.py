@@ -0,0 +1,38 @@
+from datetime import timedelta
+
+import pytest
+
+from benchmarks.parity import compare_engines
+from core.services.create_report import TimeHandler
+from core.services.incremental import IncrementalTimeHandler, rolling_uptime
+from core.services.observations import epoch_us
+from core.services.windows import DEFAULT_WINDOWS
+
+
+@pytest.mark.parametrize("hours_back", [0, 13, 47, 100])
+def test_matches_per_store(loaded_db, store_ids, latest, hours_back):
+    # a report pinned before the newest observation must not see the sums / tail after it
+    rolling_uptime.reset()
+    reference_time = latest - timedelta(hours=hours_back)
+    mismatches = compare_engines(loaded_db, ["incremental"], reference_time, DEFAULT_WINDOWS, store_ids)
+    assert mismatches["incremental"] == []
+
+
+@pytest.mark.parametrize("hours_back", [0, 13, 100])
+def test_every_store_answered_from_the_state(loaded_db, store_ids, latest, hours_back):
+    # the rolling state itself gives the per_store row, no store is handed back to TimeHandler
+    rolling_uptime.reset()
+    reference_time = latest - timedelta(hours=hours_back)
+    IncrementalTimeHandler(loaded_db).calculate_store_metrics(store_ids[0], reference_time)
+    handler = TimeHandler(loaded_db)
+    for store_id in store_ids:
+        expected = handler.calculate_store_metrics(store_id, reference_time)
+        assert rolling_uptime.metrics(handler, store_id, reference_time) == expected, store_id
+
+
+def test_past_reference_first_leaves_live_state_complete(loaded_db, store_ids, latest):
+    # a cold state bootstrapped by a past report still covers everything up to the newest row
+    rolling_uptime.reset()
+    compare_engines(loaded_db, ["incremental"], latest - timedelta(hours=30), DEFAULT_WINDOWS, store_ids[:1])
+    assert rolling_uptime.ready
+    assert max(state.utc[-1] for state in rolling_uptime.states.values()) == epoch_us(latest)
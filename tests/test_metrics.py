@@ -0,0 +1,31 @@
+import gzip
+from datetime import datetime
+
+from core.services.report_formats import negotiate_encoding
+from core.services.report_metrics import MetricsExposition
+from core.services.windows import DEFAULT_WINDOWS, fieldnames
+
+
+def _row(store_id):
+    return {column: 1.0 for column in fieldnames(DEFAULT_WINDOWS)} | {"store_id": store_id}
+
+
+def test_newest_report_replaces_the_series():
+    exposition = MetricsExposition()
+    exposition.publish(datetime(2024, 10, 2), [_row("a"), _row("b")])
+    exposition.publish(datetime(2024, 10, 3), [_row("a")])
+    # finished late, older than what's published
+    exposition.publish(datetime(2024, 10, 1), [_row("c")])
+    body = exposition.body().decode()
+    assert 'store_id="a"' in body
+    assert 'store_id="b"' not in body
+    assert 'store_id="c"' not in body
+    assert gzip.decompress(exposition.body(gzipped=True)) == exposition.body()
+
+
+def test_gzip_negotiation_honours_q_values():
+    assert negotiate_encoding("gzip;q=0", codings=("gzip",)) is None
+    assert negotiate_encoding("GZIP; q=0.0, identity", codings=("gzip",)) is None
+    assert negotiate_encoding("deflate, gzip;q=0.5", codings=("gzip",)) == "gzip"
+    assert negotiate_encoding("*", codings=("gzip",)) == "gzip"
+    assert negotiate_encoding(None, codings=("gzip",)) is None
@@ -0,0 +1,41 @@
+from datetime import timedelta
+
+import pytest
+
+from benchmarks.parity import _row, compare_engines
+from core.services.create_report import TimeHandler
+from core.services.incremental import rolling_uptime
+from core.services.offline_report import compute_offline
+from core.services.report_runner import ReportEngine
+from core.services.windows import DEFAULT_WINDOWS, parse_windows
+
+# the engines that must give the per_store report row for row, at any reference time
+EXACT = ["bulk", "vectorized", "rollup"]
+WINDOWS = {"default": DEFAULT_WINDOWS, "custom": parse_windows("15m,6h,1d,30d")}
+
+
+@pytest.mark.parametrize("windows", WINDOWS.values(), ids=WINDOWS.keys())
+@pytest.mark.parametrize("hours_back", [0, 13, 100])
+def test_engines_match_per_store(loaded_db, store_ids, latest, windows, hours_back):
+    reference_time = latest - timedelta(hours=hours_back)
+    mismatches = compare_engines(loaded_db, EXACT, reference_time, windows, store_ids)
+    assert mismatches == {engine: [] for engine in EXACT}
+
+
+@pytest.mark.parametrize("hours_back", [0, 13, 100])
+def test_incremental_matches_per_store(loaded_db, store_ids, latest, hours_back):
+    # default windows only, the incremental engine answers up to a week
+    rolling_uptime.reset()
+    reference_time = latest - timedelta(hours=hours_back)
+    assert compare_engines(loaded_db, ["incremental"], reference_time, DEFAULT_WINDOWS, store_ids) == {"incremental": []}
+
+
+@pytest.mark.parametrize("engine", [ReportEngine.BULK, ReportEngine.VECTORIZED])
+@pytest.mark.parametrize("hours_back", [0, 47])
+def test_offline_matches_per_store(loaded_db, store_ids, latest, fleet_files, engine, hours_back):
+    # the report straight from the csvs is the one the loaded database gives
+    reference_time = latest - timedelta(hours=hours_back)
+    rows = compute_offline(fleet_files["store_status"], fleet_files["business_hours"], fleet_files["timezones"],
+                           engine=engine, reference_time=reference_time, workers=1)
+    handler = TimeHandler(loaded_db)
+    assert rows == [_row(handler, store_id, reference_time, DEFAULT_WINDOWS) for store_id in store_ids]
@@ -0,0 +1,13 @@
+from core.services.report_store import ReportStore
+
+
+def test_get_misses_an_evicted_report(tmp_path):
+    store = ReportStore(directory=str(tmp_path), ttl_seconds=0)
+    store["done"] = {"path": None, "files": {}}
+    store["running"] = {"path": None, "files": {}}
+    assert store.get("done") is not None
+    store.finished("done")
+    # past the ttl: gone on the next lookup, no KeyError in between
+    assert store.get("done") is None
+    assert store.get("running") is not None
+    assert store.get("missing") is None
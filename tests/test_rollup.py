@@ -0,0 +1,112 @@
+import pandas as pd
+import pytest
+from sqlalchemy import select
+
+from benchmarks.parity import compare_engines
+from core.db.models.store_status_hourly import StoreStatusHourly
+from core.services.data_loader import DataLoader, LoadMode
+from core.services.prefetch import PrefetchTimeHandler
+from core.services.report_runner import ReportEngine, current_time, time_handler_for
+from core.services.rollup import rebuild_rollup
+from core.services.windows import DEFAULT_WINDOWS
+
+
+@pytest.fixture
+def db(empty_db):
+    return empty_db
+
+
+def _rollup(db):
+    table = StoreStatusHourly.__table__
+    return db.execute(select(table).order_by(table.c.store_id, table.c.hour_local)).all()
+
+
+def _rebuilt(db):
+    # what a full rebuild gives on the same rows
+    rebuild_rollup(db)
+    return _rollup(db)
+
+
+def _split(fleet_files, tmp_path):
+    # the status file cut two days before its end: (older rows, newer rows)
+    status = pd.read_csv(fleet_files["store_status"])
+    cut = pd.to_datetime(status["timestamp_utc"].str.removesuffix(" UTC")).max() - pd.Timedelta(days=2)
+    newer = pd.to_datetime(status["timestamp_utc"].str.removesuffix(" UTC")) >= cut
+    paths = tmp_path / "older.csv", tmp_path / "newer.csv"
+    status[~newer].to_csv(paths[0], index=False)
+    status[newer].to_csv(paths[1], index=False)
+    return paths
+
+
+def test_append_rebuilds_the_new_hours(db, fleet_files, tmp_path):
+    older, newer = _split(fleet_files, tmp_path)
+    loader = DataLoader(db)
+    loader.load_business_hours(fleet_files["business_hours"])
+    loader.load_timezones(fleet_files["timezones"])
+    loader.load_store_status(older)
+    loader.load_store_status(newer, mode=LoadMode.APPEND)
+    assert _rollup(db) == _rebuilt(db)
+
+
+def test_merge_rebuilds_from_the_earliest_change(db, fleet_files, tmp_path):
+    loader = DataLoader(db)
+    loader.load_business_hours(fleet_files["business_hours"])
+    loader.load_timezones(fleet_files["timezones"])
+    loader.load_store_status(fleet_files["store_status"])
+    # flip a past stretch of statuses of a few stores
+    status = pd.read_csv(fleet_files["store_status"])
+    changed = status[status["store_id"].isin(status["store_id"].unique()[:5])].iloc[100:160].copy()
+    changed["status"] = changed["status"].map({"active": "inactive", "inactive": "active"})
+    changed.to_csv(tmp_path / "merge.csv", index=False)
+    before = _rollup(db)
+    loader.load_store_status(tmp_path / "merge.csv", mode=LoadMode.MERGE)
+    after = _rollup(db)
+    assert after != before
+    assert after == _rebuilt(db)
+
+
+def test_since_only_rewrites_the_later_hours(db, fleet_files):
+    loader = DataLoader(db)
+    loader.load_business_hours(fleet_files["business_hours"])
+    loader.load_timezones(fleet_files["timezones"])
+    loader.load_store_status(fleet_files["store_status"])
+    full = _rollup(db)
+    store_id, hour = full[len(full) // 2].store_id, full[len(full) // 2].hour_local
+    written = rebuild_rollup(db, since={store_id: pd.Timestamp(hour, tz="UTC").to_pydatetime()})
+    assert 0 < written < sum(row.store_id == store_id for row in full)
+    assert _rollup(db) == full
+
+
+def test_metadata_upload_rebuilds_the_changed_stores(db, fleet_files, tmp_path):
+    loader = DataLoader(db)
+    loader.load_business_hours(fleet_files["business_hours"])
+    loader.load_timezones(fleet_files["timezones"])
+    loader.load_store_status(fleet_files["store_status"])
+    timezones = pd.read_csv(fleet_files["timezones"])
+    timezones.loc[:3, "timezone_str"] = "Asia/Kolkata"
+    timezones.to_csv(tmp_path / "timezones.csv", index=False)
+    hours = pd.read_csv(fleet_files["business_hours"])
+    hours = hours[hours["store_id"] != hours["store_id"].iloc[0]]
+    hours.to_csv(tmp_path / "hours.csv", index=False)
+
+    before = _rollup(db)
+    loader.load_timezones(tmp_path / "timezones.csv")
+    loader.load_business_hours(tmp_path / "hours.csv")
+    after = _rollup(db)
+    assert after != before
+    assert after == _rebuilt(db)
+
+
+def test_report_without_rollup_reads_raw_observations(db, fleet_files):
+    # the report session may be a read replica: a missing rollup is never built from there
+    loader = DataLoader(db)
+    loader.load_business_hours(fleet_files["business_hours"])
+    loader.load_timezones(fleet_files["timezones"])
+    loader.load_store_status(fleet_files["store_status"])
+    db.execute(StoreStatusHourly.__table__.delete())
+    db.commit()
+    reference_time = current_time(db)
+    assert isinstance(time_handler_for(ReportEngine.ROLLUP, db, reference_time), PrefetchTimeHandler)
+    store_ids = sorted(pd.read_csv(fleet_files["store_status"])["store_id"].unique())
+    assert compare_engines(db, ["rollup"], reference_time, DEFAULT_WINDOWS, store_ids) == {"rollup": []}
+    assert _rollup(db) == []
@@ -0,0 +1,68 @@
+import os
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from benchmarks.parity import compare_engines
+from core.services.windows import DEFAULT_WINDOWS, parse_windows
+
+# the sql engine only runs on postgres: TEST_POSTGRES_URL points these tests at a database
+# whose store tables are replaced, a postgres TEST_DATABASE_URL is used as is
+POSTGRES_URL = os.getenv("TEST_POSTGRES_URL") or (
+    os.environ["DATABASE_URL"] if os.environ["DATABASE_URL"].startswith("postgresql") else None)
+
+
+@pytest.fixture(scope="module")
+def pg_db(fleet_files):
+    if not POSTGRES_URL:
+        pytest.skip("set TEST_POSTGRES_URL to run the sql engine tests")
+    pytest.importorskip("psycopg2")
+    from core.db.database import Base
+    from core.db.partitioning import ensure_indexes, prepare_store_status
+    from core.services.data_loader import DataLoader
+    from core.services.incremental import rolling_uptime
+    from core.services.metadata_cache import store_metadata
+
+    engine = create_engine(POSTGRES_URL)
+    try:
+        engine.connect().close()
+    except OperationalError as e:
+        pytest.skip(f"postgres unavailable: {e.orig}")
+    prepare_store_status(engine)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        ensure_indexes(conn)
+
+    # the metadata cache and the rolling state are process wide, they're dropped on the way in
+    # and out so the sqlite tests never see the postgres rows
+    store_metadata.invalidate()
+    db = Session(bind=engine)
+    loader = DataLoader(db)
+    loader.load_store_status(fleet_files["store_status"])
+    loader.load_business_hours(fleet_files["business_hours"])
+    loader.load_timezones(fleet_files["timezones"])
+    yield db
+    db.close()
+    engine.dispose()
+    store_metadata.invalidate()
+    rolling_uptime.reset()
+
+
+@pytest.mark.parametrize("windows", [DEFAULT_WINDOWS, parse_windows("15m,6h,1d,30d")], ids=["default", "custom"])
+@pytest.mark.parametrize("hours_back", [0, 13, 100])
+def test_sql_matches_bulk(pg_db, store_ids, latest, windows, hours_back):
+    # both against per_store on the same postgres rows, so sql == bulk row for row
+    reference_time = latest - timedelta(hours=hours_back)
+    mismatches = compare_engines(pg_db, ["bulk", "sql"], reference_time, windows, store_ids)
+    assert mismatches == {"bulk": [], "sql": []}
+
+
+def test_store_status_primary_key_covers_status(pg_db):
+    # the load swapped in a staged store_status, its key still carries status
+    covering = pg_db.execute(text(
+        "SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i "
+        "WHERE i.indrelid = to_regclass('store_status') AND i.indisprimary")).scalar()
+    assert covering.endswith("(store_id, timestamp_utc) INCLUDE (status)")
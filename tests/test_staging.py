@@ -0,0 +1,53 @@
+import sqlite3
+import threading
+import time
+
+from sqlalchemy import func, select
+
+from core.db import staging
+from core.db.models.store_status import StoreStatus
+from core.services import data_loader
+from core.services.data_loader import DataLoader
+
+
+def _read_for(path, seconds, reading):
+    # a report's read transaction on the live tables, open for as long as the report runs
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("BEGIN")
+        conn.execute("SELECT count(*) FROM store_status").fetchone()
+        reading.set()
+        time.sleep(seconds)
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def test_bulk_load_waits_for_a_long_report(empty_db, fleet_files, monkeypatch):
+    loader = DataLoader(empty_db)
+    loader.load_all(fleet_files["store_status"], fleet_files["business_hours"], fleet_files["timezones"])
+    before = empty_db.execute(select(func.count()).select_from(StoreStatus)).scalar()
+    empty_db.commit()
+
+    # a report starts reading right before the swap and outlasts every short attempt (on
+    # sqlite a reader holds off every write, not just the swap's)
+    report = None
+    swap_in = data_loader.swap_in
+
+    def swap_during_report(engine, tables):
+        nonlocal report
+        reading = threading.Event()
+        report = threading.Thread(target=_read_for, args=(engine.url.database, 1.5, reading))
+        report.start()
+        reading.wait()
+        return swap_in(engine, tables)
+
+    monkeypatch.setattr(staging, "SWAP_ATTEMPTS", 1)
+    monkeypatch.setattr(data_loader, "swap_in", swap_during_report)
+    try:
+        loader.load_all(fleet_files["store_status"], fleet_files["business_hours"], fleet_files["timezones"])
+    finally:
+        if report:
+            report.join()
+    assert loader.stats["swap_attempts"] > staging.SWAP_ATTEMPTS
+    assert empty_db.execute(select(func.count()).select_from(StoreStatus)).scalar() == before